@@ -0,0 +1,303 @@
+# -------------------------------------------------------------------------------
+# Name:        AGWA_DrainageIndex.py
+# Purpose:     Per-workspace drainage index for delineating watersheds without processing the whole DEM
+# -------------------------------------------------------------------------------
+# The index is built once from the flow direction grid and holds the receiver of every cell, the donors of every cell
+# as compressed sparse rows (donors[donor_starts[i]:donor_starts[i + 1]] flow into cell i), and the topological
+# levels of the grid. The arrays are built a band of rows at a time into .npy files and opened memory-mapped, so
+# neither building the index nor a delineation holds the grid in memory, and a delineation only reads the pages of the
+# cells in its basin. Cells are numbered row by row, as in AGWA_TerrainEngine.
+# Like AGWA_TerrainEngine this module does not import arcpy.
+import json
+import os
+import numpy as np
+import AGWA_TerrainEngine
+import AGWA_TiledTerrain
+import importlib
+importlib.reload(AGWA_TerrainEngine)
+importlib.reload(AGWA_TiledTerrain)
+
+INDEX_VERSION = 1
+INDEX_ARRAYS = ("receivers", "donor_starts", "donors", "order", "level_starts")
+INDEX_NAME = "index.json"
+BLOCK_ROWS = 1024
+
+
+def _band_receivers(direction, r0, r1):
+    # receivers of the cells of a band of rows, as flat indices in the grid
+    cols = direction.shape[1]
+    window = AGWA_TiledTerrain.read_window(direction, (r0, r1, 0, cols), 1, 0, np.uint8)
+    receivers = AGWA_TerrainEngine.flow_receivers(window).reshape(window.shape)[1:-1, 1:-1]
+    window_rows, window_cols = np.divmod(receivers, cols + 2)
+
+    return np.where(receivers >= 0, (window_rows + r0 - 1) * cols + window_cols - 1, -1).ravel()
+
+
+def build_drainage_index(direction, index_folder, georeference, source_signature, block_rows=BLOCK_ROWS):
+    """Build the drainage index of a flow direction grid and save it to a folder
+    The arrays are written a band of rows at a time into memory-mapped files, so only a few bands are held in memory.
+    Returns the opened DrainageIndex.
+    : direction - 2D array or memmap of ESRI D8 codes, 0 for NoData
+    : index_folder - folder of the index files, created if it does not exist
+    : georeference - dictionary with x_min, y_max, cell_width, and cell_height of the grid
+    : source_signature - JSON serializable signature of the flow direction raster, used to detect a stale index
+    : block_rows - number of rows processed at a time
+    """
+    if not os.path.exists(index_folder):
+        os.makedirs(index_folder)
+    # remove the description first so an interrupted build is never opened
+    index_path = os.path.join(index_folder, INDEX_NAME)
+    if os.path.exists(index_path):
+        os.remove(index_path)
+
+    rows, cols = direction.shape
+    bands = [(r0, min(r0 + block_rows, rows)) for r0 in range(0, rows, block_rows)]
+    paths = {name: os.path.join(index_folder, name + ".npy") for name in INDEX_ARRAYS}
+    remaining_path = os.path.join(index_folder, "remaining_donors.npy")
+    receivers = AGWA_TiledTerrain.create_array(paths["receivers"], (rows * cols,), np.int64)
+    donor_starts = AGWA_TiledTerrain.create_array(paths["donor_starts"], (rows * cols + 1,), np.int64)
+    remaining = AGWA_TiledTerrain.create_array(remaining_path, (rows * cols,), np.uint8)
+    donor_starts[0] = 0
+    valid_count = 0
+    for r0, r1 in bands:
+        receivers[r0 * cols:r1 * cols] = _band_receivers(direction, r0, r1)
+        valid_count += int(np.count_nonzero(np.asarray(direction[r0:r1]) > 0))
+    for r0, r1 in bands:
+        # the donors of a band are in the band or in the rows next to it
+        cells = np.arange(max(r0 - 1, 0) * cols, min(r1 + 1, rows) * cols)
+        cell_receivers = np.asarray(receivers[cells[0]:cells[-1] + 1])
+        into_band = (cell_receivers >= r0 * cols) & (cell_receivers < r1 * cols)
+        donor_count = np.bincount(cell_receivers[into_band] - r0 * cols, minlength=(r1 - r0) * cols)
+        remaining[r0 * cols:r1 * cols] = donor_count
+        donor_starts[r0 * cols + 1:r1 * cols + 1] = donor_starts[r0 * cols] + np.cumsum(donor_count)
+
+    donors = AGWA_TiledTerrain.create_array(paths["donors"], (int(donor_starts[-1]),), np.int64)
+    for r0, r1 in bands:
+        cells = np.arange(max(r0 - 1, 0) * cols, min(r1 + 1, rows) * cols)
+        cell_receivers = np.asarray(receivers[cells[0]:cells[-1] + 1])
+        into_band = (cell_receivers >= r0 * cols) & (cell_receivers < r1 * cols)
+        band_donors = cells[into_band][np.argsort(cell_receivers[into_band], kind="stable")]
+        donors[donor_starts[r0 * cols]:donor_starts[r1 * cols]] = band_donors
+
+    # topological levels as in AGWA_TerrainEngine.topological_levels, with each level appended to the order file as
+    # the cells of the level before it are processed a band's worth of cells at a time
+    order = AGWA_TiledTerrain.create_array(paths["order"], (valid_count,), np.int64)
+    position = 0
+    for r0, r1 in bands:
+        sources = np.flatnonzero((np.asarray(direction[r0:r1]) > 0).ravel() &
+                                 (np.asarray(remaining[r0 * cols:r1 * cols]) == 0)) + r0 * cols
+        order[position:position + len(sources)] = sources
+        position += len(sources)
+    level_starts = [0]
+    while level_starts[-1] < position:
+        level_start, level_end = level_starts[-1], position
+        for start in range(level_start, level_end, block_rows * cols):
+            downstream = np.asarray(receivers[np.asarray(order[start:min(start + block_rows * cols, level_end)])])
+            downstream, counts = np.unique(downstream[downstream >= 0], return_counts=True)
+            left = remaining[downstream].astype(np.int64) - counts
+            remaining[downstream] = left
+            ready = downstream[left == 0]
+            order[position:position + len(ready)] = ready
+            position += len(ready)
+        level_starts.append(level_end)
+    np.save(paths["level_starts"], np.array(level_starts, dtype=np.int64))
+
+    for values in (receivers, donor_starts, donors, order):
+        values.flush()
+    del receivers, donor_starts, donors, order, remaining
+    os.remove(remaining_path)
+    if position < valid_count:
+        raise Exception("Cannot proceed. \nThe flow paths of {0} cells of the flow direction raster loop without "
+                        "leaving the grid. Derive the flow direction raster again, e.g. with Setup AGWA Workspace."
+                        .format(valid_count - position))
+
+    description = {"version": INDEX_VERSION, "shape": [rows, cols], "georeference": georeference,
+                   "source": source_signature}
+    with open(index_path, "w") as f:
+        json.dump(description, f, indent=1)
+
+    return DrainageIndex(index_folder)
+
+
+def open_drainage_index(index_folder, source_signature):
+    """Open a drainage index, or return None if it does not exist or was built from a different flow direction raster
+    : index_folder - folder of the index files
+    : source_signature - signature of the current flow direction raster
+    """
+    index_path = os.path.join(index_folder, INDEX_NAME)
+    if not os.path.exists(index_path):
+        return None
+    try:
+        with open(index_path, "r") as f:
+            description = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if description.get("version") != INDEX_VERSION or \
+            description.get("source") != json.loads(json.dumps(source_signature)):
+        return None
+    if not all(os.path.exists(os.path.join(index_folder, name + ".npy")) for name in INDEX_ARRAYS):
+        return None
+
+    return DrainageIndex(index_folder)
+
+
+class DrainageIndex(object):
+    """Memory-mapped receiver, donor, and topological order arrays of a flow direction grid
+    : index_folder - folder written by build_drainage_index
+    """
+    def __init__(self, index_folder):
+        with open(os.path.join(index_folder, INDEX_NAME), "r") as f:
+            description = json.load(f)
+        self.index_folder = index_folder
+        self.shape = tuple(description["shape"])
+        self.georeference = description["georeference"]
+        for name in INDEX_ARRAYS:
+            setattr(self, name, np.load(os.path.join(index_folder, name + ".npy"), mmap_mode="r"))
+
+    def cell_of(self, x, y):
+        """Return the flat index of the cells containing map coordinates, -1 outside the grid
+        : x, y - scalars or arrays of map coordinates in the spatial reference of the grid
+        """
+        georeference = self.georeference
+        rows = np.floor((georeference["y_max"] - np.asarray(y, dtype=np.float64)) / georeference["cell_height"])
+        cols = np.floor((np.asarray(x, dtype=np.float64) - georeference["x_min"]) / georeference["cell_width"])
+        inside = (rows >= 0) & (rows < self.shape[0]) & (cols >= 0) & (cols < self.shape[1])
+
+        return np.where(inside, rows * self.shape[1] + cols, -1).astype(np.int64)
+
+    def _gather_donors(self, cells):
+        # donors of all the cells as one flat array, and the number of donors of each cell
+        cells = np.asarray(cells, dtype=np.int64)
+        starts = np.asarray(self.donor_starts[cells])
+        counts = np.asarray(self.donor_starts[cells + 1]) - starts
+        total = int(counts.sum())
+        if total == 0:
+            return np.empty(0, dtype=np.int64), counts
+        # position k of the output reads donors[starts[i] + k - first output position of cell i]
+        offsets = np.repeat(starts - (np.cumsum(counts) - counts), counts) + np.arange(total)
+
+        return np.asarray(self.donors[offsets]), counts
+
+    def donors_of(self, cells):
+        """Return the donors of all the given cells as one flat array
+        : cells - flat cell indices
+        """
+        return self._gather_donors(cells)[0]
+
+    def upstream_cells(self, outlets):
+        """Walk upstream from outlet cells breadth first
+        Returns the flat indices of the outlets and every cell draining to them, touching only those cells.
+        : outlets - flat cell indices of the outlets
+        """
+        frontier = np.unique(np.asarray(outlets, dtype=np.int64))
+        frontier = frontier[frontier >= 0]
+        visited = []
+        while frontier.size > 0:
+            visited.append(frontier)
+            frontier = self.donors_of(frontier)
+        cells = np.concatenate(visited) if visited else np.empty(0, dtype=np.int64)
+
+        # nested outlets reach the cells upstream of the inner outlet twice
+        return np.unique(cells) if len(outlets) > 1 else cells
+
+    def label_upstream(self, outlets):
+        """Label the cells upstream of many outlets in one breadth first walk
+        Each cell gets the label of the nearest outlet downstream of it, so the basin of an outlet nested in the basin
+        of another outlet keeps its own label, and the walk touches every cell of the union of the basins once.
+        Outlet i has label i + 1, and outlets in the same cell share the label of the first of them.
+        Returns the labelled cells, their labels, the label of each outlet, and the parents array, where parents[label]
+        is the label of the basin the outlet with that label drains into, or 0 if it is not nested.
+        : outlets - flat cell indices of the outlets, -1 for outlets outside of the grid
+        """
+        outlets = np.asarray(outlets, dtype=np.int64)
+        outlet_cells, first, inverse = np.unique(outlets, return_index=True, return_inverse=True)
+        cell_labels = first + 1
+        outlet_labels = cell_labels[inverse]
+        inside = outlet_cells >= 0
+        outlet_cells, cell_labels = outlet_cells[inside], cell_labels[inside]
+        parents = np.zeros(len(outlets) + 1, dtype=np.int64)
+
+        frontier, frontier_labels = outlet_cells, cell_labels
+        cells, labels = [], []
+        while frontier.size > 0:
+            cells.append(frontier)
+            labels.append(frontier_labels)
+            donors, counts = self._gather_donors(frontier)
+            donor_labels = np.repeat(frontier_labels, counts)
+            # the walk stops at nested outlets, whose basins are walked from their own label
+            positions = np.searchsorted(outlet_cells, donors)
+            nested = positions < len(outlet_cells)
+            nested[nested] = outlet_cells[positions[nested]] == donors[nested]
+            parents[cell_labels[positions[nested]]] = donor_labels[nested]
+            frontier, frontier_labels = donors[~nested], donor_labels[~nested]
+
+        if not cells:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), outlet_labels, parents
+
+        return np.concatenate(cells), np.concatenate(labels), outlet_labels, parents
+
+    def window_of(self, cells):
+        """Return the rows and columns of cells within their bounding window, and the window (r0, r1, c0, c1)
+        : cells - flat cell indices
+        """
+        rows, cols = np.divmod(np.asarray(cells, dtype=np.int64), self.shape[1])
+        window = (int(rows.min()), int(rows.max()) + 1, int(cols.min()), int(cols.max()) + 1)
+
+        return rows - window[0], cols - window[2], window
+
+
+def nested_labels(parents):
+    """List the labels of every basin and of the basins nested in it
+    Returns a dictionary of label to the sorted labels whose cells make up the whole basin of that label.
+    : parents - parents array from DrainageIndex.label_upstream
+    """
+    members = {label: [label] for label in range(1, len(parents))}
+    for label in range(1, len(parents)):
+        # add the label to every basin downstream of it, nesting follows the flow so it has no cycles
+        parent = parents[label]
+        while parent > 0:
+            members[int(parent)].append(label)
+            parent = parents[parent]
+
+    return {label: sorted(labels) for label, labels in members.items()}
+
+
+def disc_offsets(radius, cell_width, cell_height):
+    """Row and column offsets of the cells whose centers are within a radius of the center of a cell
+    Returns arrays of row and column offsets ordered from the nearest to the farthest cell.
+    : radius - search radius in map units
+    : cell_width, cell_height - cell size in map units
+    """
+    radius_rows = int(np.floor(radius / cell_height))
+    radius_cols = int(np.floor(radius / cell_width))
+    dr, dc = np.mgrid[-radius_rows:radius_rows + 1, -radius_cols:radius_cols + 1]
+    distance = np.hypot(dr * cell_height, dc * cell_width).ravel()
+    inside = distance <= radius
+    nearest = np.argsort(distance[inside], kind="stable")
+
+    return dr.ravel()[inside][nearest], dc.ravel()[inside][nearest]
+
+
+def snap_to_max(values, rows, cols, offsets):
+    """Move every point to the cell of highest value within a footprint around it, e.g. of highest flow accumulation
+    The footprint is evaluated for all points at once, one offset at a time, and ties go to the nearest cell.
+    Returns the snapped rows and columns. Points whose footprint holds no data keep their cell.
+    : values - 2D array, NaN for NoData
+    : rows, cols - arrays of the cells of the points in values
+    : offsets - row and column offsets of the footprint from disc_offsets
+    """
+    rows = np.asarray(rows, dtype=np.int64)
+    cols = np.asarray(cols, dtype=np.int64)
+    best = np.full(len(rows), -np.inf)
+    best_rows, best_cols = rows.copy(), cols.copy()
+    for dr, dc in zip(*offsets):
+        r, c = rows + dr, cols + dc
+        inside = (r >= 0) & (r < values.shape[0]) & (c >= 0) & (c < values.shape[1])
+        candidate = np.full(len(rows), -np.inf)
+        candidate[inside] = values[r[inside], c[inside]]
+        better = candidate > best
+        best[better] = candidate[better]
+        best_rows[better] = r[better]
+        best_cols[better] = c[better]
+
+    return best_rows, best_cols
@@ -0,0 +1,194 @@
+# -------------------------------------------------------------------------------
+# Name:        AGWA_Polygonize.py
+# Purpose:     Convert label arrays to one dissolved polygon per label by tracing the label boundaries
+# -------------------------------------------------------------------------------
+# The boundary of every label is made of the cell edges between a cell of the label and a cell of another label or
+# NoData. Each edge is directed so the label is on its right, the edges are linked end to start into rings, and the
+# rings are ordered with pointer jumping, so no per-cell polygons or intermediate feature classes are created.
+# Outer rings run clockwise and holes counterclockwise, as ArcGIS expects, and where two cells of a label only touch
+# at a corner the rings turn right so the cells are separate parts, as with RasterToPolygon and Dissolve.
+import arcpy
+import os
+import numpy as np
+
+# edge directions in clockwise order, as row and column steps between the vertices of the cell corners
+EAST, SOUTH, WEST, NORTH = 0, 1, 2, 3
+DIRECTION_STEPS = np.array([(0, 1), (1, 0), (0, -1), (-1, 0)])
+
+
+def boundary_edges(labels, nodata):
+    """Find the directed cell edges on the boundaries of the labels
+    Returns the label, start vertex row, start vertex column, and direction of every edge, with vertex (i, j) at the
+    top left corner of cell (i, j).
+    : labels - 2D integer array of labels
+    : nodata - label of cells that are not part of any polygon
+    """
+    rows, cols = labels.shape
+    padded = np.full((rows + 2, cols + 2), nodata, dtype=labels.dtype)
+    padded[1:-1, 1:-1] = labels
+
+    # horizontal edges along vertex row i between cells (i - 1, j) above and (i, j) below, in padded coordinates
+    above, below = padded[:-1, :], padded[1:, :]
+    i, j = np.nonzero(above != below)
+    below_labels, above_labels = below[i, j], above[i, j]
+    i = i + 1
+    # vertical edges along vertex column j between cells (i, j - 1) on the left and (i, j) on the right
+    left, right = padded[:, :-1], padded[:, 1:]
+    vi, vj = np.nonzero(left != right)
+    left_labels, right_labels = left[vi, vj], right[vi, vj]
+    vj = vj + 1
+
+    # the label below runs east, the label above west, the label on the left south, and the label on the right north
+    parts = [(below_labels, i, j, EAST), (above_labels, i, j + 1, WEST),
+             (left_labels, vi, vj, SOUTH), (right_labels, vi + 1, vj, NORTH)]
+    edge_labels, edge_rows, edge_cols, edge_directions = [], [], [], []
+    for part_labels, part_rows, part_cols, direction in parts:
+        valid = part_labels != nodata
+        edge_labels.append(part_labels[valid])
+        edge_rows.append(part_rows[valid] - 1)
+        edge_cols.append(part_cols[valid] - 1)
+        edge_directions.append(np.full(int(valid.sum()), direction, dtype=np.int8))
+
+    return (np.concatenate(edge_labels), np.concatenate(edge_rows).astype(np.int64),
+            np.concatenate(edge_cols).astype(np.int64), np.concatenate(edge_directions))
+
+
+def link_edges(edge_labels, edge_rows, edge_cols, edge_directions):
+    """Find the next edge of every boundary edge, the edge of the same label that starts where it ends
+    Where two edges start at that vertex, the cells of the label touch only at the corner and the right turn is taken.
+    : edge_labels, edge_rows, edge_cols, edge_directions - edges from boundary_edges
+    """
+    _, label_index = np.unique(edge_labels, return_inverse=True)
+    vertex_cols = int(edge_cols.max()) + 2
+    vertex_count = (int(edge_rows.max()) + 2) * vertex_cols
+    start_keys = label_index * vertex_count + edge_rows * vertex_cols + edge_cols
+    end_rows = edge_rows + DIRECTION_STEPS[edge_directions, 0]
+    end_cols = edge_cols + DIRECTION_STEPS[edge_directions, 1]
+    end_keys = label_index * vertex_count + end_rows * vertex_cols + end_cols
+
+    order = np.lexsort((edge_directions, start_keys))
+    sorted_keys = start_keys[order]
+    first = np.searchsorted(sorted_keys, end_keys, "left")
+    count = np.searchsorted(sorted_keys, end_keys, "right") - first
+    right_turn = (edge_directions + 1) % 4
+    second = np.minimum(first + 1, len(order) - 1)
+    take_second = (count == 2) & (edge_directions[order[first]] != right_turn)
+
+    return order[np.where(take_second, second, first)]
+
+
+def order_rings(next_edges):
+    """Split the cycles of the next edge permutation into rings and order the edges of each ring
+    Returns the edges in ring order and the start of each ring, with a final entry equal to the number of edges.
+    : next_edges - next edge of every edge from link_edges
+    """
+    edge_count = len(next_edges)
+    steps = max(int(np.ceil(np.log2(max(edge_count, 2)))) + 1, 1)
+    # the smallest edge of each cycle identifies its ring
+    ring = np.arange(edge_count)
+    jump = next_edges.copy()
+    for _ in range(steps):
+        ring = np.minimum(ring, ring[jump])
+        jump = jump[jump]
+
+    # break each cycle before its smallest edge and count the edges from every edge to the end of its ring
+    last = next_edges == ring
+    remaining = np.where(last, 0, 1)
+    jump = np.where(last, np.arange(edge_count), next_edges)
+    for _ in range(steps):
+        remaining = remaining + remaining[jump]
+        jump = jump[jump]
+
+    edges = np.lexsort((-remaining, ring))
+    ring_starts = np.concatenate([np.flatnonzero(np.diff(ring[edges], prepend=-1)), [edge_count]])
+
+    return edges, ring_starts
+
+
+def trace_rings(labels, nodata):
+    """Trace the boundary rings of every label
+    Returns the label of every ring, the start of every ring in the vertex arrays with a final entry equal to the
+    number of vertices, and the vertex rows and columns, keeping only the corners of each ring.
+    : labels - 2D integer array of labels
+    : nodata - label of cells that are not part of any polygon
+    """
+    edge_labels, edge_rows, edge_cols, edge_directions = boundary_edges(labels, nodata)
+    if len(edge_labels) == 0:
+        empty = np.empty(0, dtype=np.int64)
+        return empty, np.zeros(1, dtype=np.int64), empty, empty
+
+    next_edges = link_edges(edge_labels, edge_rows, edge_cols, edge_directions)
+    edges, ring_starts = order_rings(next_edges)
+
+    # a vertex is a corner where the direction of the ring changes
+    directions = edge_directions[edges]
+    previous = np.arange(len(edges)) - 1
+    ring_lengths = np.diff(ring_starts)
+    previous[ring_starts[:-1]] = ring_starts[1:] - 1
+    corner = directions != directions[previous]
+    ring_of_edge = np.repeat(np.arange(len(ring_lengths)), ring_lengths)
+    corner_count = np.bincount(ring_of_edge[corner], minlength=len(ring_lengths))
+    vertex_starts = np.concatenate([[0], np.cumsum(corner_count)]).astype(np.int64)
+
+    return (edge_labels[edges[ring_starts[:-1]]], vertex_starts, edge_rows[edges[corner]],
+            edge_cols[edges[corner]])
+
+
+def label_polygons(labels, nodata):
+    """Trace one polygon per label
+    Returns a dictionary of label to the list of rings of the label, each an array of vertex (row, column) pairs,
+    with outer rings clockwise and holes counterclockwise when drawn north up.
+    : labels - 2D integer array of labels
+    : nodata - label of cells that are not part of any polygon
+    """
+    ring_labels, vertex_starts, vertex_rows, vertex_cols = trace_rings(labels, nodata)
+    polygons = {}
+    for ring, label in enumerate(ring_labels):
+        start, end = vertex_starts[ring], vertex_starts[ring + 1]
+        polygons.setdefault(label.item(), []).append(np.column_stack([vertex_rows[start:end],
+                                                                      vertex_cols[start:end]]))
+
+    return polygons
+
+
+def to_polygon(rings, x_min, y_max, cell_width, cell_height, spatial_reference=None):
+    """Convert the rings of a label to an arcpy.Polygon in map coordinates
+    : rings - rings of one label from label_polygons
+    : x_min, y_max - map coordinates of the top left corner of the label array
+    : cell_width, cell_height - cell size in map units
+    : spatial_reference - spatial reference of the polygon
+    """
+    parts = arcpy.Array()
+    for ring in rings:
+        x = x_min + ring[:, 1] * cell_width
+        y = y_max - ring[:, 0] * cell_height
+        part = arcpy.Array([arcpy.Point(float(px), float(py)) for px, py in zip(x, y)])
+        part.add(arcpy.Point(float(x[0]), float(y[0])))
+        parts.add(part)
+
+    return arcpy.Polygon(parts, spatial_reference)
+
+
+def save_label_polygons(labels, nodata, x_min, y_max, cell_width, cell_height, spatial_reference, out_fc,
+                        label_field="gridcode"):
+    """Save one dissolved polygon per label to a new feature class
+    : labels - 2D integer array of labels
+    : nodata - label of cells that are not part of any polygon
+    : x_min, y_max - map coordinates of the top left corner of the label array
+    : cell_width, cell_height - cell size in map units
+    : spatial_reference - spatial reference of the feature class
+    : out_fc - output feature class
+    : label_field - integer field the labels are written to
+    """
+    out_path, out_name = os.path.split(out_fc)
+    if not out_path:
+        out_path = arcpy.env.workspace
+    result = arcpy.management.CreateFeatureclass(out_path, out_name, "POLYGON", spatial_reference=spatial_reference)
+    out_fc = result.getOutput(0)
+    arcpy.management.AddField(out_fc, label_field, "LONG")
+    with arcpy.da.InsertCursor(out_fc, ["SHAPE@", label_field]) as cursor:
+        for label, rings in label_polygons(labels, nodata).items():
+            cursor.insertRow((to_polygon(rings, x_min, y_max, cell_width, cell_height, spatial_reference),
+                              int(label)))
+
+    return out_fc
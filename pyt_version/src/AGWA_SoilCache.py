@@ -0,0 +1,112 @@
+# -------------------------------------------------------------------------------
+# Name:        AGWA_SoilCache.py
+# Purpose:     Persistent cache of weighted soil parameters by mukey
+# -------------------------------------------------------------------------------
+# The weighted parameters of a mukey depend only on the soils database, kin_lut, max_horizons, and max_thickness,
+# so they are stored in a SQLite database under a key derived from those inputs and reused across workspaces.
+import datetime
+import hashlib
+import json
+import os
+import sqlite3
+
+# increase when the soil weighting changes so results cached by earlier versions are not reused
+CACHE_VERSION = 1
+QUERY_BATCH_SIZE = 500
+
+
+def database_signature(soils_database):
+    """Identify a soils database by its path and the size and modification time of its files
+    Lock files are ignored so opening the database in ArcGIS does not change its signature.
+    : soils_database - file geodatabase or other database with the SSURGO tables
+    """
+    path = os.path.normcase(os.path.abspath(soils_database))
+    entries = []
+    if os.path.isdir(path):
+        for name in sorted(os.listdir(path)):
+            file_path = os.path.join(path, name)
+            if os.path.isfile(file_path) and not name.lower().endswith(".lock"):
+                stat = os.stat(file_path)
+                entries.append([name, stat.st_size, stat.st_mtime_ns])
+    elif os.path.isfile(path):
+        stat = os.stat(path)
+        entries.append(["", stat.st_size, stat.st_mtime_ns])
+
+    return hashlib.sha1(json.dumps([path, entries]).encode("utf-8")).hexdigest()
+
+
+def make_cache_key(soils_database, max_horizons, max_thickness, kin_lut_by_texture):
+    """Build the key of the cached parameters of a soils database and weighting options
+    : soils_database - file geodatabase with the SSURGO tables
+    : max_horizons - maximum number of horizons weighted, 0 for all
+    : max_thickness - maximum thickness weighted, 0 for all
+    : kin_lut_by_texture - dictionary of texture name to kin_lut rows
+    """
+    kin_lut = sorted([texture, [list(row) for row in rows]] for texture, rows in kin_lut_by_texture.items())
+    key = [CACHE_VERSION, database_signature(soils_database), max_horizons, max_thickness, kin_lut]
+
+    return hashlib.sha1(json.dumps(key, default=str).encode("utf-8")).hexdigest()
+
+
+class SoilParameterCache(object):
+    """SQLite store of weighted soil parameters
+    Each entry holds the soil, component, horizon, and texture values of one mukey under a cache key.
+    : cache_path - path of the SQLite database, created if it does not exist
+    """
+    def __init__(self, cache_path):
+        self.cache_path = cache_path
+        self._connection = sqlite3.connect(cache_path, timeout=60)
+        with self._connection:
+            self._connection.execute("CREATE TABLE IF NOT EXISTS soil_parameters ("
+                                     "cache_key TEXT NOT NULL, mukey TEXT NOT NULL, parameters TEXT NOT NULL, "
+                                     "creation_date TEXT NOT NULL, PRIMARY KEY (cache_key, mukey))")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def lookup(self, cache_key, mukeys):
+        """Return a dictionary of mukey to cached parameters for the mukeys found in the cache
+        : cache_key - key from make_cache_key
+        : mukeys - iterable of mukeys
+        """
+        mukeys = [str(mukey) for mukey in mukeys]
+        found = {}
+        for start in range(0, len(mukeys), QUERY_BATCH_SIZE):
+            batch = mukeys[start:start + QUERY_BATCH_SIZE]
+            query = "SELECT mukey, parameters FROM soil_parameters WHERE cache_key = ? AND mukey IN ({})".format(
+                ", ".join(["?"] * len(batch)))
+            for mukey, parameters in self._connection.execute(query, [cache_key] + batch):
+                found[mukey] = json.loads(parameters)
+
+        return found
+
+    def store(self, cache_key, parameters_by_mukey):
+        """Save the parameters of many mukeys in one transaction
+        : cache_key - key from make_cache_key
+        : parameters_by_mukey - dictionary of mukey to JSON serializable parameters
+        """
+        creation_date = datetime.datetime.now().isoformat()
+        with self._connection:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO soil_parameters (cache_key, mukey, parameters, creation_date) "
+                "VALUES (?, ?, ?, ?)",
+                [(cache_key, str(mukey), json.dumps(parameters), creation_date)
+                 for mukey, parameters in parameters_by_mukey.items()])
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+
+def open_cache(cache_path):
+    """Open the soil parameter cache, or return None when it cannot be opened, e.g. in a read-only directory
+    : cache_path - path of the SQLite database
+    """
+    try:
+        return SoilParameterCache(cache_path)
+    except sqlite3.Error:
+        return None
@@ -0,0 +1,208 @@
+# -------------------------------------------------------------------------------
+# Name:        AGWA_StreamNetwork.py
+# Purpose:     NumPy stream network extraction from D8 flow direction grids for discretization
+# -------------------------------------------------------------------------------
+# The stream cells, stream links, Shreve orders, link polylines, and link topology are derived in one pass over the
+# flow direction grid of a delineation, like StreamLink, StreamOrder, and StreamToFeature, and the elements are
+# labelled by routing every cell to the first stream cell downstream of it, like Watershed with every stream cell as a
+# pour point. For KINEROS2 the cells of each link are further split into left and right laterals by where their flow
+# paths enter the link. A link starts at a stream cell without exactly one stream cell flowing into it, so at a source
+# or just below a confluence, and links are numbered from 1 in row-major order of their first cells. Cells are
+# numbered row by row, as in AGWA_TerrainEngine.
+# Like AGWA_TerrainEngine this module does not import arcpy.
+import numpy as np
+import AGWA_TerrainEngine
+import importlib
+importlib.reload(AGWA_TerrainEngine)
+
+
+def extract_stream_network(direction, flow_length_upstream, threshold, mask=None):
+    """Extract the stream network of a flow direction grid
+    Returns a dictionary with
+        receivers - flat receiver array of the cells in the mask
+        streams - flat boolean array of the stream cells
+        links - flat array of the link of every stream cell, 0 elsewhere
+        link_starts, link_cells - the cells of link i from upstream to downstream are
+                                  link_cells[link_starts[i - 1]:link_starts[i]]
+        downstream_links - link each link flows into, 0 for outlet links, indexed by link - 1
+        shreve - Shreve order of each link, indexed by link - 1
+        from_nodes, to_nodes - node at the start and end of each link, indexed by link - 1. The from node of a link is
+                               its number and the to node of an outlet link is a new node after the last link.
+        outlet_links - links that do not flow into another link
+    : direction - 2D array of ESRI D8 codes, 0 for NoData
+    : flow_length_upstream - 2D array of upstream flow lengths, NaN for NoData
+    : threshold - minimum upstream flow length of a stream cell
+    : mask - optional 2D boolean array of the cells of the delineation
+    """
+    direction = np.asarray(direction)
+    if mask is None:
+        mask = direction > 0
+    # cells flowing out of the mask have no receiver, as cells flowing out of the DEM
+    receivers = AGWA_TerrainEngine.flow_receivers(np.where(mask, direction, 0))
+    with np.errstate(invalid="ignore"):
+        streams = (mask & (np.nan_to_num(flow_length_upstream, nan=-np.inf) > threshold)).ravel()
+
+    cells = np.flatnonzero(streams)
+    index = np.full(streams.size, -1, dtype=np.int64)
+    index[cells] = np.arange(len(cells))
+    downstream = receivers[cells]
+    flows_to_stream = downstream >= 0
+    flows_to_stream[flows_to_stream] = streams[downstream[flows_to_stream]]
+    downstream = np.where(flows_to_stream, index[np.maximum(downstream, 0)], -1)
+    stream_donors = np.bincount(downstream[flows_to_stream], minlength=len(cells))
+    heads = stream_donors != 1
+
+    # every cell that is not the first cell of a link has one stream cell flowing into it, pointer jumping up that
+    # chain finds the first cell of the link and the number of cells from it
+    upstream = np.arange(len(cells))
+    upstream[downstream[flows_to_stream]] = np.flatnonzero(flows_to_stream)
+    upstream[heads] = np.flatnonzero(heads)
+    distance = np.where(heads, 0, 1)
+    while not np.all(heads[upstream]):
+        distance = distance + distance[upstream]
+        upstream = upstream[upstream]
+    # the jump target is the first cell, whose distance is 0, so one more step completes the count
+    distance = distance + distance[upstream]
+
+    link_numbers = np.cumsum(heads)
+    cell_links = link_numbers[upstream]
+    link_count = int(heads.sum())
+    links = np.zeros(streams.size, dtype=np.int64)
+    links[cells] = cell_links
+    order = np.lexsort((distance, cell_links))
+    link_cells = cells[order]
+    link_starts = np.concatenate([[0], np.cumsum(np.bincount(cell_links, minlength=link_count + 1)[1:])])
+
+    # a link flows into the link of the stream cell below its last cell
+    last_cells = order[link_starts[1:] - 1]
+    downstream_links = np.where(flows_to_stream[last_cells], cell_links[np.maximum(downstream[last_cells], 0)], 0)
+    link_receivers = downstream_links - 1
+    link_order, level_starts = AGWA_TerrainEngine.topological_levels(link_receivers)
+    sources = np.bincount(link_receivers[link_receivers >= 0], minlength=link_count) == 0
+    shreve = AGWA_TerrainEngine.flow_accumulation(link_receivers, link_order, level_starts,
+                                                  sources.astype(np.float64)) + sources
+    outlet_links = np.flatnonzero(downstream_links == 0) + 1
+
+    from_nodes = np.arange(1, link_count + 1)
+    to_nodes = np.where(downstream_links > 0, downstream_links, 0)
+    to_nodes[outlet_links - 1] = link_count + np.arange(1, len(outlet_links) + 1)
+
+    return {"receivers": receivers, "streams": streams, "links": links, "link_starts": link_starts,
+            "link_cells": link_cells, "downstream_links": downstream_links, "shreve": shreve.astype(np.int64),
+            "from_nodes": from_nodes, "to_nodes": to_nodes, "outlet_links": outlet_links}
+
+
+def link_vertices(network, link, direction):
+    """Return the rows and columns of the vertices of a link from upstream to downstream, in cell units from the top
+    left corner of the grid so cell centers are at half cells
+    A link that flows into another link ends at the center of the first cell of that link so the polylines of the
+    network connect, and an outlet link of a single cell ends half a cell downstream of its center.
+    : network - dictionary from extract_stream_network
+    : link - link number
+    : direction - 2D array of ESRI D8 codes the network was extracted from
+    """
+    cells = network["link_cells"][network["link_starts"][link - 1]:network["link_starts"][link]]
+    downstream_link = network["downstream_links"][link - 1]
+    if downstream_link > 0:
+        cells = np.append(cells, network["link_cells"][network["link_starts"][downstream_link - 1]])
+    rows, cols = np.divmod(cells, direction.shape[1])
+    rows, cols = rows + 0.5, cols + 0.5
+    if len(cells) == 1:
+        position = AGWA_TerrainEngine.D8_INDEX[int(direction.flat[cells[0]])]
+        dr, dc = AGWA_TerrainEngine.D8_OFFSETS[position] if position >= 0 else (0, 0)
+        rows, cols = np.append(rows, rows[0] + dr / 2), np.append(cols, cols[0] + dc / 2)
+
+    return rows, cols
+
+
+def element_labels(network, mask=None, direction=None):
+    """Label every cell with the element it drains to
+    Stream cells are labelled with their link times 10, plus 1 for the first cell of a first order link so the area
+    above the source of the stream is its own upland element. Every other cell gets the label of the first stream cell
+    downstream of it, and cells that leave the mask without reaching a stream are 0.
+    With a flow direction grid the cells of each link are split into laterals, plus 2 for the cells that enter the link
+    from the right and plus 3 for the cells that enter from the left looking downstream. The stream line runs through
+    the stream cells, so they alternate between the two laterals along the link, starting on the right, and go to the
+    only lateral of a link that has hillslope cells on one side only.
+    Returns a flat array of labels.
+    : network - dictionary from extract_stream_network
+    : mask - optional flat boolean array of the cells to label, defaults to every cell
+    : direction - optional 2D array of ESRI D8 codes the network was extracted from, to split the laterals
+    """
+    receivers = network["receivers"]
+    link_cells = network["link_cells"]
+    labels = np.zeros(len(receivers), dtype=np.int64)
+    labels[link_cells] = network["links"][link_cells] * 10
+    first_order = np.flatnonzero(network["shreve"] == 1)
+    labels[link_cells[network["link_starts"][first_order]]] += 1
+
+    if direction is not None:
+        # the side of a hillslope flow path is decided where it enters the link, and carried upstream with the label
+        entries = np.flatnonzero(~network["streams"] & (receivers >= 0))
+        entries = entries[network["streams"][receivers[entries]]]
+        lateral = labels[receivers[entries]] % 10 == 0
+        entries = entries[lateral]
+        sides = lateral_sides(network, direction, entries)
+        labels[entries] = labels[receivers[entries]] + sides
+        # split the stream cells of each link between the laterals on its sides
+        link_count = len(network["shreve"])
+        entry_links = network["links"][receivers[entries]]
+        has_right = np.bincount(entry_links[sides == 2], minlength=link_count + 1) > 0
+        has_left = np.bincount(entry_links[sides == 3], minlength=link_count + 1) > 0
+        link_starts = network["link_starts"]
+        positions = np.arange(len(link_cells)) - np.repeat(link_starts[:-1], np.diff(link_starts))
+        cell_links = network["links"][link_cells]
+        stream_sides = np.where(positions % 2 == 0, 2, 3)
+        stream_sides[~has_left[cell_links]] = 2
+        stream_sides[has_left[cell_links] & ~has_right[cell_links]] = 3
+        laterals = labels[link_cells] % 10 == 0
+        labels[link_cells[laterals]] += stream_sides[laterals]
+
+    # walk the levels from the outlets to the ridges so each cell takes the label of its receiver
+    order, level_starts = AGWA_TerrainEngine.topological_levels(receivers, mask)
+    for start, end in zip(level_starts[-2::-1], level_starts[:0:-1]):
+        cells = order[start:end]
+        downstream = receivers[cells]
+        unlabelled = (labels[cells] == 0) & (downstream >= 0)
+        labels[cells[unlabelled]] = labels[downstream[unlabelled]]
+
+    return labels
+
+
+def lateral_sides(network, direction, entries):
+    """Find the side of the link each hillslope cell flows into it from
+    The local downstream direction of a stream cell runs from the stream cell above it to the cell its flow direction
+    points to, so a cell entering at a bend is judged against the bend rather than one of its legs. Where the cell
+    lies on that line, the outgoing and then the incoming leg decide, and the right side is taken if neither does.
+    Returns 2 for the right and 3 for the left of every entry cell.
+    : network - dictionary from extract_stream_network
+    : direction - 2D array of ESRI D8 codes the network was extracted from
+    : entries - flat indices of cells that are not stream cells and flow into a stream cell
+    """
+    shape = direction.shape
+    link_cells = network["link_cells"]
+    links = network["links"]
+    # the stream cell above each stream cell in the same link, -1 at the first cell of a link
+    upstream = np.full(len(links), -1, dtype=np.int64)
+    same_link = links[link_cells[1:]] == links[link_cells[:-1]]
+    upstream[link_cells[1:][same_link]] = link_cells[:-1][same_link]
+
+    stream_cells = network["receivers"][entries]
+    rows, cols = np.divmod(stream_cells, shape[1])
+    entry_rows, entry_cols = np.divmod(entries, shape[1])
+    entry_rows, entry_cols = entry_rows - rows, entry_cols - cols
+    positions = AGWA_TerrainEngine.D8_INDEX[direction.ravel()[stream_cells].astype(np.int64)]
+    offsets = np.vstack([np.array(AGWA_TerrainEngine.D8_OFFSETS), [(0, 0)]])
+    out_rows, out_cols = offsets[positions].T
+    above = upstream[stream_cells]
+    above_rows, above_cols = np.divmod(np.maximum(above, 0), shape[1])
+    in_rows = np.where(above >= 0, rows - above_rows, 0)
+    in_cols = np.where(above >= 0, cols - above_cols, 0)
+
+    # the cross product of the downstream direction and the entry offset is positive on the left, with rows down
+    cross = np.zeros(len(entries), dtype=np.int64)
+    for flow_rows, flow_cols in ((in_rows + out_rows, in_cols + out_cols), (out_rows, out_cols), (in_rows, in_cols)):
+        undecided = cross == 0
+        cross[undecided] = (flow_rows * entry_cols - flow_cols * entry_rows)[undecided]
+
+    return np.where(cross > 0, 3, 2)
@@ -0,0 +1,221 @@
+# -------------------------------------------------------------------------------
+# Name:        AGWA_TerrainCache.py
+# Purpose:     Content-addressed cache of the terrain rasters derived during workspace setup
+# -------------------------------------------------------------------------------
+# The rasters derived from a DEM depend only on the content of the DEM and the derivation options, so they are stored
+# under a hash of both and hard-linked into every workspace set up on the same DEM. Each cache entry has a manifest
+# with the size and modification time of its files, and an entry whose files were changed or removed is treated as
+# missing, so edited products are never reused.
+import hashlib
+import json
+import os
+import shutil
+
+# increase when the derivation of the terrain rasters changes so products cached by earlier versions are not reused
+CACHE_VERSION = 1
+MANIFEST_NAME = "manifest.json"
+READ_BLOCK_SIZE = 16 * 1024 * 1024
+COPIED_SIDECARS = (".aux.xml", ".ovr")
+
+
+def hash_file(path, digest=None):
+    """Hash the bytes of a file
+    Returns the hex digest, or updates and returns the given hashlib object.
+    : path - file to hash
+    : digest - optional hashlib object to update
+    """
+    file_digest = hashlib.sha256() if digest is None else digest
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(READ_BLOCK_SIZE), b""):
+            file_digest.update(block)
+
+    return file_digest.hexdigest() if digest is None else file_digest
+
+
+def make_cache_key(input_signatures, parameters):
+    """Build the key of the terrain rasters derived from a set of inputs
+    : input_signatures - JSON serializable content hashes of the inputs, e.g. of the DEM
+    : parameters - JSON serializable derivation options, e.g. the terrain engine
+    """
+    key = [CACHE_VERSION, input_signatures, parameters]
+    return hashlib.sha256(json.dumps(key, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+def raster_files(raster_path):
+    """List the files of a file based raster, the raster file and its sidecar files such as .aux.xml and .tfw
+    : raster_path - path of the raster file, e.g. fd.tif
+    """
+    folder, name = os.path.split(raster_path)
+    base_name = os.path.splitext(name)[0]
+    files = []
+    for file_name in sorted(os.listdir(folder)):
+        if file_name == name or file_name.startswith(name + ".") or \
+                (os.path.splitext(file_name)[0] == base_name and file_name != name):
+            file_path = os.path.join(folder, file_name)
+            if os.path.isfile(file_path):
+                files.append(file_path)
+
+    return files
+
+
+def link_file(source, destination):
+    # hard link a file, or copy it when hard links are not supported, e.g. across drives. Statistics and pyramids
+    # are rewritten in place by ArcGIS, so they are always copied to keep the workspace from changing the cache.
+    if os.path.lexists(destination):
+        os.remove(destination)
+    if source.endswith(COPIED_SIDECARS):
+        shutil.copy2(source, destination)
+        return
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copy2(source, destination)
+
+
+class TerrainCache(object):
+    """Folder of cached terrain rasters, with one entry folder per cache key
+    : cache_directory - folder of the cache, created if it does not exist
+    """
+    def __init__(self, cache_directory):
+        self.cache_directory = cache_directory
+        if not os.path.exists(cache_directory):
+            os.makedirs(cache_directory)
+
+    def entry_directory(self, cache_key):
+        return os.path.join(self.cache_directory, cache_key[:2], cache_key)
+
+    def _read_manifest(self, cache_key):
+        manifest_path = os.path.join(self.entry_directory(cache_key), MANIFEST_NAME)
+        if not os.path.exists(manifest_path):
+            return {}
+        try:
+            with open(manifest_path, "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def lookup(self, cache_key, raster_names):
+        """Return a dictionary of raster name to cached raster path, or None if any raster is missing or was changed
+        : cache_key - key from make_cache_key
+        : raster_names - names of the raster files needed, e.g. fd.tif
+        """
+        manifest = self._read_manifest(cache_key)
+        entry_directory = self.entry_directory(cache_key)
+        rasters = {}
+        for raster_name in raster_names:
+            files = manifest.get(raster_name)
+            if not files:
+                return None
+            for file_name, (size, modification_time) in files.items():
+                file_path = os.path.join(entry_directory, file_name)
+                if not os.path.isfile(file_path):
+                    return None
+                stat = os.stat(file_path)
+                if stat.st_size != size or stat.st_mtime_ns != modification_time:
+                    return None
+            rasters[raster_name] = os.path.join(entry_directory, raster_name)
+
+        return rasters
+
+    def store(self, cache_key, raster_paths):
+        """Add rasters and their sidecar files to the entry of a cache key
+        : cache_key - key from make_cache_key
+        : raster_paths - paths of file based rasters, e.g. the fd.tif of a workspace
+        """
+        entry_directory = self.entry_directory(cache_key)
+        if not os.path.exists(entry_directory):
+            os.makedirs(entry_directory)
+        manifest = self._read_manifest(cache_key)
+        for raster_path in raster_paths:
+            files = {}
+            for file_path in raster_files(raster_path):
+                file_name = os.path.basename(file_path)
+                cached_path = os.path.join(entry_directory, file_name)
+                link_file(file_path, cached_path)
+                stat = os.stat(cached_path)
+                files[file_name] = [stat.st_size, stat.st_mtime_ns]
+            manifest[os.path.basename(raster_path)] = files
+
+        # write the manifest last and atomically so a partial entry is never read as complete
+        temporary_path = os.path.join(entry_directory, MANIFEST_NAME + ".tmp")
+        with open(temporary_path, "w") as f:
+            json.dump(manifest, f, indent=1)
+        os.replace(temporary_path, os.path.join(entry_directory, MANIFEST_NAME))
+
+    def changed_rasters(self, cache_key, raster_paths):
+        """Return the rasters whose files are no longer the files of the cache entry they were derived into
+        A workspace raster is a hard link to or a copy of the cached file, so it keeps the size and modification time
+        recorded in the manifest until it is edited or replaced. Rasters that are not in the entry, e.g. rasters
+        supplied by the user, and the statistics and pyramids that ArcGIS rewrites in place are not compared.
+        Returns None when the entry does not exist.
+        : cache_key - key recorded when the rasters were derived
+        : raster_paths - paths of the workspace rasters, e.g. its fd.tif
+        """
+        manifest = self._read_manifest(cache_key)
+        if not manifest:
+            return None
+        changed = []
+        for raster_path in raster_paths:
+            files = manifest.get(os.path.basename(raster_path), {})
+            for file_name, (size, modification_time) in files.items():
+                if file_name.endswith(COPIED_SIDECARS):
+                    continue
+                file_path = os.path.join(os.path.dirname(raster_path), file_name)
+                if not os.path.isfile(file_path):
+                    changed.append(raster_path)
+                    break
+                stat = os.stat(file_path)
+                if stat.st_size != size or stat.st_mtime_ns != modification_time:
+                    changed.append(raster_path)
+                    break
+
+        return changed
+
+    def link(self, cache_key, raster_names, destination_folder):
+        """Link cached rasters and their sidecar files into a folder
+        Returns a dictionary of raster name to linked raster path.
+        : cache_key - key from make_cache_key
+        : raster_names - names of the raster files, e.g. fd.tif
+        : destination_folder - folder the rasters are linked into
+        """
+        manifest = self._read_manifest(cache_key)
+        entry_directory = self.entry_directory(cache_key)
+        rasters = {}
+        for raster_name in raster_names:
+            for file_name in manifest[raster_name]:
+                link_file(os.path.join(entry_directory, file_name), os.path.join(destination_folder, file_name))
+            rasters[raster_name] = os.path.join(destination_folder, raster_name)
+
+        return rasters
+
+
+def open_cache(cache_directory):
+    """Open the terrain cache, or return None when it cannot be created, e.g. in a read-only directory
+    : cache_directory - folder of the cache
+    """
+    try:
+        return TerrainCache(cache_directory)
+    except OSError:
+        return None
+
+
+def cache_directory_of(agwa_directory):
+    """Return the folder of the terrain cache of an AGWA directory
+    : agwa_directory - AGWA directory recorded in metaWorkspace
+    """
+    return os.path.join(agwa_directory, "datafiles", "terrain_cache")
+
+
+def changed_workspace_rasters(agwa_directory, cache_key, raster_paths):
+    """Return the workspace rasters that changed since they were derived under a cache key
+    Returns None when nothing can be compared: no key was recorded, because every raster was supplied, or the cache
+    or its entry is not available.
+    : agwa_directory - AGWA directory recorded in metaWorkspace
+    : cache_key - TerrainCacheKey recorded in metaWorkspace
+    : raster_paths - paths of the workspace rasters to compare
+    """
+    cache_directory = cache_directory_of(agwa_directory) if agwa_directory else None
+    if not cache_key or not cache_directory or not os.path.isdir(cache_directory):
+        return None
+
+    return TerrainCache(cache_directory).changed_rasters(cache_key, raster_paths)
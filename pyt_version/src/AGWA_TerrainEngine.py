@@ -0,0 +1,540 @@
+# -------------------------------------------------------------------------------
+# Name:        AGWA_TerrainEngine.py
+# Purpose:     NumPy D8 terrain engine for filling, flow routing, and terrain derivatives of a DEM
+# -------------------------------------------------------------------------------
+# Every function works on 2D arrays with NaN for NoData, so the engine can run on headless batch nodes without
+# ArcGIS; code_setup_agwa_workspace loads and saves the rasters with arcpy when it is run from the toolbox.
+# Conventions follow the Spatial Analyst tools:
+#   - flow directions use the ESRI D8 codes 1 (east), 2, 4, 8, 16, 32, 64, 128 (northeast);
+#   - cells on the edge of the DEM or next to NoData flow out of the DEM when they have no lower neighbour;
+#   - flow accumulation counts the upstream cells (or weights) of a cell, excluding the cell itself;
+#   - slope is in percent rise and aspect in degrees clockwise from north, -1 for flat cells.
+# Depressions are filled by flooding the graph of pit basins rather than every cell, and flows are accumulated in
+# topological levels, so all per-cell work is vectorized with NumPy.
+import time
+import numpy as np
+
+# row and column offsets of the D8 neighbours in the order of the ESRI direction codes
+D8_OFFSETS = ((0, 1), (1, 1), (1, 0), (1, -1), (0, -1), (-1, -1), (-1, 0), (-1, 1))
+D8_CODES = np.array([1, 2, 4, 8, 16, 32, 64, 128], dtype=np.uint8)
+D8_DISTANCES = np.array([1, np.sqrt(2)] * 4)
+# position of each direction code in D8_OFFSETS, -1 for values that are not a single direction
+D8_INDEX = np.full(256, -1, dtype=np.int8)
+D8_INDEX[D8_CODES] = np.arange(8)
+
+
+def _shifted(values, dr, dc, fill_value):
+    # values of the neighbour at offset (dr, dc) of every cell, fill_value beyond the edge
+    rows, cols = values.shape
+    shifted = np.full(values.shape, fill_value, dtype=values.dtype)
+    shifted[max(0, -dr):rows - max(0, dr), max(0, -dc):cols - max(0, dc)] = \
+        values[max(0, dr):rows - max(0, -dr), max(0, dc):cols - max(0, -dc)]
+    return shifted
+
+
+def _steepest_descent(z):
+    """Find the steepest downhill neighbour and the first neighbour beyond the DEM or in NoData of every cell
+    Returns two arrays of positions in D8_OFFSETS, -1 where there is no such neighbour.
+    : z - 2D elevation array with NaN for NoData
+    """
+    best_drop = np.zeros(z.shape)
+    steepest = np.full(z.shape, -1, dtype=np.int8)
+    outside = np.full(z.shape, -1, dtype=np.int8)
+    with np.errstate(invalid="ignore"):
+        for k, (dr, dc) in enumerate(D8_OFFSETS):
+            neighbour = _shifted(z, dr, dc, np.nan)
+            drop = (z - neighbour) / D8_DISTANCES[k]
+            steeper = drop > best_drop
+            steepest[steeper] = k
+            best_drop[steeper] = drop[steeper]
+            outside[np.isnan(neighbour) & (outside < 0)] = k
+    nodata = np.isnan(z)
+    steepest[nodata] = -1
+    outside[nodata] = -1
+
+    return steepest, outside
+
+
+def _neighbour_index(cells, k, shape):
+    # flat index of the neighbour of flat cell indices in direction k, -1 beyond the edge
+    rows, cols = shape
+    dr, dc = D8_OFFSETS[k]
+    r = cells // cols + dr
+    c = cells % cols + dc
+    inside = (r >= 0) & (r < rows) & (c >= 0) & (c < cols)
+    return np.where(inside, r * cols + c, -1)
+
+
+def find_roots(receivers):
+    # follow the receivers of every cell to the end of its flow path by pointer jumping
+    roots = receivers.copy()
+    while True:
+        next_roots = roots[roots]
+        if np.array_equal(next_roots, roots):
+            return roots
+        roots = next_roots
+
+
+def descent_basins(z):
+    """Label every cell with the basin of the cell its steepest descent path ends in
+    Returns a 2D int64 array of basin labels numbered from 0, -1 for NoData, and the number of basins.
+    : z - 2D elevation array with NaN for NoData
+    """
+    steepest = _steepest_descent(z)[0].ravel()
+    cells = np.arange(z.size)
+    receivers = cells.copy()
+    for k in range(8):
+        selected = steepest == k
+        receivers[selected] = _neighbour_index(cells[selected], k, z.shape)
+    valid = ~np.isnan(z).ravel()
+    basin_roots, basin = np.unique(find_roots(receivers)[valid], return_inverse=True)
+    labels = np.full(z.size, -1, dtype=np.int64)
+    labels[valid] = basin
+
+    return labels.reshape(z.shape), len(basin_roots)
+
+
+def basin_crossings(z, labels):
+    """Find where water crosses between neighbouring basins
+    The arrays have a one cell border around the cells whose east, southeast, south, and southwest neighbours are
+    paired, so every pair of neighbouring cells is found once when the cores of tiles are processed separately.
+    Returns the lower basin label, higher basin label, and lowest crossing elevation of every pair of basins.
+    : z - elevations with NaN for NoData and beyond the DEM
+    : labels - basin labels aligned with z, -1 for NoData and beyond the DEM
+    """
+    rows = z.shape[0] - 2
+    cols = z.shape[1] - 2
+    core_z = z[1:-1, 1:-1]
+    core_labels = labels[1:-1, 1:-1]
+    low = []
+    high = []
+    weight = []
+    for dr, dc in D8_OFFSETS[:4]:
+        neighbour_z = z[1 + dr:1 + dr + rows, 1 + dc:1 + dc + cols]
+        neighbour_labels = labels[1 + dr:1 + dr + rows, 1 + dc:1 + dc + cols]
+        crossing = (core_labels >= 0) & (neighbour_labels >= 0) & (core_labels != neighbour_labels)
+        low.append(np.minimum(core_labels[crossing], neighbour_labels[crossing]))
+        high.append(np.maximum(core_labels[crossing], neighbour_labels[crossing]))
+        weight.append(np.maximum(core_z[crossing], neighbour_z[crossing]))
+
+    return lowest_crossings(np.concatenate(low), np.concatenate(high), np.concatenate(weight))
+
+
+def outlet_crossings(z, labels, outside_node):
+    """Find where water leaves the DEM, through any cell next to the edge of the DEM or to NoData
+    Returns crossings like basin_crossings between the basins and the outside node.
+    : z, labels - arrays with a one cell border like basin_crossings
+    : outside_node - label of the node outside of the DEM
+    """
+    outlet = (_steepest_descent(z)[1][1:-1, 1:-1] >= 0) & (labels[1:-1, 1:-1] >= 0)
+    return lowest_crossings(labels[1:-1, 1:-1][outlet], np.full(int(outlet.sum()), outside_node, dtype=np.int64),
+                            z[1:-1, 1:-1][outlet])
+
+
+def lowest_crossings(low, high, weight):
+    """Keep the lowest crossing of every pair of basins
+    : low, high, weight - arrays of basin pairs, with low < high, and their crossing elevations
+    """
+    order = np.lexsort((weight, high, low))
+    low = low[order]
+    high = high[order]
+    weight = weight[order]
+    first = np.ones(len(low), dtype=bool)
+    first[1:] = (low[1:] != low[:-1]) | (high[1:] != high[:-1])
+
+    return low[first], high[first], weight[first]
+
+
+def flood_levels(low, high, weight, node_count, sources):
+    """Find the lowest level at which water in each node reaches one of the sources over the basin graph
+    The graph is flooded with array operations rather than a priority queue of nodes: at each step the crossings of
+    the lowest fifth of the nodes waiting to be expanded are relaxed at once, which keeps most nodes from being lowered
+    more than once, until no node is waiting.
+    Returns an array of the level of every node, -inf for the sources and inf for nodes that reach no source, and an
+    array of the source each node is reached from, -1 for nodes that reach no source.
+    : low, high, weight - lowest crossings from lowest_crossings
+    : node_count - number of nodes
+    : sources - nodes water leaves the graph through
+    """
+    node_from = np.concatenate([low, high])
+    node_to = np.concatenate([high, low])
+    node_weight = np.concatenate([weight, weight])
+    order = np.argsort(node_from, kind="stable")
+    indptr = np.concatenate([[0], np.cumsum(np.bincount(node_from, minlength=node_count))])
+    adjacent = node_to[order]
+    adjacent_weight = node_weight[order]
+    sources = np.asarray(sources, dtype=np.int64)
+    levels = np.full(node_count, np.inf)
+    levels[sources] = -np.inf
+    owners = np.full(node_count, -1, dtype=np.int64)
+    owners[sources] = sources
+    pending = sources
+    while len(pending) > 0:
+        pending_levels = levels[pending]
+        expanded = pending_levels <= np.partition(pending_levels, len(pending) // 5)[len(pending) // 5]
+        lowered = pending[expanded]
+        counts = indptr[lowered + 1] - indptr[lowered]
+        positions = np.repeat(indptr[lowered] - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+        from_nodes = np.repeat(lowered, counts)
+        neighbours = adjacent[positions]
+        neighbour_levels = np.maximum(levels[from_nodes], adjacent_weight[positions])
+        lower = neighbour_levels < levels[neighbours]
+        from_nodes, neighbours, neighbour_levels = from_nodes[lower], neighbours[lower], neighbour_levels[lower]
+        # keep the lowest level reaching each neighbour
+        order = np.lexsort((neighbour_levels, neighbours))
+        from_nodes, neighbours, neighbour_levels = from_nodes[order], neighbours[order], neighbour_levels[order]
+        first = np.ones(len(neighbours), dtype=bool)
+        first[1:] = neighbours[1:] != neighbours[:-1]
+        lowered = neighbours[first]
+        levels[lowered] = neighbour_levels[first]
+        owners[lowered] = owners[from_nodes[first]]
+        pending = np.union1d(pending[~expanded], lowered)
+
+    return levels, owners
+
+
+def spill_levels(low, high, weight, node_count, outside_node):
+    """Find the level at which each basin spills out of the DEM by flooding the basin graph from the outside node
+    Returns an array of the spill level of every node.
+    : low, high, weight - lowest crossings from lowest_crossings
+    : node_count - number of nodes, including the outside node
+    : outside_node - label of the node outside of the DEM
+    """
+    return flood_levels(low, high, weight, node_count, [outside_node])[0]
+
+
+def fill_depressions(dem):
+    """Fill the depressions of a DEM to the level at which they spill, like the Spatial Analyst Fill tool
+    Cells are grouped into the basins of their steepest descent pits, the spill level of every basin is found by
+    flooding the basin adjacency graph from outside the DEM, and each cell is raised to the spill level of its basin.
+    : dem - 2D elevation array with NaN for NoData
+    """
+    z = np.asarray(dem, dtype=np.float64)
+    valid = ~np.isnan(z)
+    labels, basin_count = descent_basins(z)
+    padded_z = np.pad(z, 1, constant_values=np.nan)
+    padded_labels = np.pad(labels, 1, constant_values=-1)
+    outside_node = basin_count
+    crossings = [np.concatenate(arrays) for arrays in
+                 zip(basin_crossings(padded_z, padded_labels),
+                     outlet_crossings(padded_z, padded_labels, outside_node))]
+    spill = spill_levels(*crossings, basin_count + 1, outside_node)
+    filled = z.copy()
+    filled[valid] = np.maximum(z[valid], spill[labels[valid]])
+
+    return filled
+
+
+def flow_direction(filled):
+    """Compute ESRI D8 flow direction codes of a filled DEM
+    Cells flow to their steepest downhill neighbour, edge cells without one flow out of the DEM, and cells on flats
+    flow along the shortest path over the flat to a cell that drains, like water spilling out of a filled depression.
+    Returns a uint8 array with 0 for NoData.
+    : filled - 2D elevation array with NaN for NoData, normally from fill_depressions
+    """
+    z = np.asarray(filled, dtype=np.float64)
+    direction = steepest_directions(z)
+    resolve_flats(z, direction, ~np.isnan(z) & (direction == 0))
+
+    return direction
+
+
+def steepest_directions(z):
+    """D8 codes of the steepest downhill neighbour of every cell, or out of the DEM for edge cells without one
+    Cells on flats are left at 0 for resolve_flats.
+    : z - 2D elevation array with NaN for NoData and beyond the DEM
+    """
+    steepest, outside = _steepest_descent(z)
+    direction = np.zeros(z.shape, dtype=np.uint8)
+    draining = steepest >= 0
+    direction[draining] = D8_CODES[steepest[draining]]
+    at_edge = ~draining & (outside >= 0)
+    direction[at_edge] = D8_CODES[outside[at_edge]]
+
+    return direction
+
+
+def resolve_flats(z, direction, unresolved):
+    """Route flats to the cells that drain them
+    Breadth first search from the cells with a direction into unresolved cells of the same elevation, so each
+    unresolved cell flows along the shortest path over its flat. The direction array is updated in place and the
+    number of cells resolved is returned.
+    : z - 2D elevation array
+    : direction - 2D array of D8 codes, 0 where there is no direction
+    : unresolved - 2D boolean array of the cells that may be given a direction
+    """
+    flat_direction = direction.reshape(-1)
+    flat_z = z.ravel()
+    unresolved = unresolved.ravel().copy()
+    frontier = np.flatnonzero(flat_direction)
+    resolved_count = 0
+    while frontier.size > 0 and np.any(unresolved):
+        new_cells = []
+        new_codes = []
+        for k in range(8):
+            neighbours = _neighbour_index(frontier, k, z.shape)
+            inside = neighbours >= 0
+            sources = frontier[inside]
+            neighbours = neighbours[inside]
+            selected = unresolved[neighbours] & (flat_z[neighbours] == flat_z[sources])
+            new_cells.append(neighbours[selected])
+            # the neighbour flows back to the frontier cell, the opposite direction of k
+            new_codes.append(np.full(int(selected.sum()), D8_CODES[(k + 4) % 8], dtype=np.uint8))
+        new_cells = np.concatenate(new_cells)
+        new_codes = np.concatenate(new_codes)
+        frontier, first = np.unique(new_cells, return_index=True)
+        flat_direction[frontier] = new_codes[first]
+        unresolved[frontier] = False
+        resolved_count += len(frontier)
+
+    return resolved_count
+
+
+def flow_receivers(direction):
+    """Find the cell each cell flows to
+    Returns a flat array of cell indices, -1 where the cell flows out of the DEM, into NoData, or has no direction.
+    : direction - 2D array of ESRI D8 codes
+    """
+    direction = np.asarray(direction)
+    codes = np.where((direction >= 0) & (direction < 256), direction, 0).astype(np.int64).ravel()
+    positions = D8_INDEX[codes]
+    cells = np.arange(direction.size)
+    receivers = np.full(direction.size, -1, dtype=np.int64)
+    for k in range(8):
+        selected = positions == k
+        receivers[selected] = _neighbour_index(cells[selected], k, direction.shape)
+    # cells flowing into NoData, which has no direction code, leave the DEM there
+    flows_in = receivers >= 0
+    receivers[flows_in] = np.where(codes[receivers[flows_in]] > 0, receivers[flows_in], -1)
+
+    return receivers
+
+
+def topological_levels(receivers, valid=None):
+    """Order cells from the ridges to the outlets
+    Each level only holds cells whose donors are all in earlier levels, so a level can be processed in one
+    vectorized step. Returns the cell order and the start of each level in it, with a final entry equal to the number
+    of cells.
+    : receivers - flat receiver array from flow_receivers
+    : valid - optional flat boolean array of the cells to order, defaults to every cell
+    """
+    receivers = np.asarray(receivers, dtype=np.int64)
+    has_receiver = receivers >= 0
+    donor_count = np.bincount(receivers[has_receiver], minlength=len(receivers))
+    if valid is None:
+        valid = np.ones(len(receivers), dtype=bool)
+    frontier = np.flatnonzero(np.asarray(valid) & (donor_count == 0))
+    levels = []
+    while frontier.size > 0:
+        levels.append(frontier)
+        downstream = receivers[frontier]
+        downstream, counts = np.unique(downstream[downstream >= 0], return_counts=True)
+        donor_count[downstream] -= counts
+        frontier = downstream[donor_count[downstream] == 0]
+    level_starts = np.concatenate([[0], np.cumsum([len(level) for level in levels])]).astype(np.int64)
+    order = np.concatenate(levels) if levels else np.empty(0, dtype=np.int64)
+
+    return order, level_starts
+
+
+def _levels(order, level_starts):
+    for start, end in zip(level_starts[:-1], level_starts[1:]):
+        yield order[start:end]
+
+
+def flow_accumulation(receivers, order, level_starts, weights=None):
+    """Accumulate the cells or weights upstream of every cell, excluding the cell itself
+    Returns a flat float array.
+    : receivers - flat receiver array from flow_receivers
+    : order, level_starts - topological levels from topological_levels
+    : weights - optional flat array of cell weights, defaults to 1
+    """
+    if weights is None:
+        weights = np.ones(len(receivers))
+    total = np.asarray(weights, dtype=np.float64).copy()
+    for cells in _levels(order, level_starts):
+        downstream = receivers[cells]
+        flows = downstream >= 0
+        np.add.at(total, downstream[flows], total[cells[flows]])
+
+    return total - weights
+
+
+def flow_step_lengths(direction, cell_size):
+    """Distance from each cell to the cell it flows to, cell_size or cell_size * sqrt(2)
+    : direction - array of ESRI D8 codes
+    : cell_size - cell size of the DEM in map units
+    """
+    positions = D8_INDEX[np.where((direction >= 0) & (direction < 256), direction, 0).astype(np.int64).ravel()]
+    return np.where(positions >= 0, D8_DISTANCES[np.maximum(positions, 0)] * cell_size, 0.0)
+
+
+def flow_length_upstream(receivers, order, level_starts, step_lengths, initial=None):
+    """Length of the longest flow path from the divide to each cell
+    : receivers - flat receiver array from flow_receivers
+    : order, level_starts - topological levels from topological_levels
+    : step_lengths - flat array from flow_step_lengths
+    : initial - optional flat array of lengths of flow paths that enter cells from beyond the array, defaults to 0
+    """
+    length = np.zeros(len(receivers)) if initial is None else np.asarray(initial, dtype=np.float64).copy()
+    for cells in _levels(order, level_starts):
+        downstream = receivers[cells]
+        flows = downstream >= 0
+        np.maximum.at(length, downstream[flows], length[cells[flows]] + step_lengths[cells[flows]])
+
+    return length
+
+
+def flow_length_downstream(receivers, order, level_starts, step_lengths):
+    """Length of the flow path from each cell to where it leaves the DEM
+    : receivers - flat receiver array from flow_receivers
+    : order, level_starts - topological levels from topological_levels
+    : step_lengths - flat array from flow_step_lengths
+    """
+    length = np.zeros(len(receivers))
+    for start, end in zip(level_starts[-2::-1], level_starts[:0:-1]):
+        cells = order[start:end]
+        downstream = receivers[cells]
+        flows = downstream >= 0
+        length[cells[flows]] = length[downstream[flows]] + step_lengths[cells[flows]]
+
+    return length
+
+
+def _horn_gradient(dem, cell_size):
+    # Horn's 3x3 gradient, where NoData neighbours and neighbours beyond the edge take the value of the center cell
+    z = np.asarray(dem, dtype=np.float64)
+    window = {}
+    for dr in (-1, 0, 1):
+        for dc in (-1, 0, 1):
+            neighbour = _shifted(z, dr, dc, np.nan)
+            window[(dr, dc)] = np.where(np.isnan(neighbour), z, neighbour)
+    dz_dx = ((window[(-1, 1)] + 2 * window[(0, 1)] + window[(1, 1)]) -
+             (window[(-1, -1)] + 2 * window[(0, -1)] + window[(1, -1)])) / (8 * cell_size)
+    dz_dy = ((window[(1, -1)] + 2 * window[(1, 0)] + window[(1, 1)]) -
+             (window[(-1, -1)] + 2 * window[(-1, 0)] + window[(-1, 1)])) / (8 * cell_size)
+
+    return dz_dx, dz_dy
+
+
+def slope(dem, cell_size):
+    """Slope in percent rise, like Slope with PERCENT_RISE
+    : dem - 2D elevation array with NaN for NoData
+    : cell_size - cell size of the DEM in the units of the elevations
+    """
+    dz_dx, dz_dy = _horn_gradient(dem, cell_size)
+    return np.sqrt(dz_dx ** 2 + dz_dy ** 2) * 100
+
+
+def aspect(dem, cell_size):
+    """Aspect in degrees clockwise from north, -1 for flat cells, like the Aspect tool
+    : dem - 2D elevation array with NaN for NoData
+    : cell_size - cell size of the DEM in map units
+    """
+    dz_dx, dz_dy = _horn_gradient(dem, cell_size)
+    angle = np.degrees(np.arctan2(dz_dy, -dz_dx))
+    result = np.where(angle < 0, 90 - angle, np.where(angle > 90, 450 - angle, 90 - angle))
+    result = np.where((dz_dx == 0) & (dz_dy == 0), -1.0, result)
+    result[np.isnan(np.asarray(dem, dtype=np.float64))] = np.nan
+
+    return result
+
+
+def derive_terrain(dem, cell_size, filled=None, direction=None, unfilled=None):
+    """Derive the AGWA workspace terrain rasters from one loaded DEM
+    Returns a dictionary of 2D arrays with the keys filled, direction, accumulation, flow_length_upstream,
+    flow_length_downstream, slope, and aspect.
+    : dem - 2D elevation array with NaN for NoData
+    : cell_size - cell size of the DEM in map units
+    : filled - optional filled DEM, filled from dem when not given
+    : direction - optional D8 flow direction codes, computed from the filled DEM when not given
+    : unfilled - optional unfilled DEM used for slope and aspect, the filled DEM is used when not given
+    """
+    dem = np.asarray(dem, dtype=np.float64)
+    if filled is None:
+        filled = fill_depressions(dem)
+    if direction is None:
+        direction = flow_direction(filled)
+    valid = ~np.isnan(filled).ravel()
+    receivers = flow_receivers(direction)
+    order, level_starts = topological_levels(receivers, valid)
+    step_lengths = flow_step_lengths(direction, cell_size)
+    surface = filled if unfilled is None else unfilled
+
+    results = {"filled": filled, "direction": direction}
+    for name, values in (("accumulation", flow_accumulation(receivers, order, level_starts)),
+                         ("flow_length_upstream", flow_length_upstream(receivers, order, level_starts, step_lengths)),
+                         ("flow_length_downstream",
+                          flow_length_downstream(receivers, order, level_starts, step_lengths))):
+        values = values.reshape(dem.shape)
+        values[np.isnan(filled)] = np.nan
+        results[name] = values
+    results["slope"] = slope(surface, cell_size)
+    results["aspect"] = aspect(surface, cell_size)
+
+    return results
+
+
+def synthetic_dem(rows, cols, seed=0, cell_size=10.0):
+    """Build a DEM of rolling hills draining to one side with small random depressions for testing and benchmarks
+    : rows, cols - size of the DEM
+    : seed - random seed
+    : cell_size - cell size in map units
+    """
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:rows, 0:cols] * cell_size
+    dem = 0.01 * y
+    for _ in range(8):
+        wavelength = rng.uniform(20, 200) * cell_size
+        phase = rng.uniform(0, 2 * np.pi, 2)
+        angle = rng.uniform(0, np.pi)
+        dem += rng.uniform(1, 5) * np.sin(2 * np.pi * (x * np.cos(angle) + y * np.sin(angle)) / wavelength + phase[0])
+    dem += rng.normal(0, 0.05, dem.shape)
+
+    return dem
+
+
+def benchmark(sizes=((250, 250), (500, 500), (1000, 1000)), seed=0, cell_size=10.0):
+    """Time each step of derive_terrain on synthetic DEMs
+    Returns a list of (rows, cols, dictionary of step name to seconds).
+    : sizes - sequence of (rows, cols) of the DEMs
+    : seed - random seed of the synthetic DEMs
+    : cell_size - cell size of the synthetic DEMs
+    """
+    results = []
+    for rows, cols in sizes:
+        dem = synthetic_dem(rows, cols, seed, cell_size)
+        timings = {}
+        start = time.perf_counter()
+        filled = fill_depressions(dem)
+        timings["fill"] = time.perf_counter() - start
+        start = time.perf_counter()
+        direction = flow_direction(filled)
+        timings["direction"] = time.perf_counter() - start
+        start = time.perf_counter()
+        receivers = flow_receivers(direction)
+        order, level_starts = topological_levels(receivers, ~np.isnan(filled).ravel())
+        timings["order"] = time.perf_counter() - start
+        start = time.perf_counter()
+        flow_accumulation(receivers, order, level_starts)
+        timings["accumulation"] = time.perf_counter() - start
+        start = time.perf_counter()
+        step_lengths = flow_step_lengths(direction, cell_size)
+        flow_length_upstream(receivers, order, level_starts, step_lengths)
+        flow_length_downstream(receivers, order, level_starts, step_lengths)
+        timings["flow_length"] = time.perf_counter() - start
+        start = time.perf_counter()
+        slope(dem, cell_size)
+        aspect(dem, cell_size)
+        timings["slope_aspect"] = time.perf_counter() - start
+        results.append((rows, cols, timings))
+
+    return results
+
+
+if __name__ == '__main__':
+    for benchmark_rows, benchmark_cols, benchmark_timings in benchmark():
+        print("{0} x {1}: {2}, total {3:.2f} s".format(
+            benchmark_rows, benchmark_cols,
+            ", ".join("{0} {1:.2f} s".format(step, seconds) for step, seconds in benchmark_timings.items()),
+            sum(benchmark_timings.values())))
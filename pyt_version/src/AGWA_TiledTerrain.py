@@ -0,0 +1,375 @@
+# -------------------------------------------------------------------------------
+# Name:        AGWA_TiledTerrain.py
+# Purpose:     Out-of-core tiled terrain processing of DEMs stored as memory-mapped .npy files
+# -------------------------------------------------------------------------------
+# The DEM and every output are memory-mapped arrays, and each step reads one tile with a one cell halo at a time, so
+# peak memory is bounded by the tile size rather than the DEM size. Work that crosses tile boundaries is resolved on
+# small global graphs:
+#   - fill: the pit basins of every tile are labelled and flooded inside the tile from its outlets and from the basins
+#     on its edges, only the edge basins are solved on one graph of all tiles, and each tile is then raised to the
+#     higher of its own levels and the spill levels of the edge basins it drains to;
+#   - flats: tiles are revisited until the flats that span tiles are routed from the directions found so far;
+#   - accumulation and upstream flow length: the cells where flow leaves each tile are linked to the cells where it
+#     enters the next tile, the totals of that exit graph are solved in topological order, and each tile is then
+#     accumulated again with the inflows it receives.
+# Like AGWA_TerrainEngine this module does not import arcpy.
+import os
+import numpy as np
+import AGWA_TerrainEngine
+import importlib
+importlib.reload(AGWA_TerrainEngine)
+
+DEFAULT_TILE_SIZE = 2048
+
+
+def tiles(shape, tile_size):
+    """Split an array shape into tiles
+    Returns a list of (first row, end row, first column, end column).
+    : shape - rows and columns of the DEM
+    : tile_size - number of rows and columns of a tile
+    """
+    rows, cols = shape
+    return [(r0, min(r0 + tile_size, rows), c0, min(c0 + tile_size, cols))
+            for r0 in range(0, rows, tile_size) for c0 in range(0, cols, tile_size)]
+
+
+def read_window(array, tile, halo, fill_value, dtype=np.float64):
+    """Read a tile and a halo of cells around it, with fill_value beyond the array
+    : array - 2D array or memmap
+    : tile - (first row, end row, first column, end column) from tiles
+    : halo - number of cells read around the tile
+    : fill_value - value of the cells beyond the array
+    : dtype - type of the returned window
+    """
+    r0, r1, c0, c1 = tile
+    rows, cols = array.shape
+    window = np.full((r1 - r0 + 2 * halo, c1 - c0 + 2 * halo), fill_value, dtype=dtype)
+    wr0, wr1 = max(r0 - halo, 0), min(r1 + halo, rows)
+    wc0, wc1 = max(c0 - halo, 0), min(c1 + halo, cols)
+    window[wr0 - r0 + halo:wr1 - r0 + halo, wc0 - c0 + halo:wc1 - c0 + halo] = array[wr0:wr1, wc0:wc1]
+
+    return window
+
+
+def create_array(path, shape, dtype):
+    """Create a memory-mapped .npy file
+    : path - output .npy file
+    : shape - shape of the array
+    : dtype - type of the array
+    """
+    return np.lib.format.open_memmap(path, mode="w+", dtype=dtype, shape=shape)
+
+
+def _window_to_global(cells, tile, window_cols, cols):
+    # flat index in the DEM of flat indices in a window with a one cell halo
+    r0, c0 = tile[0], tile[2]
+    return (cells // window_cols + r0 - 1) * cols + cells % window_cols + c0 - 1
+
+
+def _flood_tile(dem, labels, tile, first_label, basin_count, outside_node):
+    """Flood the basins of a tile from its outlets and from the basins on the edges it shares with other tiles
+    Every basin gets the level at which it reaches one of these sources inside the tile and the source it reaches.
+    Where basins reached from different sources meet, the sources are linked at the level of the meeting, so the
+    links and the crossings of the edge basins into the next tiles form the graph that is solved for all tiles.
+    Returns the level and the source of every basin, with the outside node as the source of the outlets, the labels of
+    the edge basins, and the lowest crossings of the sources.
+    : dem, labels - 2D arrays or memmaps of the elevations and the basin labels of every tile
+    : tile - (first row, end row, first column, end column) from tiles
+    : first_label, basin_count - label of the first basin of the tile and number of basins in the tile
+    : outside_node - label of the node outside of the DEM
+    """
+    r0, r1, c0, c1 = tile
+    rows, cols = dem.shape
+    z = read_window(dem, tile, 1, np.nan)
+    window_labels = read_window(labels, tile, 1, -1, np.int64)
+    in_tile = (window_labels >= first_label) & (window_labels < first_label + basin_count)
+    tile_labels = np.where(in_tile, window_labels - first_label, -1)
+
+    low, high, weight = AGWA_TerrainEngine.basin_crossings(z, window_labels)
+    between_tiles = (low < first_label) | (high >= first_label + basin_count)
+    crossings = [np.concatenate(arrays) for arrays in
+                 zip((low[~between_tiles] - first_label, high[~between_tiles] - first_label, weight[~between_tiles]),
+                     AGWA_TerrainEngine.outlet_crossings(z, tile_labels, basin_count))]
+
+    edge = np.zeros((r1 - r0, c1 - c0), dtype=bool)
+    edge[0] |= r0 > 0
+    edge[-1] |= r1 < rows
+    edge[:, 0] |= c0 > 0
+    edge[:, -1] |= c1 < cols
+    core_labels = tile_labels[1:-1, 1:-1]
+    edge_basins = np.unique(core_labels[edge & (core_labels >= 0)])
+    levels, owners = AGWA_TerrainEngine.flood_levels(*crossings, basin_count + 1,
+                                                     np.append(edge_basins, basin_count))
+    owners = np.where((owners >= 0) & (owners < basin_count), owners + first_label, outside_node)
+
+    tile_low, tile_high, tile_weight = crossings
+    linked = owners[tile_low] != owners[tile_high]
+    low_owners = owners[tile_low][linked]
+    high_owners = owners[tile_high][linked]
+    link_weight = np.maximum(tile_weight[linked], np.maximum(levels[tile_low][linked], levels[tile_high][linked]))
+    source_crossings = AGWA_TerrainEngine.lowest_crossings(
+        np.concatenate([np.minimum(low_owners, high_owners), low[between_tiles]]),
+        np.concatenate([np.maximum(low_owners, high_owners), high[between_tiles]]),
+        np.concatenate([link_weight, weight[between_tiles]]))
+
+    return levels[:-1], owners[:-1], edge_basins + first_label, source_crossings
+
+
+def fill_depressions_tiled(dem, filled, labels_path, tile_size=DEFAULT_TILE_SIZE):
+    """Fill the depressions of a DEM tile by tile
+    : dem - 2D array or memmap of elevations with NaN for NoData
+    : filled - output 2D array or memmap
+    : labels_path - temporary .npy file for the basin label of every cell, deleted when done
+    : tile_size - number of rows and columns of a tile
+    """
+    tile_list = tiles(dem.shape, tile_size)
+    labels = create_array(labels_path, dem.shape, np.int64)
+    first_labels = []
+    basin_counts = []
+    for r0, r1, c0, c1 in tile_list:
+        tile_labels, tile_basin_count = AGWA_TerrainEngine.descent_basins(np.asarray(dem[r0:r1, c0:c1],
+                                                                                     dtype=np.float64))
+        first_labels.append(sum(basin_counts))
+        basin_counts.append(tile_basin_count)
+        labels[r0:r1, c0:c1] = np.where(tile_labels >= 0, tile_labels + first_labels[-1], -1)
+
+    # only the basins on the edges between tiles and the outside node are nodes of the graph of all tiles
+    outside_node = sum(basin_counts)
+    edge_basins = [[outside_node]]
+    crossings = []
+    for tile, first_label, basin_count in zip(tile_list, first_labels, basin_counts):
+        tile_edge_basins, tile_crossings = _flood_tile(dem, labels, tile, first_label, basin_count, outside_node)[2:]
+        edge_basins.append(tile_edge_basins)
+        crossings.append(tile_crossings)
+    nodes = np.unique(np.concatenate(edge_basins))
+    low, high, weight = AGWA_TerrainEngine.lowest_crossings(*[np.concatenate(arrays) for arrays in zip(*crossings)])
+    spill = AGWA_TerrainEngine.spill_levels(np.searchsorted(nodes, low), np.searchsorted(nodes, high), weight,
+                                            len(nodes), np.searchsorted(nodes, outside_node))
+
+    # each basin is raised to its level in the tile or to the spill level of the source it reaches, if higher
+    for tile, first_label, basin_count in zip(tile_list, first_labels, basin_counts):
+        r0, r1, c0, c1 = tile
+        levels, owners = _flood_tile(dem, labels, tile, first_label, basin_count, outside_node)[:2]
+        levels = np.maximum(levels, spill[np.searchsorted(nodes, owners)])
+        z = np.asarray(dem[r0:r1, c0:c1], dtype=np.float64)
+        tile_labels = np.asarray(labels[r0:r1, c0:c1]) - first_label
+        valid = tile_labels >= 0
+        z[valid] = np.maximum(z[valid], levels[tile_labels[valid]])
+        filled[r0:r1, c0:c1] = z
+
+    del labels
+    os.remove(labels_path)
+
+
+def flow_direction_tiled(filled, direction, tile_size=DEFAULT_TILE_SIZE):
+    """Compute D8 flow directions of a filled DEM tile by tile
+    : filled - 2D array or memmap of filled elevations with NaN for NoData
+    : direction - output 2D uint8 array or memmap
+    : tile_size - number of rows and columns of a tile
+    """
+    tile_list = tiles(filled.shape, tile_size)
+    pending = []
+    for tile in tile_list:
+        r0, r1, c0, c1 = tile
+        tile_direction = AGWA_TerrainEngine.steepest_directions(read_window(filled, tile, 1, np.nan))[1:-1, 1:-1]
+        direction[r0:r1, c0:c1] = tile_direction
+        if np.any((tile_direction == 0) & ~np.isnan(np.asarray(filled[r0:r1, c0:c1], dtype=np.float64))):
+            pending.append(tile)
+
+    # flats that span tiles are routed over several passes, each starting from the directions found so far
+    while pending:
+        still_pending = []
+        resolved_count = 0
+        for tile in pending:
+            r0, r1, c0, c1 = tile
+            z = read_window(filled, tile, 1, np.nan)
+            tile_direction = read_window(direction, tile, 1, 0, np.uint8)
+            unresolved = np.zeros(z.shape, dtype=bool)
+            unresolved[1:-1, 1:-1] = ~np.isnan(z[1:-1, 1:-1]) & (tile_direction[1:-1, 1:-1] == 0)
+            tile_resolved_count = AGWA_TerrainEngine.resolve_flats(z, tile_direction, unresolved)
+            if tile_resolved_count > 0:
+                direction[r0:r1, c0:c1] = tile_direction[1:-1, 1:-1]
+                resolved_count += tile_resolved_count
+            if tile_resolved_count < unresolved.sum():
+                still_pending.append(tile)
+        if resolved_count == 0:
+            break
+        pending = still_pending
+
+
+def _route_tile(direction, tile, cell_size):
+    # route the core of a tile with a one cell halo, stopping the flow paths at the edge of the core
+    tile_direction = read_window(direction, tile, 1, 0, np.uint8)
+    receivers = AGWA_TerrainEngine.flow_receivers(tile_direction)
+    core = np.zeros(tile_direction.shape, dtype=bool)
+    core[1:-1, 1:-1] = True
+    core = core.ravel()
+    valid_core = core & (tile_direction.ravel() > 0)
+    inside = receivers >= 0
+    inside[inside] = core[receivers[inside]]
+    local_receivers = np.where(valid_core & inside, receivers, -1)
+    order, level_starts = AGWA_TerrainEngine.topological_levels(local_receivers, valid_core)
+    step_lengths = AGWA_TerrainEngine.flow_step_lengths(tile_direction, cell_size)
+
+    return tile_direction, receivers, local_receivers, core, valid_core, order, level_starts, step_lengths
+
+
+def flow_accumulation_tiled(direction, accumulation, cell_size, flow_length_upstream=None,
+                            tile_size=DEFAULT_TILE_SIZE):
+    """Accumulate flow and, optionally, the upstream flow length tile by tile
+    : direction - 2D array or memmap of D8 codes with 0 for NoData
+    : accumulation - output 2D float array or memmap of upstream cell counts
+    : cell_size - cell size of the DEM in map units
+    : flow_length_upstream - optional output 2D float array or memmap of upstream flow lengths
+    : tile_size - number of rows and columns of a tile
+    """
+    cols = direction.shape[1]
+    tile_list = tiles(direction.shape, tile_size)
+
+    # first pass: route each tile alone and record where flow leaves and enters it
+    exit_cells, exit_totals, exit_lengths, exit_receivers, exit_steps = [], [], [], [], []
+    entry_cells, entry_exits, entry_distances = [], [], []
+    for tile in tile_list:
+        tile_direction, receivers, local_receivers, core, valid_core, order, level_starts, step_lengths = \
+            _route_tile(direction, tile, cell_size)
+        window_cols = tile_direction.shape[1]
+        weights = valid_core.astype(np.float64)
+        totals = AGWA_TerrainEngine.flow_accumulation(local_receivers, order, level_starts, weights) + weights
+        lengths = AGWA_TerrainEngine.flow_length_upstream(local_receivers, order, level_starts, step_lengths)
+        distances = AGWA_TerrainEngine.flow_length_downstream(local_receivers, order, level_starts, step_lengths)
+        cells = np.arange(len(local_receivers))
+        exits = AGWA_TerrainEngine.find_roots(np.where(local_receivers >= 0, local_receivers, cells))
+
+        tile_exits = np.flatnonzero(valid_core & (local_receivers < 0))
+        exit_cells.append(_window_to_global(tile_exits, tile, window_cols, cols))
+        exit_totals.append(totals[tile_exits])
+        exit_lengths.append(lengths[tile_exits])
+        tile_receivers = receivers[tile_exits]
+        exit_receivers.append(np.where(tile_receivers >= 0,
+                                       _window_to_global(tile_receivers, tile, window_cols, cols), -1))
+        exit_steps.append(step_lengths[tile_exits])
+
+        halo_receivers = receivers[~core & (receivers >= 0)]
+        tile_entries = np.unique(halo_receivers[valid_core[halo_receivers]])
+        entry_cells.append(_window_to_global(tile_entries, tile, window_cols, cols))
+        entry_exits.append(_window_to_global(exits[tile_entries], tile, window_cols, cols))
+        entry_distances.append(distances[tile_entries])
+
+    exit_cells = np.concatenate(exit_cells)
+    exit_totals = np.concatenate(exit_totals)
+    exit_lengths = np.concatenate(exit_lengths)
+    exit_receivers = np.concatenate(exit_receivers)
+    exit_steps = np.concatenate(exit_steps)
+    entry_cells = np.concatenate(entry_cells)
+    entry_exits = np.concatenate(entry_exits)
+    entry_distances = np.concatenate(entry_distances)
+    exit_order = np.argsort(exit_cells)
+    entry_order = np.argsort(entry_cells)
+    exit_cells, exit_totals, exit_lengths, exit_receivers, exit_steps = [
+        values[exit_order] for values in (exit_cells, exit_totals, exit_lengths, exit_receivers, exit_steps)]
+    entry_cells, entry_exits, entry_distances = [
+        values[entry_order] for values in (entry_cells, entry_exits, entry_distances)]
+
+    # solve the graph of exits, where each exit flows through the entry of the next tile to the exit of that entry
+    flows_on = exit_receivers >= 0
+    exit_entries = np.full(len(exit_cells), -1, dtype=np.int64)
+    exit_entries[flows_on] = np.searchsorted(entry_cells, exit_receivers[flows_on])
+    exit_downstream = np.full(len(exit_cells), -1, dtype=np.int64)
+    exit_downstream[flows_on] = np.searchsorted(exit_cells, entry_exits[exit_entries[flows_on]])
+    exit_step_lengths = exit_steps.copy()
+    exit_step_lengths[flows_on] += entry_distances[exit_entries[flows_on]]
+    order, level_starts = AGWA_TerrainEngine.topological_levels(exit_downstream)
+    final_totals = AGWA_TerrainEngine.flow_accumulation(exit_downstream, order, level_starts, exit_totals) + \
+        exit_totals
+    final_lengths = AGWA_TerrainEngine.flow_length_upstream(exit_downstream, order, level_starts, exit_step_lengths,
+                                                            exit_lengths)
+    entry_inflows = np.zeros(len(entry_cells))
+    np.add.at(entry_inflows, exit_entries[flows_on], final_totals[flows_on])
+    entry_lengths = np.zeros(len(entry_cells))
+    np.maximum.at(entry_lengths, exit_entries[flows_on], final_lengths[flows_on] + exit_steps[flows_on])
+
+    # second pass: accumulate each tile again with the flow entering it from the other tiles
+    entry_rows = entry_cells // cols
+    entry_cols = entry_cells % cols
+    for tile in tile_list:
+        r0, r1, c0, c1 = tile
+        tile_direction, receivers, local_receivers, core, valid_core, order, level_starts, step_lengths = \
+            _route_tile(direction, tile, cell_size)
+        window_cols = tile_direction.shape[1]
+        in_tile = (entry_rows >= r0) & (entry_rows < r1) & (entry_cols >= c0) & (entry_cols < c1)
+        tile_entries = (entry_rows[in_tile] - r0 + 1) * window_cols + entry_cols[in_tile] - c0 + 1
+        weights = valid_core.astype(np.float64)
+        weights[tile_entries] += entry_inflows[in_tile]
+        totals = AGWA_TerrainEngine.flow_accumulation(local_receivers, order, level_starts, weights) + weights
+        tile_accumulation = np.where(valid_core, totals - 1, np.nan).reshape(tile_direction.shape)
+        accumulation[r0:r1, c0:c1] = tile_accumulation[1:-1, 1:-1]
+        if flow_length_upstream is not None:
+            initial = np.zeros(len(local_receivers))
+            initial[tile_entries] = entry_lengths[in_tile]
+            lengths = AGWA_TerrainEngine.flow_length_upstream(local_receivers, order, level_starts, step_lengths,
+                                                              initial)
+            tile_lengths = np.where(valid_core, lengths, np.nan).reshape(tile_direction.shape)
+            flow_length_upstream[r0:r1, c0:c1] = tile_lengths[1:-1, 1:-1]
+
+
+def slope_aspect_tiled(dem, cell_size, slope, aspect, tile_size=DEFAULT_TILE_SIZE):
+    """Compute slope and aspect tile by tile
+    : dem - 2D array or memmap of elevations with NaN for NoData
+    : cell_size - cell size of the DEM in map units
+    : slope, aspect - output 2D float arrays or memmaps
+    : tile_size - number of rows and columns of a tile
+    """
+    for tile in tiles(dem.shape, tile_size):
+        r0, r1, c0, c1 = tile
+        z = read_window(dem, tile, 1, np.nan)
+        slope[r0:r1, c0:c1] = AGWA_TerrainEngine.slope(z, cell_size)[1:-1, 1:-1]
+        aspect[r0:r1, c0:c1] = AGWA_TerrainEngine.aspect(z, cell_size)[1:-1, 1:-1]
+
+
+def derive_terrain_tiled(dem, cell_size, output_folder, tile_size=DEFAULT_TILE_SIZE, filled=None, direction=None,
+                         unfilled=None):
+    """Derive the AGWA workspace terrain rasters of a DEM tile by tile into memory-mapped .npy files
+    Returns a dictionary of the keys filled, direction, accumulation, flow_length_upstream, slope, and aspect to the
+    .npy file of each output. Supplied inputs are returned as given instead of a file.
+    : dem - 2D array or memmap of elevations with NaN for NoData
+    : cell_size - cell size of the DEM in map units
+    : output_folder - folder of the .npy files
+    : tile_size - number of rows and columns of a tile
+    : filled - optional filled DEM, filled from dem when not given
+    : direction - optional D8 flow direction codes with 0 for NoData, computed from the filled DEM when not given
+    : unfilled - optional unfilled DEM used for slope and aspect, the filled DEM is used when not given
+    """
+    outputs = {}
+    float_type = dem.dtype if np.issubdtype(dem.dtype, np.floating) else np.float64
+    if filled is None:
+        outputs["filled"] = os.path.join(output_folder, "filled.npy")
+        filled = create_array(outputs["filled"], dem.shape, float_type)
+        fill_depressions_tiled(dem, filled, os.path.join(output_folder, "basin_labels.npy"), tile_size)
+        filled.flush()
+    else:
+        outputs["filled"] = filled
+    if direction is None:
+        outputs["direction"] = os.path.join(output_folder, "direction.npy")
+        direction = create_array(outputs["direction"], dem.shape, np.uint8)
+        flow_direction_tiled(filled, direction, tile_size)
+        direction.flush()
+    else:
+        outputs["direction"] = direction
+
+    outputs["accumulation"] = os.path.join(output_folder, "accumulation.npy")
+    outputs["flow_length_upstream"] = os.path.join(output_folder, "flow_length_upstream.npy")
+    accumulation = create_array(outputs["accumulation"], dem.shape, np.float32)
+    flow_length_upstream = create_array(outputs["flow_length_upstream"], dem.shape, np.float32)
+    flow_accumulation_tiled(direction, accumulation, cell_size, flow_length_upstream, tile_size)
+    accumulation.flush()
+    flow_length_upstream.flush()
+
+    outputs["slope"] = os.path.join(output_folder, "slope.npy")
+    outputs["aspect"] = os.path.join(output_folder, "aspect.npy")
+    slope = create_array(outputs["slope"], dem.shape, np.float32)
+    aspect = create_array(outputs["aspect"], dem.shape, np.float32)
+    slope_aspect_tiled(filled if unfilled is None else unfilled, cell_size, slope, aspect, tile_size)
+    slope.flush()
+    aspect.flush()
+
+    return outputs
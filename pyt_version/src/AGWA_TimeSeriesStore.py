@@ -0,0 +1,340 @@
+# -------------------------------------------------------------------------------
+# Name:        AGWA_TimeSeriesStore.py
+# Purpose:     Columnar store of the K2 element .sim time series of a simulation
+# -------------------------------------------------------------------------------
+# The store is a single file per simulation:
+#   magic (8 bytes) | header offset (uint64) | header length (uint64) | compressed chunks | JSON header
+# The rows of every element are stored contiguously, sorted by element id, and each column is split into chunks of
+# chunk_rows rows that are byte-shuffled and zlib compressed. The header holds the element offset index and the byte
+# range of every chunk, so reading one element decompresses only the chunks that hold its rows. The chunks are
+# written as soon as they are full and the header is written last, so writing holds one chunk per column and the
+# elements being parsed in memory rather than the whole simulation.
+# This module does not import arcpy so it can be used by worker processes and outside of ArcGIS.
+import glob
+import json
+import multiprocessing
+import os
+import re
+import sys
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+MAGIC = b"AGWATS02"
+MAGIC_VERSION_1 = b"AGWATS01"
+DTYPE = np.dtype("<f8")
+DEFAULT_CHUNK_ROWS = 65536
+SIM_FILE_PATTERNS = (("planes", r"plane_(\d+)\.sim$"), ("channels", r"chan_(\d+)\.sim$"))
+
+
+def find_sim_files(simulation_directory):
+    """Find the element time series files written by K2 in a simulation directory
+    Returns a dictionary of element id to .sim file path.
+    : simulation_directory - directory with the planes and channels folders set in the parameter file
+    """
+    sim_files = {}
+    for folder, pattern in SIM_FILE_PATTERNS:
+        for sim_file in glob.glob(os.path.join(simulation_directory, folder, "*.sim")):
+            match = re.search(pattern, os.path.basename(sim_file), re.IGNORECASE)
+            if match:
+                sim_files[int(match.group(1))] = sim_file
+
+    return sim_files
+
+
+def parse_sim_file(sim_file):
+    """Read the numeric table of a K2 .sim file
+    Rows with the same number of numeric fields as the first data row are kept. Column names are taken from the
+    last text line before the data when it has one name per column.
+    Returns the column names and a 2D float array.
+    : sim_file - path of the .sim file
+    """
+    names = None
+    header = None
+    rows = []
+    width = None
+    with open(sim_file, "r") as f:
+        for line in f:
+            tokens = line.split()
+            if not tokens:
+                continue
+            try:
+                values = [float(token) for token in tokens]
+            except ValueError:
+                if width is None:
+                    header = tokens
+                continue
+            if width is None:
+                width = len(values)
+                if header is not None and len(header) == width:
+                    names = header
+            if len(values) == width:
+                rows.append(values)
+
+    if width is None:
+        return [], np.empty((0, 0), dtype=DTYPE)
+    if names is None:
+        names = ["Column{}".format(i + 1) for i in range(width)]
+
+    return names, np.array(rows, dtype=DTYPE)
+
+
+def _parse_element(item):
+    element_id, sim_file = item
+    names, values = parse_sim_file(sim_file)
+    return element_id, names, values
+
+
+def _process_context():
+    # inside ArcGIS Pro sys.executable is ArcGISPro.exe, so workers are started with the environment's python
+    context = multiprocessing.get_context("spawn")
+    if os.name == "nt" and not os.path.basename(sys.executable).lower().startswith("python"):
+        context.set_executable(os.path.join(sys.exec_prefix, "pythonw.exe"))
+    return context
+
+
+def iterate_sim_files(sim_files, max_workers=None, batch_size=None):
+    """Parse many .sim files in parallel, yielding the elements in element id order
+    Files are parsed a batch at a time, so only the parsed arrays of one batch are held in memory.
+    Yields (element id, column names, values).
+    : sim_files - dictionary of element id to .sim file path
+    : max_workers - number of worker processes, defaults to the number of processors
+    : batch_size - number of files parsed per batch, defaults to 8 per worker
+    """
+    items = sorted(sim_files.items())
+    if not max_workers:
+        max_workers = os.cpu_count() or 1
+    max_workers = max(1, min(max_workers, len(items)))
+    if not batch_size:
+        batch_size = max_workers * 8
+
+    if max_workers == 1:
+        for item in items:
+            yield _parse_element(item)
+        return
+
+    with ProcessPoolExecutor(max_workers=max_workers, mp_context=_process_context()) as executor:
+        for start in range(0, len(items), batch_size):
+            batch = items[start:start + batch_size]
+            chunk_size = max(1, len(batch) // (max_workers * 2))
+            for parsed in executor.map(_parse_element, batch, chunksize=chunk_size):
+                yield parsed
+
+
+def parse_sim_files(sim_files, max_workers=None):
+    """Parse many .sim files in parallel
+    Returns a dictionary of element id to (column names, values).
+    : sim_files - dictionary of element id to .sim file path
+    : max_workers - number of worker processes, defaults to the number of processors
+    """
+    return {element_id: (names, values) for element_id, names, values in iterate_sim_files(sim_files, max_workers)}
+
+
+def _compress(values):
+    # byte shuffle so the exponent bytes of neighbouring values compress together
+    shuffled = np.ascontiguousarray(values.view(np.uint8).reshape(-1, values.itemsize).T)
+    return zlib.compress(shuffled.tobytes(), 6)
+
+
+def _decompress(data, row_count):
+    shuffled = np.frombuffer(zlib.decompress(data), dtype=np.uint8).reshape(DTYPE.itemsize, row_count)
+    return np.ascontiguousarray(shuffled.T).view(DTYPE).ravel()
+
+
+class _ColumnChunks(object):
+    # the rows of the current chunk of every column, compressed and written to the store file as each chunk fills.
+    # A column first seen after some chunks were written holds NaN in them, which compresses to a few bytes.
+    def __init__(self, store_file, chunk_rows):
+        self.store_file = store_file
+        self.chunk_rows = chunk_rows
+        self.columns = []
+        self.buffers = {}
+        self.chunks = {}
+        self.chunk_index = 0
+        self.filled = 0
+        self.data_length = 0
+
+    def _write(self, column, values):
+        blob = _compress(values)
+        self.store_file.write(blob)
+        self.chunks[column].append([self.data_length, len(blob)])
+        self.data_length += len(blob)
+
+    def _add_column(self, column):
+        self.columns.append(column)
+        self.chunks[column] = []
+        empty = np.full(self.chunk_rows, np.nan, dtype=DTYPE)
+        for _ in range(self.chunk_index):
+            self._write(column, empty)
+        self.buffers[column] = empty.copy()
+
+    def _flush(self, row_count):
+        for column in self.columns:
+            self._write(column, self.buffers[column][:row_count])
+            self.buffers[column][:] = np.nan
+        self.chunk_index += 1
+        self.filled = 0
+
+    def append(self, names, values):
+        for name in names:
+            if name not in self.buffers:
+                self._add_column(name)
+        start = 0
+        while start < len(values):
+            count = min(self.chunk_rows - self.filled, len(values) - start)
+            for position, name in enumerate(names):
+                self.buffers[name][self.filled:self.filled + count] = values[start:start + count, position]
+            self.filled += count
+            start += count
+            if self.filled == self.chunk_rows:
+                self._flush(self.chunk_rows)
+
+    def close(self):
+        if self.filled > 0:
+            self._flush(self.filled)
+
+
+def write_store(store_path, series, chunk_rows=DEFAULT_CHUNK_ROWS):
+    """Write element time series to a store file, one element at a time
+    Columns are the union of the columns of every element; elements without a column hold NaN in it.
+    : store_path - output store file
+    : series - iterable of (element id, column names, 2D values) in element id order from iterate_sim_files, or a
+               dictionary of element id to (column names, 2D values) from parse_sim_files
+    : chunk_rows - number of rows per compressed chunk
+    """
+    if isinstance(series, dict):
+        series = [(element_id, names, values) for element_id, (names, values) in sorted(series.items())]
+
+    element_ids = []
+    counts = []
+    temporary_path = store_path + ".tmp"
+    with open(temporary_path, "wb") as f:
+        f.write(MAGIC)
+        # the header offset and length are written once the chunks are written
+        f.write(np.zeros(2, dtype=np.uint64).tobytes())
+        column_chunks = _ColumnChunks(f, chunk_rows)
+        for element_id, names, values in series:
+            if element_ids and element_id <= element_ids[-1]:
+                raise Exception("Cannot proceed. \nThe time series of element {} are not in element id order.".format(
+                    element_id))
+            element_ids.append(element_id)
+            counts.append(len(values))
+            column_chunks.append(names, values)
+            # release the parsed arrays of the element once they are in the chunks
+            del values
+        column_chunks.close()
+
+        counts = np.array(counts, dtype=np.int64)
+        offsets = np.concatenate([[0], np.cumsum(counts)[:-1]]).astype(np.int64) if len(counts) else counts
+        header = {"version": 2, "dtype": DTYPE.str, "chunk_rows": chunk_rows, "row_count": int(counts.sum()),
+                  "columns": column_chunks.columns, "element_ids": element_ids, "offsets": offsets.tolist(),
+                  "counts": counts.tolist(), "chunks": column_chunks.chunks}
+        header_bytes = json.dumps(header).encode("utf-8")
+        header_offset = f.tell()
+        f.write(header_bytes)
+        f.seek(len(MAGIC))
+        f.write(np.array([header_offset, len(header_bytes)], dtype=np.uint64).tobytes())
+    os.replace(temporary_path, store_path)
+
+
+def build_store(simulation_directory, store_path, max_workers=None, chunk_rows=DEFAULT_CHUNK_ROWS):
+    """Parse every element .sim file of a simulation in parallel and write them to a store file
+    Returns the number of elements written.
+    : simulation_directory - K2 simulation directory
+    : store_path - output store file
+    : max_workers - number of worker processes, defaults to the number of processors
+    : chunk_rows - number of rows per compressed chunk
+    """
+    sim_files = find_sim_files(simulation_directory)
+    write_store(store_path, iterate_sim_files(sim_files, max_workers), chunk_rows)
+
+    return len(sim_files)
+
+
+class TimeSeriesStore(object):
+    """Memory-mapped reader of a store file
+    : store_path - store file written by write_store
+    : cache_size - number of decompressed chunks kept in memory
+    """
+    def __init__(self, store_path, cache_size=16):
+        self.store_path = store_path
+        self.cache_size = cache_size
+        self._cache = {}
+        self._mmap = np.memmap(store_path, dtype=np.uint8, mode="r")
+        magic = self._mmap[:len(MAGIC)].tobytes()
+        if magic == MAGIC:
+            header_start, header_length = (int(value) for value in
+                                           self._mmap[len(MAGIC):len(MAGIC) + 16].view(np.uint64))
+            self._data_start = len(MAGIC) + 16
+        elif magic == MAGIC_VERSION_1:
+            # stores written before the header moved after the chunks
+            header_length = int(self._mmap[len(MAGIC):len(MAGIC) + 8].view(np.uint64)[0])
+            header_start = len(MAGIC) + 8
+            self._data_start = header_start + header_length
+        else:
+            raise Exception("'{}' is not an AGWA time series store.".format(store_path))
+        self._header = json.loads(self._mmap[header_start:header_start + header_length].tobytes().decode("utf-8"))
+        self._index = {element_id: (offset, count) for element_id, offset, count in
+                       zip(self._header["element_ids"], self._header["offsets"], self._header["counts"])}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @property
+    def columns(self):
+        return list(self._header["columns"])
+
+    @property
+    def element_ids(self):
+        return list(self._header["element_ids"])
+
+    def _chunk(self, column, chunk_index):
+        key = (column, chunk_index)
+        values = self._cache.get(key)
+        if values is None:
+            byte_offset, byte_length = self._header["chunks"][column][chunk_index]
+            start = self._data_start + byte_offset
+            chunk_rows = self._header["chunk_rows"]
+            row_count = min(chunk_rows, self._header["row_count"] - chunk_index * chunk_rows)
+            values = _decompress(self._mmap[start:start + byte_length].tobytes(), row_count)
+            if len(self._cache) >= self.cache_size:
+                self._cache.pop(next(iter(self._cache)))
+            self._cache[key] = values
+
+        return values
+
+    def read(self, element_id, columns=None):
+        """Read the time series of one element
+        Returns a dictionary of column name to array.
+        : element_id - K2 element id
+        : columns - optional list of columns to read, defaults to every column
+        """
+        if element_id not in self._index:
+            raise KeyError("Element {} is not in the time series store '{}'.".format(element_id, self.store_path))
+        if columns is None:
+            columns = self._header["columns"]
+        offset, count = self._index[element_id]
+        chunk_rows = self._header["chunk_rows"]
+
+        result = {}
+        for column in columns:
+            if column not in self._header["chunks"]:
+                raise KeyError("Column '{}' is not in the time series store '{}'.".format(column, self.store_path))
+            if count == 0:
+                result[column] = np.empty(0, dtype=DTYPE)
+                continue
+            first_chunk = offset // chunk_rows
+            last_chunk = (offset + count - 1) // chunk_rows
+            values = np.concatenate([self._chunk(column, chunk_index)
+                                     for chunk_index in range(first_chunk, last_chunk + 1)])
+            start = offset - first_chunk * chunk_rows
+            result[column] = values[start:start + count]
+
+        return result
+
+    def close(self):
+        self._cache = {}
+        self._mmap = None
@@ -0,0 +1,318 @@
+# -------------------------------------------------------------------------------
+# Name:        AGWA_ZonalEngine.py
+# Purpose:     Label-array zonal statistics shared by the parameterization tools
+# -------------------------------------------------------------------------------
+import arcpy
+import hashlib
+import json
+import os
+import numpy as np
+
+
+class ZoneGrid(object):
+    """Cell grid of a rasterized zone feature class
+    : lower_left - arcpy.Point of the lower left corner of the grid
+    : cell_size - cell size of the grid in map units
+    : labels - 2D array of zone values, where cells outside of every zone are equal to nodata
+    : nodata - value of cells that are not in a zone
+    : spatial_reference - coordinate system of the grid, the coordinate system of the snap raster
+    """
+    def __init__(self, lower_left, cell_size, labels, nodata, spatial_reference=None):
+        self.lower_left = lower_left
+        self.cell_size = cell_size
+        self.labels = labels
+        self.nodata = nodata
+        self.spatial_reference = spatial_reference
+
+    @property
+    def nrows(self):
+        return self.labels.shape[0]
+
+    @property
+    def ncols(self):
+        return self.labels.shape[1]
+
+
+def rasterize_zones(zone_features, zone_field, snap_raster, out_raster, nodata=-1):
+    """Rasterize zone polygons onto the cells of the snap raster and load them as a label array
+    The zones are projected to the coordinate system of the snap raster, as Tabulate Area and Zonal Statistics do,
+    so rasters in another coordinate system than the zones, e.g. NLCD in CONUS Albers, are read on their own cells.
+    : zone_features - polygon feature class with the zones
+    : zone_field - integer field holding the zone value, e.g. Element_ID
+    : snap_raster - raster whose cell size and alignment the zones are rasterized to
+    : out_raster - output path of the zone raster
+    : nodata - label assigned to cells that are not in a zone
+    """
+    snap_description = arcpy.Describe(snap_raster)
+    cell_size = snap_description.meanCellWidth
+    spatial_reference = snap_description.spatialReference
+    # a snap raster in another coordinate system than the output is ignored, so the output is set to its system
+    snap_raster_env = arcpy.env.snapRaster
+    output_coordinate_system_env = arcpy.env.outputCoordinateSystem
+    arcpy.env.snapRaster = snap_raster
+    arcpy.env.outputCoordinateSystem = spatial_reference
+    try:
+        arcpy.conversion.PolygonToRaster(zone_features, zone_field, out_raster, "CELL_CENTER", "NONE", cell_size)
+    finally:
+        arcpy.env.snapRaster = snap_raster_env
+        arcpy.env.outputCoordinateSystem = output_coordinate_system_env
+
+    extent = arcpy.Describe(out_raster).extent
+    lower_left = arcpy.Point(extent.XMin, extent.YMin)
+    labels = arcpy.RasterToNumPyArray(out_raster, nodata_to_value=nodata).astype(np.int64)
+
+    return ZoneGrid(lower_left, cell_size, labels, nodata, spatial_reference)
+
+
+def read_aligned(raster, grid):
+    """Read a raster over the cells of a zone grid as a float array
+    NoData cells and cells beyond the extent of the raster are returned as NaN.
+    : raster - path of a raster that shares the cell size and alignment of the grid
+    : grid - ZoneGrid returned by rasterize_zones
+    """
+    value_raster = arcpy.Raster(raster)
+    nodata = value_raster.noDataValue
+    values = arcpy.RasterToNumPyArray(value_raster, grid.lower_left, grid.ncols, grid.nrows).astype(np.float64)
+    if nodata is not None:
+        values[values == nodata] = np.nan
+
+    # mask the cells of the grid whose centers fall outside of the raster
+    extent = value_raster.extent
+    x = grid.lower_left.X + (np.arange(grid.ncols) + 0.5) * grid.cell_size
+    y = grid.lower_left.Y + (grid.nrows - np.arange(grid.nrows) - 0.5) * grid.cell_size
+    values[:, (x < extent.XMin) | (x > extent.XMax)] = np.nan
+    values[(y < extent.YMin) | (y > extent.YMax), :] = np.nan
+
+    return values
+
+
+def raster_digest(raster, block_rows=1024):
+    """Hash the cell values of a raster a block of rows at a time
+    Used for rasters that are not a single file, e.g. in a geodatabase, whose changes cannot be seen from a file size
+    and modification time.
+    : raster - raster to hash
+    : block_rows - number of rows read at a time
+    """
+    value_raster = arcpy.Raster(raster)
+    extent = value_raster.extent
+    digest = hashlib.sha256()
+    for r0 in range(0, value_raster.height, block_rows):
+        r1 = min(r0 + block_rows, value_raster.height)
+        lower_left = arcpy.Point(extent.XMin, extent.YMax - r1 * value_raster.meanCellHeight)
+        block = arcpy.RasterToNumPyArray(value_raster, lower_left, value_raster.width, r1 - r0)
+        digest.update(block.tobytes())
+
+    return digest.hexdigest()
+
+
+def index_zones(labels, nodata, zone_ids=None):
+    """Map zone labels to consecutive indices so zones can be aggregated with np.bincount
+    Returns the sorted zone ids and an index array shaped like labels where cells outside of the
+    zones, or in zones not listed in zone_ids, are equal to -1.
+    : labels - array of zone values
+    : nodata - label of cells that are not in a zone
+    : zone_ids - optional sequence of zone values to index; defaults to the zones present in labels
+    """
+    labels = np.asarray(labels)
+    in_zone = labels != nodata
+    if zone_ids is None:
+        zone_ids = np.unique(labels[in_zone])
+    else:
+        zone_ids = np.unique(np.asarray(zone_ids, dtype=labels.dtype))
+
+    index = np.full(labels.shape, -1, dtype=np.int64)
+    if len(zone_ids) > 0:
+        position = np.searchsorted(zone_ids, labels[in_zone])
+        position_clipped = np.minimum(position, len(zone_ids) - 1)
+        found = zone_ids[position_clipped] == labels[in_zone]
+        index[in_zone] = np.where(found, position_clipped, -1)
+
+    return zone_ids, index
+
+
+def zonal_statistics(index, zone_count, value_arrays, statistics=("MEAN",)):
+    """Compute grouped statistics of several value arrays over the same zones in one pass per array
+    Cells where a value is NaN are ignored, matching the DATA option of Zonal Statistics as Table.
+    Zones without any valid cell receive NaN (COUNT receives 0).
+    : index - zone index array from index_zones
+    : zone_count - number of zones
+    : value_arrays - dictionary of name to value array shaped like index
+    : statistics - sequence of MEAN, SUM, COUNT, MIN, MAX, RANGE, and/or STD
+    Returns a dictionary of name to dictionary of statistic to array of length zone_count.
+    """
+    statistics = [statistic.upper() for statistic in statistics]
+    flat_index = np.ravel(index)
+    in_zone = flat_index >= 0
+
+    results = {}
+    for name, values in value_arrays.items():
+        flat_values = np.ravel(values)
+        valid = in_zone & ~np.isnan(flat_values)
+        zone = flat_index[valid]
+        data = flat_values[valid]
+
+        count = np.bincount(zone, minlength=zone_count)
+        total = np.bincount(zone, weights=data, minlength=zone_count)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mean = np.where(count > 0, total / count, np.nan)
+
+        zone_results = {}
+        if "COUNT" in statistics:
+            zone_results["COUNT"] = count
+        if "SUM" in statistics:
+            zone_results["SUM"] = np.where(count > 0, total, np.nan)
+        if "MEAN" in statistics:
+            zone_results["MEAN"] = mean
+        if "STD" in statistics:
+            # population standard deviation, as reported by Zonal Statistics
+            squares = np.bincount(zone, weights=(data - mean[zone]) ** 2, minlength=zone_count)
+            with np.errstate(invalid="ignore", divide="ignore"):
+                zone_results["STD"] = np.where(count > 0, np.sqrt(squares / count), np.nan)
+        if {"MIN", "MAX", "RANGE"}.intersection(statistics):
+            minimum = np.full(zone_count, np.nan)
+            maximum = np.full(zone_count, np.nan)
+            if len(zone) > 0:
+                order = np.argsort(zone, kind="stable")
+                sorted_zone = zone[order]
+                sorted_data = data[order]
+                starts = np.flatnonzero(np.r_[True, sorted_zone[1:] != sorted_zone[:-1]])
+                zones_present = sorted_zone[starts]
+                minimum[zones_present] = np.minimum.reduceat(sorted_data, starts)
+                maximum[zones_present] = np.maximum.reduceat(sorted_data, starts)
+            if "MIN" in statistics:
+                zone_results["MIN"] = minimum
+            if "MAX" in statistics:
+                zone_results["MAX"] = maximum
+            if "RANGE" in statistics:
+                zone_results["RANGE"] = maximum - minimum
+        results[name] = zone_results
+
+    return results
+
+
+def crosstabulate(index, zone_ids, class_values, cell_area=1.0):
+    """Tabulate the area of every class in every zone in one pass
+    Only the zone and class pairs that occur are kept, so the result stays small with many zones and many classes,
+    e.g. elements and soil map units. Cells outside of the zones or where the class value is NaN are ignored.
+    Returns a SparseCrosstab with one row per zone id.
+    : index - zone index array from index_zones
+    : zone_ids - zone ids from index_zones
+    : class_values - array of class values shaped like index, e.g. land cover read with read_aligned
+    : cell_area - area of a cell in map units
+    """
+    flat_index = np.ravel(index)
+    flat_values = np.ravel(class_values)
+    valid = (flat_index >= 0) & ~np.isnan(flat_values)
+    class_ids, class_index = np.unique(flat_values[valid].astype(np.int64), return_inverse=True)
+    class_count = max(len(class_ids), 1)
+    pairs, counts = np.unique(flat_index[valid] * class_count + class_index.ravel(), return_counts=True)
+    rows, columns = np.divmod(pairs, class_count)
+
+    return SparseCrosstab.from_pairs(zone_ids, class_ids, rows, columns, counts * cell_area)
+
+
+def sample_points(grid, values, x, y):
+    """Read the values of a grid aligned array at points
+    Points outside of the grid are returned as NaN.
+    : grid - ZoneGrid the values are aligned to
+    : values - array read with read_aligned
+    : x, y - arrays of point coordinates in the units of the grid
+    """
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    cols = np.floor((x - grid.lower_left.X) / grid.cell_size).astype(np.int64)
+    rows = grid.nrows - 1 - np.floor((y - grid.lower_left.Y) / grid.cell_size).astype(np.int64)
+    inside = (rows >= 0) & (rows < grid.nrows) & (cols >= 0) & (cols < grid.ncols)
+    sampled = np.full(x.shape, np.nan)
+    sampled[inside] = values[rows[inside], cols[inside]]
+
+    return sampled
+
+
+class SparseCrosstab(object):
+    """Zone x class area matrix in compressed sparse row form
+    : zone_ids - sorted zone values of the rows
+    : class_ids - sorted class values of the columns
+    : indptr - start of the entries of each row, with a final entry equal to the number of entries
+    : indices - column of each entry
+    : areas - area of each entry
+    """
+    def __init__(self, zone_ids, class_ids, indptr, indices, areas):
+        self.zone_ids = np.asarray(zone_ids, dtype=np.int64)
+        self.class_ids = np.asarray(class_ids, dtype=np.int64)
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+        self.indices = np.asarray(indices, dtype=np.int64)
+        self.areas = np.asarray(areas, dtype=np.float64)
+
+    @classmethod
+    def from_pairs(cls, zone_ids, class_ids, rows, columns, areas):
+        """Build the matrix from row, column, and area entries, summing the areas of repeated entries
+        : zone_ids, class_ids - sorted zone and class values of the rows and columns
+        : rows, columns - row and column of each entry
+        : areas - area of each entry
+        """
+        class_count = max(len(class_ids), 1)
+        keys = np.asarray(rows, dtype=np.int64) * class_count + np.asarray(columns, dtype=np.int64)
+        keys, inverse = np.unique(keys, return_inverse=True)
+        entry_areas = np.bincount(inverse.ravel(), weights=np.asarray(areas, dtype=np.float64), minlength=len(keys))
+        rows, columns = np.divmod(keys, class_count)
+        indptr = np.concatenate([[0], np.cumsum(np.bincount(rows, minlength=len(zone_ids)))])
+        return cls(zone_ids, class_ids, indptr, columns, entry_areas)
+
+    def add_entries(self, rows, class_values, areas):
+        """Return a matrix with areas added to some rows, for classes that may not be columns yet
+        : rows - row of each area
+        : class_values - class value of each area
+        : areas - areas to add
+        """
+        class_ids = np.union1d(self.class_ids, np.asarray(class_values, dtype=np.int64))
+        columns = np.searchsorted(class_ids, self.class_ids)[self.indices]
+        new_columns = np.searchsorted(class_ids, np.asarray(class_values, dtype=np.int64))
+        return SparseCrosstab.from_pairs(self.zone_ids, class_ids, np.concatenate([self.rows(), rows]),
+                                         np.concatenate([columns, new_columns]),
+                                         np.concatenate([self.areas, areas]))
+
+    def rows(self):
+        """Row of each entry"""
+        return np.repeat(np.arange(len(self.zone_ids)), np.diff(self.indptr))
+
+    def total_areas(self):
+        return np.bincount(self.rows(), weights=self.areas, minlength=len(self.zone_ids))
+
+    def weighted_mean(self, lookup):
+        """Area-weighted mean of per-class values for every zone as sparse matrix-vector products
+        Zones without area receive NaN.
+        : lookup - class count x value count array of values, in the order of class_ids
+        """
+        lookup = np.asarray(lookup, dtype=np.float64).reshape(len(self.class_ids), -1)
+        rows = self.rows()
+        totals = self.total_areas()
+        result = np.empty((len(self.zone_ids), lookup.shape[1]))
+        for column in range(lookup.shape[1]):
+            weighted = np.bincount(rows, weights=self.areas * lookup[self.indices, column],
+                                   minlength=len(self.zone_ids))
+            with np.errstate(invalid="ignore", divide="ignore"):
+                result[:, column] = np.where(totals > 0, weighted / totals, np.nan)
+
+        return result
+
+    def save(self, path, signature):
+        """Write the matrix and a signature of its inputs to a compressed .npz file
+        : path - output .npz file
+        : signature - JSON serializable description of the inputs, compared by load
+        """
+        np.savez_compressed(path, zone_ids=self.zone_ids, class_ids=self.class_ids, indptr=self.indptr,
+                            indices=self.indices, areas=self.areas, signature=np.array(json.dumps(signature)))
+
+    @classmethod
+    def load(cls, path, signature=None):
+        """Read a matrix written by save, or return None if it is missing or was built from other inputs
+        : path - .npz file
+        : signature - expected signature of the inputs
+        """
+        if not os.path.exists(path):
+            return None
+        with np.load(path) as data:
+            if signature is not None and json.loads(str(data["signature"])) != json.loads(json.dumps(signature)):
+                return None
+            return cls(data["zone_ids"], data["class_ids"], data["indptr"], data["indices"], data["areas"])
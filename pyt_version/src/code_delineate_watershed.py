@@ -3,6 +3,18 @@ import arcpy
 import arcpy.management  # Import statement added to provide intellisense in PyCharm
 import os
 import datetime
+import numpy as np
+import AGWA_DrainageIndex
+import AGWA_Polygonize
+import AGWA_TerrainCache
+import AGWA_TiledTerrain
+import importlib
+importlib.reload(AGWA_DrainageIndex)
+importlib.reload(AGWA_Polygonize)
+importlib.reload(AGWA_TerrainCache)
+importlib.reload(AGWA_TiledTerrain)
+
+SNAP_BLOCK_ROWS = 1024
 
 
 # Check out any necessary licenses
@@ -56,20 +68,17 @@ def initialize_workspace(workspace, delineation_name, outlet_feature_set, outlet
         result = arcpy.management.CreateTable(out_path, out_name, template, config_keyword, out_alias)
         metadata_delineation_table = result.getOutput(0)
 
-    row = None
     outlet_x = None
     outlet_y = None
-    for row in arcpy.da.SearchCursor(outlet_feature_set, ["SHAPE@"]):
-        if sr1.name != sr2.name:
-            tweet("Projecting the outlet coordinates because the spatial references between the DEM and the outlet do "
-                  "not match. \nDEM Spatial Reference: '{0}' \nOutlet Spatial Reference: '{1}'".format(sr1.name,
-                                                                                                       sr2.name))
-            outlet_x = row[0].projectAs(sr1).centroid.X
-            outlet_y = row[0].projectAs(sr1).centroid.Y
-        else:
-            outlet_x = row[0].centroid.X
-            outlet_y = row[0].centroid.Y
-    if row is None:
+    if sr1.name != sr2.name:
+        tweet("Projecting the outlet coordinates because the spatial references between the DEM and the outlet do "
+              "not match. \nDEM Spatial Reference: '{0}' \nOutlet Spatial Reference: '{1}'".format(sr1.name,
+                                                                                                   sr2.name))
+    outlets = read_outlets(outlet_feature_set, sr1)
+    if len(outlets) > 0:
+        outlet_x = float(outlets["SHAPE@X"][-1])
+        outlet_y = float(outlets["SHAPE@Y"][-1])
+    else:
         tweet("Cannot proceed. There were no records in the outlet feature set.")
 
     creation_date = datetime.datetime.now().isoformat()
@@ -83,6 +92,76 @@ def initialize_workspace(workspace, delineation_name, outlet_feature_set, outlet
                           agwa_version_at_creation, agwa_gdb_version_at_creation))
 
 
+def initialize_batch(workspace, delineation_name, outlet_feature_set, outlet_snapping_radius):
+    """Write one metaDelineation row per outlet for batch delineation
+    Each outlet becomes a delineation named after the delineation name and the ObjectID of the outlet, e.g. name_12,
+    and all the rows are written with one cursor. Returns the delineation names in the order of the outlets.
+    : workspace - delineation workspace geodatabase
+    : delineation_name - name of the batch, used as the prefix of the delineation names
+    : outlet_feature_set - point layer of the outlets
+    : outlet_snapping_radius - snap radius of every outlet in map units
+    """
+    arcpy.env.workspace = workspace
+
+    tweet("Reading Spatial Reference of filled DEM")
+    meta_workspace_table = os.path.join(workspace, "metaWorkspace")
+    fields = ["DelineationWorkspace", "FilledDEMName", "FilledDEMPath"]
+
+    row = None
+    expression = "{0} = '{1}'".format(arcpy.AddFieldDelimiters(workspace, "DelineationWorkspace"),
+                                      workspace)
+    with arcpy.da.SearchCursor(meta_workspace_table, fields, expression) as cursor:
+        for row in cursor:
+            filled_dem_name = row[1]
+            filled_dem_path = row[2]
+        if row is None:
+            msg = "Cannot proceed. \nThe table '{0}' returned 0 records with field '{1}' equal to '{2}'.".format(
+                meta_workspace_table, "DelineationWorkspace", workspace)
+            print(msg)
+            raise Exception(msg)
+
+    raster = os.path.join(filled_dem_path, filled_dem_name)
+    sr1 = arcpy.Describe(raster).SpatialReference
+
+    tweet("Reading Spatial Reference of outlets")
+    sr2 = arcpy.Describe(outlet_feature_set).SpatialReference
+    if sr1.name != sr2.name:
+        tweet("Projecting the outlet coordinates because the spatial references between the DEM and the outlets do "
+              "not match. \nDEM Spatial Reference: '{0}' \nOutlet Spatial Reference: '{1}'".format(sr1.name,
+                                                                                                    sr2.name))
+
+    tweet("Writing delineation parameters to metadata")
+    out_path = workspace
+    out_name = "metaDelineation"
+    template = r"\schema\metaDelineation.csv"
+    config_keyword = ""
+    out_alias = ""
+    metadata_delineation_table = os.path.join(out_path, out_name)
+    if not arcpy.Exists(metadata_delineation_table):
+        result = arcpy.management.CreateTable(out_path, out_name, template, config_keyword, out_alias)
+        metadata_delineation_table = result.getOutput(0)
+
+    creation_date = datetime.datetime.now().isoformat()
+    agwa_version_at_creation = ""
+    agwa_gdb_version_at_creation = ""
+
+    delineation_rows = []
+    for oid, outlet_x, outlet_y in read_outlets(outlet_feature_set, sr1):
+        delineation_rows.append(("{0}_{1}".format(delineation_name, oid), float(outlet_x), float(outlet_y),
+                                 outlet_snapping_radius, creation_date, agwa_version_at_creation,
+                                 agwa_gdb_version_at_creation))
+    if not delineation_rows:
+        raise Exception("Cannot proceed. \nThere were no records in the outlet feature set.")
+
+    fields = ["DelineationName", "OutletX", "OutletY", "OutletSnappingRadius", "CreationDate",
+              "AGWAVersionAtCreation", "AGWAGDBVersionAtCreation"]
+    with arcpy.da.InsertCursor(metadata_delineation_table, fields) as cursor:
+        for delineation_row in delineation_rows:
+            cursor.insertRow(delineation_row)
+
+    return [delineation_row[0] for delineation_row in delineation_rows]
+
+
 def delineate(workspace, delineation_name, save_intermediate_outputs):
     try:
         arcpy.env.workspace = workspace
@@ -121,7 +200,7 @@ def delineate(workspace, delineation_name, save_intermediate_outputs):
         with arcpy.da.SearchCursor(meta_delineation_table, fields, expression) as cursor:
             for row in cursor:
                 outlet_tpl = float(row[0]), float(row[1])
-                snap_radius = row[2]
+                snap_radius = float(row[2])
 
             if row is None:
                 msg = "Cannot proceed. \nThe table '{0}' returned 0 records with field '{1}' equal to '{2}'.".format(
@@ -129,46 +208,310 @@ def delineate(workspace, delineation_name, save_intermediate_outputs):
                 print(msg)
                 raise Exception(msg)
 
+        # The drainage index is built from the flow direction raster on the first delineation in the workspace, after
+        # which delineation only touches the cells of the basin instead of the whole flow direction raster
+        fd_raster = os.path.join(fd_path, fd_name)
+        drainage_index = get_drainage_index(workspace, fd_raster)
+
         # Snap the outletFeatureSet or outletFeatureClass to the faRaster using the snapRadius
         tweet("Snapping pour point")
         outlet_x, outlet_y = outlet_tpl
-        outlet_point = arcpy.Point(outlet_x, outlet_y)
-        outlet_point_geometry = arcpy.PointGeometry(outlet_point)
         fa_raster = os.path.join(fa_path, fa_name)
-        outlet_pour_point = arcpy.sa.SnapPourPoint(outlet_point_geometry, fa_raster, snap_radius, "#")
-        error_msgs = arcpy.GetMessages(2)
-        if error_msgs:
-            msg = "Cannot proceed. \nThe tool '{0}' failed with the message '{1}''.".format("SnapPourPoint", error_msgs)
-            raise Exception(msg)
+        outlet_x, outlet_y = snap_pour_points(fa_raster, [outlet_x], [outlet_y], snap_radius)
+        outlet_x, outlet_y = float(outlet_x[0]), float(outlet_y[0])
+        outlet_cell = int(drainage_index.cell_of(outlet_x, outlet_y))
+        if outlet_cell < 0:
+            raise Exception("Cannot proceed. \nThe outlet ({0}, {1}) is outside of the flow direction raster "
+                            "'{2}'.".format(outlet_x, outlet_y, fd_raster))
 
-        # Process: Watershed
         tweet("Delineating watershed raster")
-        fd_raster = os.path.join(fd_path, fd_name)
-        delineation_raster = arcpy.sa.Watershed(fd_raster, outlet_pour_point, "#")
+        basin_cells = drainage_index.upstream_cells([outlet_cell])
+        delineation_output_name = os.path.join(workspace, delineation_name + "_raster")
+        basin_values, x_min, y_max = save_basin_raster(drainage_index, basin_cells, fd_raster,
+                                                       delineation_output_name)
 
-        # Process: Raster to Polygon
+        # the basin polygon is traced from the basin array, with no per-cell intermediate polygons to dissolve
         tweet("Converting delineation raster to feature class")
-        intermediate_delineation_fc = "intermediate_{}_dissolve".format(delineation_name)
-        arcpy.RasterToPolygon_conversion(delineation_raster, intermediate_delineation_fc, "NO_SIMPLIFY", "#")
-
-        tweet("Dissolving intermediate delineation feature class")
         delineation_fc = os.path.join(workspace, delineation_name)
-        result = arcpy.Dissolve_management(intermediate_delineation_fc, delineation_fc, "gridcode", "", "MULTI_PART",
-                                           "DISSOLVE_LINES")
-        delineation_fc = result.getOutput(0)
-
-        if not save_intermediate_outputs:
-            arcpy.Delete_management(intermediate_delineation_fc)
+        georeference = drainage_index.georeference
+        delineation_fc = AGWA_Polygonize.save_label_polygons(basin_values, 0, x_min, y_max,
+                                                             georeference["cell_width"], georeference["cell_height"],
+                                                             arcpy.Describe(fd_raster).spatialReference, delineation_fc)
 
         # Add the WSGroup Field to the delineation_fc and populate it
 
-        save_delineation_raster = True
-        if save_delineation_raster:
-            delineation_output_name = os.path.join(workspace, delineation_name + "_raster")
-            delineation_raster.save(delineation_output_name)
-
         # Set the output parameter so the delineation can be added to the map
         arcpy.SetParameter(4, delineation_fc)
 
     except Exception as e:
         tweet(e)
+
+
+def delineate_batch(workspace, delineation_name, delineation_names, save_intermediate_outputs):
+    """Delineate the watersheds of many outlets together
+    The outlets are snapped in one vectorized search and the basins of all the outlets are labelled in one upstream
+    walk of the drainage index, where an outlet nested in the basin of another outlet gets its own label. The
+    delineation polygons are traced from the basin arrays and written to one feature class named after the batch,
+    which is then split into one feature class per delineation.
+    : workspace - delineation workspace geodatabase
+    : delineation_name - name of the batch
+    : delineation_names - names of the delineations written by initialize_batch
+    : save_intermediate_outputs - not used, batch delineation creates no intermediate outputs
+    """
+    try:
+        arcpy.env.workspace = workspace
+
+        tweet("Reading workspace metadata")
+        meta_workspace_table = os.path.join(workspace, "metaWorkspace")
+        if not arcpy.Exists(meta_workspace_table):
+            # Short-circuit and leave message
+            raise Exception("Cannot proceed. \nThe table '{}' does not exist.".format(meta_workspace_table))
+
+        row = None
+        fields = ["DelineationWorkspace", "FDName", "FDPath", "FAName", "FAPath"]
+        expression = "{0} = '{1}'".format(arcpy.AddFieldDelimiters(workspace, "DelineationWorkspace"), workspace)
+        with arcpy.da.SearchCursor(meta_workspace_table, fields, expression) as cursor:
+            for row in cursor:
+                fd_name = row[1]
+                fd_path = row[2]
+
+                fa_name = row[3]
+                fa_path = row[4]
+            if row is None:
+                msg = "Cannot proceed. \nThe table '{0}' returned 0 records with field '{1}' equal to '{2}'.".format(
+                    meta_workspace_table, "DelineationWorkspace", workspace)
+                print(msg)
+                raise Exception(msg)
+
+        tweet("Reading delineation metadata")
+        meta_delineation_table = os.path.join(workspace, "metaDelineation")
+        if not arcpy.Exists(meta_delineation_table):
+            # Short-circuit and leave message
+            raise Exception("Cannot proceed. \nThe table '{}' does not exist.".format(meta_delineation_table))
+
+        outlets = {}
+        fields = ["DelineationName", "OutletX", "OutletY", "OutletSnappingRadius"]
+        expression = "{0} IN ({1})".format(arcpy.AddFieldDelimiters(workspace, "DelineationName"),
+                                           ", ".join("'{}'".format(name) for name in delineation_names))
+        with arcpy.da.SearchCursor(meta_delineation_table, fields, expression) as cursor:
+            for row in cursor:
+                outlets[row[0]] = float(row[1]), float(row[2]), float(row[3])
+        missing_names = [name for name in delineation_names if name not in outlets]
+        if missing_names:
+            msg = "Cannot proceed. \nThe table '{0}' returned 0 records with field '{1}' equal to '{2}'.".format(
+                meta_delineation_table, "DelineationName", "', '".join(missing_names))
+            print(msg)
+            raise Exception(msg)
+
+        fd_raster = os.path.join(fd_path, fd_name)
+        drainage_index = get_drainage_index(workspace, fd_raster)
+
+        tweet("Snapping {} pour points".format(len(delineation_names)))
+        fa_raster = os.path.join(fa_path, fa_name)
+        outlet_x = np.array([outlets[name][0] for name in delineation_names])
+        outlet_y = np.array([outlets[name][1] for name in delineation_names])
+        snap_radii = np.array([outlets[name][2] for name in delineation_names])
+        for snap_radius in np.unique(snap_radii):
+            same_radius = snap_radii == snap_radius
+            outlet_x[same_radius], outlet_y[same_radius] = snap_pour_points(fa_raster, outlet_x[same_radius],
+                                                                            outlet_y[same_radius], snap_radius)
+        outlet_cells = drainage_index.cell_of(outlet_x, outlet_y)
+        if np.any(outlet_cells < 0):
+            outside_names = [name for name, cell in zip(delineation_names, outlet_cells) if cell < 0]
+            raise Exception("Cannot proceed. \nThe outlets of the delineations '{0}' are outside of the flow direction "
+                            "raster '{1}'.".format("', '".join(outside_names), fd_raster))
+
+        tweet("Labelling the basins of {} outlets".format(len(delineation_names)))
+        cells, labels, outlet_labels, parents = drainage_index.label_upstream(outlet_cells)
+        members = AGWA_DrainageIndex.nested_labels(parents)
+        label_order = np.argsort(labels, kind="stable")
+        sorted_labels = labels[label_order]
+
+        # each delineation is traced from its own basin array, so nested delineations include the nested basins
+        tweet("Saving delineation rasters and feature classes")
+        spatial_reference = arcpy.Describe(fd_raster).spatialReference
+        georeference = drainage_index.georeference
+        result = arcpy.management.CreateFeatureclass(workspace, delineation_name, "POLYGON",
+                                                     spatial_reference=spatial_reference)
+        delineation_fc = result.getOutput(0)
+        arcpy.management.AddField(delineation_fc, "DelineationName", "TEXT")
+        with arcpy.da.InsertCursor(delineation_fc, ["SHAPE@", "DelineationName"]) as cursor:
+            for name, outlet_label in zip(delineation_names, outlet_labels):
+                basin_cells = np.concatenate([cells[label_order[np.searchsorted(sorted_labels, label):
+                                                                np.searchsorted(sorted_labels, label, "right")]]
+                                              for label in members[outlet_label]])
+                basin_values, x_min, y_max = save_basin_raster(drainage_index, basin_cells, fd_raster,
+                                                               os.path.join(workspace, name + "_raster"))
+                rings = AGWA_Polygonize.label_polygons(basin_values, 0)[1]
+                cursor.insertRow((AGWA_Polygonize.to_polygon(rings, x_min, y_max, georeference["cell_width"],
+                                                              georeference["cell_height"], spatial_reference), name))
+
+        arcpy.analysis.SplitByAttributes(delineation_fc, workspace, "DelineationName")
+
+        # Set the output parameter so the delineations can be added to the map
+        arcpy.SetParameter(4, delineation_fc)
+
+    except Exception as e:
+        tweet(e)
+
+
+def get_drainage_index(workspace, fd_raster):
+    """Open the drainage index of a workspace, building it when it does not exist or the flow direction raster changed
+    The index is stored in the drainage_index folder next to the workspace geodatabase.
+    : workspace - delineation workspace geodatabase
+    : fd_raster - flow direction raster of the workspace
+    """
+    workspace_folder = arcpy.Describe(workspace).path
+    workspace_name = os.path.splitext(os.path.basename(workspace))[0]
+    index_folder = os.path.join(workspace_folder, "drainage_index", workspace_name)
+
+    # an index built before the workspace was set up again on another DEM is rebuilt
+    terrain_cache_key = check_terrain_rasters(workspace)
+
+    value_raster = arcpy.Raster(fd_raster)
+    extent = value_raster.extent
+    catalog_path = value_raster.catalogPath
+    source_signature = [catalog_path, extent.XMin, extent.YMin, extent.XMax, extent.YMax, terrain_cache_key]
+    if os.path.isfile(catalog_path):
+        stat = os.stat(catalog_path)
+        source_signature += [stat.st_size, stat.st_mtime_ns]
+
+    drainage_index = AGWA_DrainageIndex.open_drainage_index(index_folder, source_signature)
+    if drainage_index is None:
+        tweet("Building the drainage index of the workspace")
+        if not os.path.exists(index_folder):
+            os.makedirs(index_folder)
+        direction_file = os.path.join(index_folder, "fd.npy")
+        direction = export_flow_direction(value_raster, direction_file)
+        georeference = {"x_min": extent.XMin, "y_max": extent.YMax, "cell_width": value_raster.meanCellWidth,
+                        "cell_height": value_raster.meanCellHeight}
+        drainage_index = AGWA_DrainageIndex.build_drainage_index(direction, index_folder, georeference,
+                                                                 source_signature)
+        del direction
+        os.remove(direction_file)
+
+    return drainage_index
+
+
+def export_flow_direction(value_raster, npy_file, tile_size=AGWA_TiledTerrain.DEFAULT_TILE_SIZE):
+    """Copy a flow direction raster to a memory-mapped .npy file of uint8 codes one tile at a time, 0 for NoData
+    : value_raster - arcpy.Raster of the flow direction
+    : npy_file - output .npy file
+    : tile_size - number of rows and columns read at a time
+    """
+    extent = value_raster.extent
+    cell_width = value_raster.meanCellWidth
+    cell_height = value_raster.meanCellHeight
+    direction = AGWA_TiledTerrain.create_array(npy_file, (value_raster.height, value_raster.width), np.uint8)
+    for r0, r1, c0, c1 in AGWA_TiledTerrain.tiles(direction.shape, tile_size):
+        lower_left = arcpy.Point(extent.XMin + c0 * cell_width, extent.YMax - r1 * cell_height)
+        direction[r0:r1, c0:c1] = arcpy.RasterToNumPyArray(value_raster, lower_left, c1 - c0, r1 - r0,
+                                                           nodata_to_value=0).astype(np.uint8)
+    direction.flush()
+
+    return direction
+
+
+def check_terrain_rasters(workspace):
+    """Warn when the terrain rasters of a workspace changed since they were derived from its DEM
+    The TerrainCacheKey recorded in metaWorkspace names the terrain cache entry the rasters were derived into, and
+    its manifest holds the size and modification time of their files.
+    Returns the recorded key, or an empty string for workspaces set up without one.
+    : workspace - delineation workspace geodatabase
+    """
+    meta_workspace_table = os.path.join(workspace, "metaWorkspace")
+    if "TerrainCacheKey" not in [field.name for field in arcpy.ListFields(meta_workspace_table)]:
+        return ""
+
+    fields = ["TerrainCacheKey", "AGWADirectory", "FDName", "FDPath", "FAName", "FAPath", "FlUpName", "FlUpPath"]
+    expression = "{0} = '{1}'".format(arcpy.AddFieldDelimiters(workspace, "DelineationWorkspace"), workspace)
+    terrain_cache_key, agwa_directory, raster_paths = "", "", []
+    with arcpy.da.SearchCursor(meta_workspace_table, fields, expression) as cursor:
+        for row in cursor:
+            terrain_cache_key, agwa_directory = row[0] or "", row[1]
+            raster_paths = [os.path.join(row[i + 1], row[i]) for i in (2, 4, 6)]
+
+    changed = AGWA_TerrainCache.changed_workspace_rasters(agwa_directory, terrain_cache_key, raster_paths)
+    if changed:
+        tweet("Warning: the rasters {0} were changed after they were derived from the DEM of the workspace (terrain "
+              "cache key {1}), so they may not match the DEM. Run Setup AGWA Workspace again to derive them from the "
+              "current DEM.".format(changed, terrain_cache_key))
+
+    return terrain_cache_key
+
+
+def read_outlets(outlet_feature_set, spatial_reference):
+    """Read the ObjectIDs and centroids of outlets, projected in bulk to a spatial reference
+    Returns a structured array with the fields OID@, SHAPE@X, and SHAPE@Y.
+    : outlet_feature_set - outlet feature set or feature class
+    : spatial_reference - spatial reference of the DEM
+    """
+    return arcpy.da.FeatureClassToNumPyArray(outlet_feature_set, ["OID@", "SHAPE@X", "SHAPE@Y"],
+                                             spatial_reference=spatial_reference)
+
+
+def snap_pour_points(fa_raster, outlet_x, outlet_y, snap_radius, block_rows=SNAP_BLOCK_ROWS):
+    """Move outlets to the cell of highest flow accumulation within the snap radius
+    The flow accumulation raster is read once, in bands of rows that hold outlets plus the snap radius, and the
+    outlets of each band are snapped together, so thousands of outlets cost about one read of the raster. Returns
+    arrays of the coordinates of the centers of the snapped cells, outlets outside of the raster are not moved.
+    : fa_raster - flow accumulation raster
+    : outlet_x, outlet_y - arrays of outlet coordinates in the spatial reference of the raster
+    : snap_radius - search radius in map units
+    : block_rows - number of rows of outlets snapped at a time
+    """
+    value_raster = arcpy.Raster(fa_raster)
+    extent = value_raster.extent
+    cell_width = value_raster.meanCellWidth
+    cell_height = value_raster.meanCellHeight
+    nodata = value_raster.noDataValue
+    outlet_x = np.asarray(outlet_x, dtype=np.float64)
+    outlet_y = np.asarray(outlet_y, dtype=np.float64)
+    rows = np.floor((extent.YMax - outlet_y) / cell_height).astype(np.int64)
+    cols = np.floor((outlet_x - extent.XMin) / cell_width).astype(np.int64)
+    inside = (rows >= 0) & (rows < value_raster.height) & (cols >= 0) & (cols < value_raster.width)
+    offsets = AGWA_DrainageIndex.disc_offsets(snap_radius, cell_width, cell_height)
+    halo_rows = int(np.abs(offsets[0]).max())
+    halo_cols = int(np.abs(offsets[1]).max())
+
+    snapped_x = outlet_x.copy()
+    snapped_y = outlet_y.copy()
+    for band_start in np.unique(rows[inside] // block_rows) * block_rows:
+        in_band = inside & (rows >= band_start) & (rows < band_start + block_rows)
+        r0 = max(int(rows[in_band].min()) - halo_rows, 0)
+        r1 = min(int(rows[in_band].max()) + halo_rows + 1, value_raster.height)
+        c0 = max(int(cols[in_band].min()) - halo_cols, 0)
+        c1 = min(int(cols[in_band].max()) + halo_cols + 1, value_raster.width)
+        lower_left = arcpy.Point(extent.XMin + c0 * cell_width, extent.YMax - r1 * cell_height)
+        accumulation = arcpy.RasterToNumPyArray(value_raster, lower_left, c1 - c0, r1 - r0).astype(np.float64)
+        if nodata is not None:
+            accumulation[accumulation == nodata] = np.nan
+        snapped_rows, snapped_cols = AGWA_DrainageIndex.snap_to_max(accumulation, rows[in_band] - r0,
+                                                                    cols[in_band] - c0, offsets)
+        snapped_x[in_band] = extent.XMin + (snapped_cols + c0 + 0.5) * cell_width
+        snapped_y[in_band] = extent.YMax - (snapped_rows + r0 + 0.5) * cell_height
+
+    return snapped_x, snapped_y
+
+
+def save_basin_raster(drainage_index, basin_cells, fd_raster, output_raster, value=1):
+    """Save the cells of a basin as a raster over the bounding window of the basin
+    Returns the basin array and the map coordinates of its top left corner.
+    : drainage_index - AGWA_DrainageIndex.DrainageIndex of the flow direction raster
+    : basin_cells - flat cell indices from DrainageIndex.upstream_cells
+    : fd_raster - flow direction raster whose spatial reference is assigned to the output
+    : output_raster - output raster path
+    : value - value of the basin cells, cells outside of the basin are NoData
+    """
+    rows, cols, (r0, r1, c0, c1) = drainage_index.window_of(basin_cells)
+    values = np.zeros((r1 - r0, c1 - c0), dtype=np.int32)
+    values[rows, cols] = value
+    georeference = drainage_index.georeference
+    lower_left = arcpy.Point(georeference["x_min"] + c0 * georeference["cell_width"],
+                             georeference["y_max"] - r1 * georeference["cell_height"])
+    raster = arcpy.NumPyArrayToRaster(values, lower_left, georeference["cell_width"], georeference["cell_height"], 0)
+    raster.save(output_raster)
+    arcpy.management.DefineProjection(output_raster, arcpy.Describe(fd_raster).spatialReference)
+
+    return values, georeference["x_min"] + c0 * georeference["cell_width"], \
+        georeference["y_max"] - r0 * georeference["cell_height"]
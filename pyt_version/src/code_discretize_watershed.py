@@ -4,6 +4,12 @@ import arcpy.management  # Import statement added to provide intellisense in PyC
 import arcpy.analysis  # Import statement added to provide intellisense in PyCharm
 import os
 import datetime
+import numpy as np
+import AGWA_Polygonize
+import AGWA_StreamNetwork
+import importlib
+importlib.reload(AGWA_Polygonize)
+importlib.reload(AGWA_StreamNetwork)
 
 
 # Check out any necessary licenses
@@ -54,7 +60,7 @@ def discretize(workspace, discretization_name, save_intermediate_outputs):
         # Short-circuit and leave message
         raise Exception("Cannot proceed. \nThe table '{}' does not exist.".format(meta_workspace_table))
 
-    fields = ["FDName", "FDPath", "FAName", "FAPath", "FlUpName", "FlUpPath"]
+    fields = ["FDName", "FDPath", "FlUpName", "FlUpPath"]
 
     row = None
     expression = "{0} = '{1}'".format(arcpy.AddFieldDelimiters(workspace, "DelineationWorkspace"), workspace)
@@ -63,11 +69,8 @@ def discretize(workspace, discretization_name, save_intermediate_outputs):
             fd_name = row[0]
             fd_path = row[1]
 
-            fa_name = row[2]
-            fa_path = row[3]
-
-            flup_name = row[4]
-            flup_path = row[5]
+            flup_name = row[2]
+            flup_path = row[3]
         if row is None:
             msg = "Cannot proceed. \nThe table '{0}' returned 0 records with field '{1}' equal to '{2}'.".format(
                 meta_workspace_table, "DelineationWorkspace", workspace)
@@ -75,7 +78,6 @@ def discretize(workspace, discretization_name, save_intermediate_outputs):
             raise Exception(msg)
 
     flow_direction_raster = os.path.join(fd_path, fd_name)
-    flow_accumulation_raster = os.path.join(fa_path, fa_name)
     fl_up_raster = os.path.join(flup_path, flup_name)
 
     tweet("Reading discretization metadata")
@@ -103,17 +105,37 @@ def discretize(workspace, discretization_name, save_intermediate_outputs):
     arcpy.env.mask = delineation_name + "_raster"
     # arcpy.env.snapRaster = Snap Raster
 
-    # Process: Raster Calculator
+    # The delineation raster is aligned with the flow direction raster, so the flow direction and flow length grids
+    # are read over the window of the delineation only
+    tweet("Reading flow direction and flow length (upstream) over the delineation")
+    delineation_raster = arcpy.Raster(delineation_name + "_raster")
+    extent = delineation_raster.extent
+    cell_width = delineation_raster.meanCellWidth
+    cell_height = delineation_raster.meanCellHeight
+    spatial_reference = arcpy.Describe(flow_direction_raster).spatialReference
+    lower_left = arcpy.Point(extent.XMin, extent.YMin)
+    rows, cols = delineation_raster.height, delineation_raster.width
+    mask = arcpy.RasterToNumPyArray(delineation_raster, lower_left, cols, rows, nodata_to_value=0) > 0
+    direction = arcpy.RasterToNumPyArray(flow_direction_raster, lower_left, cols, rows, nodata_to_value=0)
+    direction = np.where(mask, direction, 0).astype(np.uint8)
+    flow_length_upstream = arcpy.RasterToNumPyArray(fl_up_raster, lower_left, cols, rows,
+                                                    nodata_to_value=np.nan).astype(np.float64)
+
+    # Stream cells, stream links, Shreve orders, and link topology in one pass over the grids instead of StreamLink,
+    # StreamOrder, StreamToFeature, and FeatureVerticesToPoints
+    tweet("Extracting stream network")
+    network = AGWA_StreamNetwork.extract_stream_network(direction, flow_length_upstream, float(threshold), mask)
+    del flow_length_upstream
+
     tweet("Creating streams raster")
-    # tweet("Scratch Workspace: %s" % arcpy.env.scratchWorkspace)
-    # tweet("Scratch Geodatabase: %s" % arcpy.env.scratchGDB)
-    # tweet("Scratch Folder: %s" % arcpy.env.scratchFolder)
-    # TODO: Determine if map algebra should not be used because it writes the output to an unpredictable temp directory
-    #  in at the %temp% Windows directory.
-    streams_raster = arcpy.Raster(fl_up_raster) > float(threshold)
-    # tweet("streams raster: %s" % streams_raster)
     streams_raster_output = "{}_streams_raster".format(discretization_name)
-    streams_raster.save(streams_raster_output)
+    streams = np.where(mask, network["streams"].reshape(mask.shape), 255).astype(np.uint8)
+    save_window_raster(streams, lower_left, cell_width, cell_height, 255, streams_raster_output, spatial_reference)
+    del streams
+    if save_intermediate_outputs:
+        stream_link_output = "intermediate_{}_streamLinkRaster".format(discretization_name)
+        save_window_raster(network["links"].reshape(mask.shape), lower_left, cell_width, cell_height, 0,
+                           stream_link_output, spatial_reference)
 
     # flow length downstream is used in element parameterization for element-based flow length calculations
     tweet("Creating flow length (downstream) raster")
@@ -125,152 +147,39 @@ def discretize(workspace, discretization_name, save_intermediate_outputs):
     flow_length_down_raster = arcpy.sa.FlowLength(flow_direction_nostream_raster, direction_measurement="DOWNSTREAM")
     flow_length_down_raster.save(flow_length_down_raster_output)
 
-    # Process: Stream Link
-    tweet("Creating stream links raster")
-    stream_link_raster = arcpy.sa.StreamLink(streams_raster, flow_direction_raster)
-    if save_intermediate_outputs:
-        stream_link_output = "intermediate_{}_streamLinkRaster".format(discretization_name)
-        stream_link_raster.save(stream_link_output)
-
-    # Process: Stream to Feature
-    tweet("Converting streams raster to feature class")
+    tweet("Creating streams and nodes feature classes")
     streams_feature_class = "{}_streams".format(discretization_name)
-    arcpy.gp.StreamToFeature(stream_link_raster, flow_direction_raster, streams_feature_class, "NO_SIMPLIFY")
-
-    # Process Feature Vertices To Points
-    tweet("Creating nodes feature class")
     nodes_feature_class = "{}_nodes".format(discretization_name)
-    # Creates all nodes but the outlet
-    arcpy.management.FeatureVerticesToPoints(streams_feature_class, nodes_feature_class, 'START')
-    arcpy.management.AddField(nodes_feature_class, "node_type", "TEXT")
-    # Get to_node that is missing, which is the outlet
-    from_set = {r[0] for r in arcpy.da.SearchCursor(streams_feature_class, "from_node")}
-    # set containing to_node without duplicates
-    to_set = {r[0] for r in arcpy.da.SearchCursor(streams_feature_class, "to_node")}
-    missing_to_node = list(to_set.difference(from_set))[0]
-    # tweet("from_set: %s" % from_set)
-    # tweet("to_set: %s" % to_set)
-    # tweet("outlet: %s" % missing_to_node)
-
-    tweet("Identifying outlet node")
-    fields = ["SHAPE@", "arcid", "grid_code", "from_node", "to_node"]
-    expression = "{0} = {1}".format(arcpy.AddFieldDelimiters(workspace, "to_node"), missing_to_node)
-    with arcpy.da.SearchCursor(streams_feature_class, fields, expression) as streams_cursor:
-        fields.append("node_type")
-        for stream_row in streams_cursor:
-            with arcpy.da.InsertCursor(nodes_feature_class, fields) as cursor:
-                cursor.insertRow((stream_row[0].lastPoint, stream_row[1], stream_row[2], stream_row[3], stream_row[4],
-                                  "outlet"))
-
-    # Process: Stream Order
-    tweet("Creating stream orders raster")
-    stream_order_raster = arcpy.sa.StreamOrder(streams_raster, flow_direction_raster, "SHREVE")
-    if save_intermediate_outputs:
-        stream_order_output = "intermediate_{}_StreamOrder".format(discretization_name)
-        stream_order_raster.save(stream_order_output)
-
-    # Process: Raster Calculator (2)
-    tweet("Creating first order streams raster")
-    first_order_streams_raster = stream_order_raster == 1
-    if save_intermediate_outputs:
-        first_order_streams_output = "intermediate_{}_firstOrderStreams".format(discretization_name)
-        first_order_streams_raster.save(first_order_streams_output)
-
-    # Process: Zonal Fill
-    tweet("Creating minimum flow accumulation zones raster of stream links")
-    minimum_fa_zones_raster = arcpy.sa.ZonalFill(stream_link_raster, flow_accumulation_raster)
-    if save_intermediate_outputs:
-        minimum_fa_zones_output = "intermediate_{}_faZones".format(discretization_name)
-        minimum_fa_zones_raster.save(minimum_fa_zones_output)
-
-    # Process: Raster Calculator (3)
-    tweet("Creating first order points raster")
-    stream_link_points_raster = minimum_fa_zones_raster == flow_accumulation_raster
-    if save_intermediate_outputs:
-        stream_link_points_output = "intermediate_{}_StreamLinkPoints".format(discretization_name)
-        stream_link_points_raster.save(stream_link_points_output)
-
-    # Process: Raster Calculator (4)
-    tweet("Creating zero order points raster")
-    zero_order_points_raster = arcpy.sa.Con(first_order_streams_raster, stream_link_points_raster, 0)
-    if save_intermediate_outputs:
-        zero_order_points_output = "intermediate_{}_ZeroOrderPoints".format(discretization_name)
-        zero_order_points_raster.save(zero_order_points_output)
-
-    # Process: Times
-    tweet("Creating stream links * 10 raster")
-    stream_link_10_raster = stream_link_raster * 10
-    if save_intermediate_outputs:
-        stream_link_10_output = "intermediate_{}_StreamLink10".format(discretization_name)
-        stream_link_10_raster.save(stream_link_10_output)
-
-    # Process: Plus
-    tweet("Creating unique pour points raster")
-    unique_pour_points_raster = zero_order_points_raster + stream_link_10_raster
-    if save_intermediate_outputs:
-        unique_pour_points_output = "intermediate_{}_UniquePourPoints".format(discretization_name)
-        unique_pour_points_raster.save(unique_pour_points_output)
-
-    # Process: Watershed
-    tweet("Creating discretization raster")
-    discretization_raster = arcpy.sa.Watershed(flow_direction_raster, unique_pour_points_raster, "VALUE")
+    save_stream_network(network, direction, extent.XMin, extent.YMax, cell_width, cell_height, spatial_reference,
+                        streams_feature_class, nodes_feature_class)
+
+    # Every cell takes the label of the first stream cell downstream of it, the labels of Watershed with the stream
+    # links * 10 and the first cells of first order links * 10 + 1 as pour points. For KINEROS2 the cells of each
+    # link are split into the right (+ 2) and left (+ 3) laterals by where their flow paths enter the link, so the
+    # elements need no overlay with the streams
+    tweet("Creating discretization labels")
+    lateral_direction = direction if model == "KINEROS2" else None
+    discretization_values = AGWA_StreamNetwork.element_labels(network, mask.ravel(),
+                                                              lateral_direction).reshape(mask.shape)
     if save_intermediate_outputs:
         discretization_output = "intermediate_{}_raster".format(discretization_name)
-        discretization_raster.save(discretization_output)
+        save_window_raster(discretization_values, lower_left, cell_width, cell_height, 0, discretization_output,
+                           spatial_reference)
+    del network, direction
 
-    # Process: Raster to Polygon
-    tweet("Converting discretization raster to feature class")
+    # Trace one dissolved polygon per element from the discretization labels instead of converting every cell run to
+    # a polygon and dissolving them
+    tweet("Converting discretization labels to feature class")
     intermediate_discretization_1 = "intermediate_{}_1".format(discretization_name)
-    arcpy.RasterToPolygon_conversion(discretization_raster, intermediate_discretization_1, "NO_SIMPLIFY", "VALUE")
+    intermediate_discretization_1 = AGWA_Polygonize.save_label_polygons(
+        discretization_values, 0, extent.XMin, extent.YMax, cell_width, cell_height, spatial_reference,
+        intermediate_discretization_1)
+    del discretization_values
 
     discretization_feature_class = "{}_elements".format(discretization_name)
-    intermediate_discretization_3 = None
-    intermediate_discretization_4 = None
-    intermediate_discretization_5 = None
-    if model == "KINEROS2":
-        tweet("Splitting model elements by streams")
-        intermediate_discretization_2 = "intermediate_{}_2_split".format(discretization_name)
-        # ArcMap needs an advanced license to use FeatureToPolygon
-        # https://desktop.arcgis.com/en/arcmap/latest/tools/data-management-toolbox/feature-to-polygon.htm
-        arcpy.management.FeatureToPolygon([intermediate_discretization_1, streams_feature_class],
-                                          intermediate_discretization_2)
-
-        # Delete extra FID field created from FeatureToPolygon
-        # Delete the gridcode field because it is empty and will be re-added with the Identity tool
-        fields = "FID_{};gridcode".format(intermediate_discretization_1)
-        tweet("Deleting unnecessary discretization fields")
-        arcpy.management.DeleteField(intermediate_discretization_2, fields, "DELETE_FIELDS")
-
-        intermediate_discretization_3 = "intermediate_{}_3_identity".format(discretization_name)
-        tweet("Updating gridcode")
-        arcpy.analysis.Identity(intermediate_discretization_2, intermediate_discretization_1,
-                                intermediate_discretization_3, "NO_FID")
-
-        # Clip output from FeatureToPolygon because it can create excess polygons where holes in existing features
-        # exists with two vertices that are coincident. The newly created feature is not part of the original
-        # delineation or discretization and should be removed.
-        intermediate_discretization_4 = "intermediate_{}_4_clip".format(discretization_name)
-        arcpy.analysis.PairwiseClip(intermediate_discretization_3, delineation_name, intermediate_discretization_4)
-
-        assign_ids(intermediate_discretization_4, streams_feature_class, model)
-
-        # Process: Dissolve
-        tweet("Dissolving intermediate discretization feature class")
-        intermediate_discretization_5 = "intermediate_{}_5_dissolve".format(discretization_name)
-        arcpy.Dissolve_management(intermediate_discretization_4, intermediate_discretization_5, "Element_ID", "",
-                                  "MULTI_PART", "DISSOLVE_LINES")
-
-        arcpy.management.Copy(intermediate_discretization_5, discretization_feature_class)
-    else:
-        # Process: Dissolve
-        tweet("Dissolving intermediate discretization feature class")
-        intermediate_discretization_2 = "intermediate_{}_2_dissolve".format(discretization_name)
-        arcpy.Dissolve_management(intermediate_discretization_1, intermediate_discretization_2, "gridcode", "",
-                                  "MULTI_PART", "DISSOLVE_LINES")
-
-        assign_ids(intermediate_discretization_2, streams_feature_class, model)
-
-        arcpy.management.Copy(intermediate_discretization_2, discretization_feature_class)
+    # The traced polygons are already dissolved by gridcode, and for KINEROS2 already split into laterals
+    assign_ids(intermediate_discretization_1, streams_feature_class, model)
+    arcpy.management.Copy(intermediate_discretization_1, discretization_feature_class)
 
     tweet("Identifying contributing channels")
     identify_contributing_channels(workspace, delineation_name, discretization_name, streams_feature_class)
@@ -281,19 +190,67 @@ def discretize(workspace, discretization_name, save_intermediate_outputs):
     # TODO: Related to prior comment, address handling and reporting of errors
     if not save_intermediate_outputs:
         arcpy.Delete_management(intermediate_discretization_1)
-        arcpy.Delete_management(intermediate_discretization_2)
-        if intermediate_discretization_3:
-            arcpy.Delete_management(intermediate_discretization_3)
-        if intermediate_discretization_4:
-            arcpy.Delete_management(intermediate_discretization_4)
-        if intermediate_discretization_5:
-            arcpy.Delete_management(intermediate_discretization_5)
 
     # Set the output parameter so the discretization can be added to the map
     arcpy.SetParameter(8, discretization_feature_class)
     arcpy.SetParameter(9, streams_feature_class)
 
 
+def save_window_raster(values, lower_left, cell_width, cell_height, nodata, output_raster, spatial_reference):
+    """Save an array read over the delineation window as a raster aligned with the flow direction raster
+    : values - 2D array
+    : lower_left - arcpy.Point of the lower left corner of the window
+    : cell_width, cell_height - cell size in map units
+    : nodata - value of the NoData cells
+    : output_raster - output raster path
+    : spatial_reference - spatial reference assigned to the output
+    """
+    raster = arcpy.NumPyArrayToRaster(values, lower_left, cell_width, cell_height, nodata)
+    raster.save(output_raster)
+    arcpy.management.DefineProjection(output_raster, spatial_reference)
+
+
+def save_stream_network(network, direction, x_min, y_max, cell_width, cell_height, spatial_reference,
+                        streams_feature_class, nodes_feature_class):
+    """Write the links of a stream network to a streams feature class and their start points and outlets to a nodes
+    feature class, with the fields of StreamToFeature and FeatureVerticesToPoints
+    : network - dictionary from AGWA_StreamNetwork.extract_stream_network
+    : direction - 2D array of ESRI D8 codes the network was extracted from
+    : x_min, y_max - map coordinates of the top left corner of the arrays
+    : cell_width, cell_height - cell size in map units
+    : spatial_reference - spatial reference of the feature classes
+    : streams_feature_class, nodes_feature_class - output feature classes
+    """
+    stream_fields = ["arcid", "grid_code", "from_node", "to_node"]
+    for feature_class, geometry_type, fields in ((streams_feature_class, "POLYLINE", stream_fields),
+                                                 (nodes_feature_class, "POINT", stream_fields + ["ORIG_FID"])):
+        out_path, out_name = os.path.split(feature_class)
+        arcpy.management.CreateFeatureclass(out_path or arcpy.env.workspace, out_name, geometry_type,
+                                            spatial_reference=spatial_reference)
+        for field in fields:
+            arcpy.management.AddField(feature_class, field, "LONG")
+    arcpy.management.AddField(nodes_feature_class, "node_type", "TEXT")
+
+    outlet_links = set(network["outlet_links"].tolist())
+    outlet_rows = []
+    with arcpy.da.InsertCursor(streams_feature_class, ["SHAPE@"] + stream_fields) as streams_cursor, \
+            arcpy.da.InsertCursor(nodes_feature_class, ["SHAPE@"] + stream_fields + ["ORIG_FID", "node_type"]) \
+            as nodes_cursor:
+        for link in range(1, len(network["shreve"]) + 1):
+            rows, cols = AGWA_StreamNetwork.link_vertices(network, link, direction)
+            points = [arcpy.Point(float(x), float(y)) for x, y in zip(x_min + cols * cell_width,
+                                                                       y_max - rows * cell_height)]
+            attributes = (link, link, int(network["from_nodes"][link - 1]), int(network["to_nodes"][link - 1]))
+            streams_cursor.insertRow((arcpy.Polyline(arcpy.Array(points), spatial_reference),) + attributes)
+            nodes_cursor.insertRow((arcpy.PointGeometry(points[0], spatial_reference),) + attributes + (link, None))
+            if link in outlet_links:
+                outlet_rows.append((arcpy.PointGeometry(points[-1], spatial_reference),) + attributes +
+                                   (link, "outlet"))
+        # the outlet nodes follow the start nodes, as when they were added after FeatureVerticesToPoints
+        for outlet_row in outlet_rows:
+            nodes_cursor.insertRow(outlet_row)
+
+
 def assign_ids(discretization_feature_class, streams_feature_class, model):
     # Assign the element_ID to each element in the elements feature class
     # Elements ending in 0 are non-upland SWAT subwatersheds
@@ -317,84 +274,8 @@ def assign_ids(discretization_feature_class, streams_feature_class, model):
     if model == "SWAT":
         arcpy.management.CalculateField(discretization_feature_class, element_id_field, "!grid_code!", expression_type)
     else:
-        fields = ["SHAPE@", "GRIDCODE", "Element_ID"]
-        with arcpy.da.UpdateCursor(discretization_feature_class, fields) as element_cursor:
-            for element_row in element_cursor:
-                if element_row[1] % 2 == 1:
-                    element_row[2] = element_row[1]
-                else:
-                    element_poly = element_row[0]
-                    element_gridcode = element_row[1]
-                    stream_gridcode = element_gridcode / 10
-                    expression = "{0} = {1}".format(arcpy.AddFieldDelimiters(arcpy.env.workspace, "grid_code"),
-                                                    stream_gridcode)
-                    with arcpy.da.SearchCursor(streams_feature_class, "SHAPE@", expression) as stream_cursor:
-                        for stream_row in stream_cursor:
-                            stream_line = stream_row[0]
-                            stream_part = stream_line.getPart(0)
-                            if stream_part.count > 3:
-                                start_point = stream_part[1]
-                                end_point = stream_part[2]
-                            else:
-                                start_point = stream_line.positionAlongLine(0.49, True).getPart(0)
-                                end_point = stream_line.positionAlongLine(0.51, True).getPart(0)
-
-                            start_tpl = (start_point.X, start_point.Y)
-                            end_tpl = (end_point.X, end_point.Y)
-                            midpoint = ((start_tpl[0] + end_tpl[0]) / 2, (start_tpl[1] + end_tpl[1]) / 2)
-
-                            if start_tpl[0] == end_tpl[0]:
-                                # vertical line
-                                int_tpl = tuple(item1 + item2 for item1, item2 in zip(midpoint, (1, 0)))
-                            elif start_tpl[1] == end_tpl[1]:
-                                # horizontal line
-                                int_tpl = tuple(item1 + item2 for item1, item2 in zip(midpoint, (0, 1)))
-                            else:
-                                # normal slope
-                                slope = (end_tpl[1] - start_tpl[1]) / (end_tpl[0] - start_tpl[0])
-                                slope_perp_bisector = -1 / slope
-                                intercept_bisector = slope_perp_bisector * (-1) * midpoint[0] + midpoint[1]
-                                int_x = midpoint[0] + 1
-                                int_y = slope_perp_bisector * int_x + intercept_bisector
-                                int_tpl = (int_x, int_y)
-
-                            # the intersection point is calculated from the stream of derived from the polygon
-                            # so using the cross product will always return the same result on the same side of the
-                            # line
-                            # a = np.array([start_tpl[0] - int_tpl[0], start_tpl[1] - int_tpl[1], 0])
-                            # b = np.array([end_tpl[0] - int_tpl[0], end_tpl[1] - int_tpl[1], 0])
-                            # c = np.cross(a, b)
-                            # if c[2] > 0:
-                            #     print("Side is left")
-                            #     element_row[2] = element_gridcode + 3
-                            # else:
-                            #     print("Side is right")
-                            #     element_row[2] = element_gridcode + 2
-                            # print(c)
-
-                            # The intersection point is calculated to always be on the right side of the stream
-                            # so if the element polygon contains it, the polygon is on the right side of the stream too
-                            pg = arcpy.PointGeometry(arcpy.Point(int_tpl[0], int_tpl[1]), element_poly.spatialReference)
-                            result = stream_line.queryPointAndDistance(pg)
-                            (point, dist_along_line, dist_to_point, on_right) = result
-                            if on_right:
-                                # intersection point is on right side of line
-                                # if element_poly contains the point, it is also on the right side of the line
-                                # else it's on the left side of the line
-                                if element_poly.contains(pg):
-                                    element_row[2] = element_gridcode + 2
-                                else:
-                                    element_row[2] = element_gridcode + 3
-                            else:
-                                # intersection point is on left side of line
-                                # if element_poly contains the point, it is also on the left side of the line
-                                # else it's on the right side of the line
-                                if element_poly.contains(pg):
-                                    element_row[2] = element_gridcode + 3
-                                else:
-                                    element_row[2] = element_gridcode + 2
-
-                element_cursor.updateRow(element_row)
+        # The labels of KINEROS2 elements already end in 1, 2, or 3
+        arcpy.management.CalculateField(discretization_feature_class, element_id_field, "!gridcode!", expression_type)
 
     # Assign the stream_ID to each stream in the streams feature class
     tweet("Assigning Stream_ID to streams")
@@ -416,20 +297,24 @@ def identify_contributing_channels(workspace, delineation_name, discretization_n
         result = arcpy.management.CreateTable(out_path, out_name, template, config_keyword, out_alias)
         contributing_channels_table = result.getOutput(0)
 
+    # Read the stream topology once and join streams on node id in memory: a stream contributes to every stream
+    # whose from_node is equal to its to_node
+    streams_fields = ["from_node", "to_node", "Stream_ID"]
+    streams_by_to_node = {}
+    streams = []
+    with arcpy.da.SearchCursor(streams_feature_class, streams_fields) as streams_cursor:
+        for from_node, to_node, stream_id in streams_cursor:
+            streams.append((from_node, stream_id))
+            streams_by_to_node.setdefault(to_node, []).append(stream_id)
+
     creation_date = datetime.datetime.now()
-    streams_fields = ["from_node", "Stream_ID"]
+    contrib_rows = []
+    for from_node, stream_id in streams:
+        for contributing_stream_id in streams_by_to_node.get(from_node, []):
+            contrib_rows.append((delineation_name, discretization_name, stream_id, contributing_stream_id,
+                                 creation_date))
+
     contrib_fields = ["DelineationName", "DiscretizationName", "StreamID", "ContributingStream", "CreationDate"]
-    # expression = "{0} = '{1}' AND {2} = '{3}'".format(arcpy.AddFieldDelimiters(workspace, "to_node"), missing_to_node)
-    with arcpy.da.SearchCursor(streams_feature_class, streams_fields) as streams_cursor:
-        for stream_row in streams_cursor:
-            from_node = stream_row[0]
-            stream_id = stream_row[1]
-
-            to_node_field = arcpy.AddFieldDelimiters(workspace, "to_node")
-            inner_expression = "{0} = {1}".format(to_node_field, from_node)
-            with arcpy.da.SearchCursor(streams_feature_class, streams_fields, inner_expression) as inner_streams_cursor:
-                for inner_stream_row in inner_streams_cursor:
-                    inner_stream_id = inner_stream_row[1]
-                    with arcpy.da.InsertCursor(contributing_channels_table, contrib_fields) as contrib_cursor:
-                        contrib_cursor.insertRow((delineation_name, discretization_name, stream_id, inner_stream_id,
-                                                 creation_date))
+    with arcpy.da.InsertCursor(contributing_channels_table, contrib_fields) as contrib_cursor:
+        for contrib_row in contrib_rows:
+            contrib_cursor.insertRow(contrib_row)
@@ -0,0 +1,106 @@
+import arcpy
+import os
+import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+
+def tweet(msg):
+    """Produce a message for both arcpy and python
+    : msg - a text message
+    """
+    m = "\n{}\n".format(msg)
+    arcpy.AddMessage(m)
+    print(m)
+    print(arcpy.GetMessages())
+
+
+def execute_simulations(workspace, simulation_directories, max_workers=None):
+    """Run K2 in batch mode for each simulation directory and record the outcome of each run in metaSimulation
+    : workspace - AGWA workspace geodatabase
+    : simulation_directories - list of simulation directories containing k2.exe and kin.fil
+    : max_workers - number of simulations run at the same time, defaults to the number of processors
+    """
+    if not max_workers:
+        max_workers = os.cpu_count() or 1
+    max_workers = max(1, min(int(max_workers), len(simulation_directories)))
+
+    tweet(f"Executing {len(simulation_directories)} simulation(s) with up to {max_workers} at a time")
+    results = {}
+    # each worker only waits on its k2 process, so threads are enough to keep every processor busy
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(execute_simulation, simulation_directory)
+                   for simulation_directory in simulation_directories]
+        for future in as_completed(futures):
+            result = future.result()
+            results[result["SimulationPath"]] = result
+            tweet(f"{os.path.split(result['SimulationPath'])[1]}: {result['Status']}")
+
+    update_simulation_status(workspace, results)
+
+    failed_count = len([result for result in results.values() if result["ReturnCode"] != 0])
+    if failed_count > 0:
+        arcpy.AddWarning(f"{failed_count} of {len(results)} simulation(s) did not complete successfully.")
+
+    return results
+
+
+def execute_simulation(simulation_directory):
+    """Run 'k2 -b' in a simulation directory and capture its exit code, wall time, and output
+    The console output is saved to k2_run.log in the simulation directory.
+    : simulation_directory - directory containing k2.exe and kin.fil
+    """
+    k2_path = os.path.join(simulation_directory, "k2.exe")
+    log_path = os.path.join(simulation_directory, "k2_run.log")
+
+    start_time = time.perf_counter()
+    try:
+        process = subprocess.run([k2_path, "-b"], cwd=simulation_directory, capture_output=True, text=True,
+                                 stdin=subprocess.DEVNULL)
+        return_code = process.returncode
+        stdout = process.stdout
+        stderr = process.stderr
+    except OSError as e:
+        return_code = -1
+        stdout = ""
+        stderr = str(e)
+    wall_time = time.perf_counter() - start_time
+
+    with open(log_path, "w") as log_file:
+        log_file.write(f"Command: {k2_path} -b\n")
+        log_file.write(f"Exit code: {return_code}\n")
+        log_file.write(f"Wall time (s): {wall_time:.2f}\n")
+        log_file.write("\n--- stdout ---\n")
+        log_file.write(stdout or "")
+        log_file.write("\n--- stderr ---\n")
+        log_file.write(stderr or "")
+
+    if return_code == 0:
+        status = f"Simulation executed successfully in {wall_time:.1f} seconds."
+    else:
+        status = f"!! Simulation failed with exit code {return_code} after {wall_time:.1f} seconds. See {log_path}."
+
+    return {"SimulationPath": simulation_directory, "ReturnCode": return_code, "WallTime": wall_time,
+            "Stdout": stdout, "Stderr": stderr, "Status": status}
+
+
+def update_simulation_status(workspace, results):
+    """Write the status of executed simulations to metaSimulation
+    : workspace - AGWA workspace geodatabase
+    : results - dictionary of simulation path to the result returned by execute_simulation
+    """
+    meta_simulation_table = os.path.join(workspace, "metaSimulation")
+    if not arcpy.Exists(meta_simulation_table):
+        tweet(f"The table '{meta_simulation_table}' does not exist, so the simulation status was not recorded.")
+        return
+
+    results_by_path = {os.path.normcase(os.path.normpath(path)): result for path, result in results.items()}
+    fields = ["SimulationPath", "Status"]
+    with arcpy.da.UpdateCursor(meta_simulation_table, fields) as cursor:
+        for row in cursor:
+            if row[0] is None:
+                continue
+            result = results_by_path.get(os.path.normcase(os.path.normpath(row[0])))
+            if result is not None:
+                row[1] = result["Status"]
+                cursor.updateRow(row)
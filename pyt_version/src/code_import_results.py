@@ -1,9 +1,13 @@
 import arcpy
 import arcpy.management
 import math
+import numpy as np
 import os
 from pathlib import Path
 import datetime
+import AGWA_TimeSeriesStore
+import importlib
+importlib.reload(AGWA_TimeSeriesStore)
 
 
 def tweet(msg):
@@ -28,21 +32,10 @@ def import_k2_results(workspace, delineation_name, discretization_name, paramete
         tweet(f"Results file geodatabase already exists: {results_gdb_name}")
 
     results_table = os.path.join(results_gdb_abspath, "results_k2")
-    results_fields = ["DelineationName", "DiscretizationName", "ParameterizationName", "SimulationName", "OutFileName",
-                      "Element_ID", "Element_Type", "Element_Area_Metric", "Cumulated_Area_Metric", "Inflow_Metric",
-                      "Rainfall_Metric", "Outflow_Metric", "Peak_Flow_Metric", "Peak_Flow_Elapsed_Time",
-                      "Peak_Sediment_Metric", "Peak_Sediment_Elapsed_Time", "Total_Infiltration_Metric",
-                      "Initial_Water_Content", "Sediment_Yield_Metric", "CreationDate", "AGWAVersionAtCreation",
-                      "AGWAGDBVersionAtCreation", "Status"]
-
     creation_date = datetime.datetime.now()
     agwa_version_at_creation = ""
     agwa_gdb_version_at_creation = ""
 
-    plane_search = "    Plane"
-    channel_search = "  Channel"
-    pond_search = "     Pond"
-
     # open kin.fil to get simulation inputs
     # TODO: Test batch simulations where each line in the runfile is a simulation
     runfile_abspath = os.path.join(simulation_abspath, "kin.fil")
@@ -70,109 +63,165 @@ def import_k2_results(workspace, delineation_name, discretization_name, paramete
                 arcpy.management.DeleteRows(in_rows=result.getOutput(0))
 
             # TODO: validate file is complete and error free before proceeding?
-            with arcpy.da.InsertCursor(results_table, results_fields) as elements_cursor:
-                with open(outfile_abspath, "r") as outfile:
-                    tweet(f"Out file opened: {out_name}")
-                    # store peak flow time and peak sediment discharge time in a dictionary to query when inserting rows
-                    peak_flow_times = {}
-                    peak_sediment_times = {}
-                    for line in outfile:
-                        if " Plane Element     " in line:
-                            element_id = line.split()[-1]
-                            read_block = True
-                            while read_block:
-                                block_line = next(outfile, False)
-                                if not block_line:
-                                    read_block = False
-                                else:
-                                    if "Peak flow = " in block_line:
-                                        time = block_line.split()[-2]
-                                        peak_flow_times[int(element_id)] = time
-                                    elif "Peak sediment discharge = " in block_line:
-                                        peak_sediment_discharge = block_line.split()[-5]
-                                        units = block_line.split()[-4]
-                                        # TODO: confirm units are always kg/s, if not then conversion is necessary
-                                        # if units != "kg/s":
-                                        time = block_line.split()[-2]
-                                        peak_sediment_times[int(element_id)] = [peak_sediment_discharge, time]
-                                        read_block = False
-                        elif " Channel Elem.     " in line:
-                            stream_id = line.split()[-1]
-                            read_block = True
-                            while read_block:
-                                block_line = next(outfile, False)
-                                if not block_line:
-                                    read_block = False
-                                else:
-                                    if "Peak flow = " in block_line:
-                                        time = block_line.split()[-2]
-                                        peak_flow_times[int(stream_id)] = time
-                                    elif "Peak sediment discharge = " in block_line:
-                                        peak_sediment_discharge = block_line.split()[-5]
-                                        units = block_line.split()[-4]
-                                        # TODO: confirm units are always kg/s, if not then conversion is necessary
-                                        # if units != "kg/s":
-                                        time = block_line.split()[-2]
-                                        peak_sediment_times[int(stream_id)] = [peak_sediment_discharge, time]
-                                        read_block = False
-                        elif " Pond Element     " in line:
-                            pond_id = line.split()[-1]
-                            read_block = True
-                            while read_block:
-                                block_line = next(outfile, False)
-                                if not block_line:
-                                    read_block = False
-                                else:
-                                    if "Peak flow = " in block_line:
-                                        time = block_line.split()[-2]
-                                        peak_flow_times[int(pond_id)] = time
-                                    elif "Peak sediment discharge = " in block_line:
-                                        peak_sediment_discharge = block_line.split()[-5]
-                                        units = block_line.split()[-4]
-                                        # TODO: confirm units are always kg/s, if not then conversion is necessary
-                                        # if units != "kg/s":
-                                        time = block_line.split()[-2]
-                                        peak_sediment_times[int(pond_id)] = [peak_sediment_discharge, time]
-                                        read_block = False
-                        elif "Tabular Summary of Element Hydrologic Components" in line:
-                            # Increment the lines to the start of the tabular data
-                            for x in range(4):
-                                next(outfile)
-                            read_tabular = True
-                            while read_tabular:
-                                tabular_line = next(outfile, False)
-                                if not tabular_line:
-                                    read_tabular = False
-                                else:
-                                    tabular_search = any(x not in tabular_line for x in (plane_search, channel_search, pond_search))
-                                    if tabular_search:
-                                        next_line_list = tabular_line.split()
-                                        (element_id, element_type, element_area, cumulated_area, inflow, rainfall,
-                                         outflow, peak_flow, total_infil, initial_water_content,
-                                         sediment_yield) = next_line_list
-                                        # new_row = [DelineationName, DiscretizationName, ParameterizationName,
-                                        #            element_id, Element_Type, Element_Area_Metric, Cumulated_Area_Metric,
-                                        #            Inflow_Metric, Rainfall_Metric, Outflow_Metric, Peak_Flow_Metric,
-                                        #            Peak_Flow_Elapsed_Minutes, Peak_Sediment_Metric,
-                                        #            Peak_Sediment_Elapsed_Time, Total_Infiltration_Metric,
-                                        #            Initial_Water_Content, Sediment_Yield_Metric, CreationDate,
-                                        #            AGWAVersionAtCreation, AGWAGDBVersionAtCreation, Status]
-
-                                        status = "Import successful"
-                                        new_row = (delineation_name, discretization_name, parameterization_name,
-                                                   simulation_name, out_name, int(element_id), element_type,
-                                                   float(element_area), float(cumulated_area), float(inflow),
-                                                   float(rainfall), float(outflow), float(peak_flow),
-                                                   float(peak_flow_times[int(element_id)]),
-                                                   float(peak_sediment_times[int(element_id)][0]),
-                                                   float(peak_sediment_times[int(element_id)][1]),
-                                                   float(total_infil), float(initial_water_content),
-                                                   float(sediment_yield), creation_date, agwa_version_at_creation,
-                                                   agwa_gdb_version_at_creation, status)
-                                        # new_row = [int(element_id)]
-                                        elements_cursor.insertRow(new_row)
-
-                    tweet(f"'{simulation_name}' simulation with '{out_name}' results file imported successfully!")
+            tweet(f"Out file opened: {out_name}")
+            results = read_k2_output(outfile_abspath)
+            append_k2_results(results_table, results, (delineation_name, discretization_name, parameterization_name,
+                                                       simulation_name, out_name, creation_date,
+                                                       agwa_version_at_creation, agwa_gdb_version_at_creation,
+                                                       "Import successful"))
+
+            tweet(f"'{simulation_name}' simulation with '{out_name}' results file imported successfully!")
+
+
+# parser states for iterate_k2_output
+SEARCHING = 0
+ELEMENT_BLOCK = 1
+SUMMARY_HEADER = 2
+SUMMARY = 3
+
+ELEMENT_HEADERS = (" Plane Element     ", " Channel Elem.     ", " Pond Element     ")
+SUMMARY_TITLE = "Tabular Summary of Element Hydrologic Components"
+SUMMARY_HEADER_LINES = 4
+SUMMARY_COLUMNS = ("Element_ID", "Element_Type", "Element_Area_Metric", "Cumulated_Area_Metric", "Inflow_Metric",
+                   "Rainfall_Metric", "Outflow_Metric", "Peak_Flow_Metric", "Total_Infiltration_Metric",
+                   "Initial_Water_Content", "Sediment_Yield_Metric")
+
+
+def iterate_k2_output(lines):
+    """Parse the lines of a K2 .out file in a single pass
+    Yields ("peak_flow", element_id, elapsed_time), ("peak_sediment", element_id, discharge, elapsed_time), and
+    ("summary", tokens) records, where tokens are the fields of a row of the tabular summary.
+    : lines - iterable of the lines of the .out file
+    """
+    state = SEARCHING
+    element_id = None
+    header_lines_remaining = 0
+    for line in lines:
+        if state == SUMMARY:
+            tokens = line.split()
+            if len(tokens) == len(SUMMARY_COLUMNS) and tokens[0].isdigit():
+                yield "summary", tokens
+        elif state == ELEMENT_BLOCK:
+            if "Peak flow = " in line:
+                yield "peak_flow", element_id, line.split()[-2]
+            elif "Peak sediment discharge = " in line:
+                tokens = line.split()
+                # TODO: confirm units in tokens[-4] are always kg/s, if not then conversion is necessary
+                yield "peak_sediment", element_id, tokens[-5], tokens[-2]
+                state = SEARCHING
+            elif SUMMARY_TITLE in line:
+                # the last element block has no peak sediment line when sediment is not simulated
+                header_lines_remaining = SUMMARY_HEADER_LINES
+                state = SUMMARY_HEADER
+            elif any(header in line for header in ELEMENT_HEADERS):
+                element_id = int(line.split()[-1])
+        elif state == SUMMARY_HEADER:
+            header_lines_remaining -= 1
+            if header_lines_remaining == 0:
+                state = SUMMARY
+        elif SUMMARY_TITLE in line:
+            header_lines_remaining = SUMMARY_HEADER_LINES
+            state = SUMMARY_HEADER
+        elif any(header in line for header in ELEMENT_HEADERS):
+            element_id = int(line.split()[-1])
+            state = ELEMENT_BLOCK
+
+
+def read_k2_output(outfile_abspath):
+    """Read the tabular summary and the peak flow and peak sediment times of a K2 .out file into columnar arrays
+    Returns a dictionary of results_k2 field name to array, with one entry per row of the tabular summary.
+    : outfile_abspath - path of the .out file
+    """
+    peak_flow_times = {}
+    peak_sediment = {}
+    summary_rows = []
+    with open(outfile_abspath, "r") as outfile:
+        for record in iterate_k2_output(outfile):
+            if record[0] == "summary":
+                summary_rows.append(record[1])
+            elif record[0] == "peak_flow":
+                peak_flow_times[record[1]] = record[2]
+            else:
+                peak_sediment[record[1]] = (record[2], record[3])
+
+    if not summary_rows:
+        msg = "Cannot proceed. \nThe out file '{}' has no tabular summary rows to import.".format(outfile_abspath)
+        tweet(msg)
+        raise Exception(msg)
+    summary = list(zip(*summary_rows))
+    columns = {}
+    for name, values in zip(SUMMARY_COLUMNS, summary):
+        if name == "Element_ID":
+            columns[name] = np.array(values, dtype=np.int32)
+        elif name == "Element_Type":
+            columns[name] = np.array(values, dtype=str)
+        else:
+            columns[name] = np.array(values, dtype=np.float64)
+
+    # elements without a peak in the element blocks are left as NaN, which is written as null
+    element_ids = columns["Element_ID"].tolist()
+    columns["Peak_Flow_Elapsed_Time"] = np.array([peak_flow_times.get(element_id, "nan")
+                                                  for element_id in element_ids], dtype=np.float64)
+    columns["Peak_Sediment_Metric"] = np.array([peak_sediment.get(element_id, ("nan", "nan"))[0]
+                                                for element_id in element_ids], dtype=np.float64)
+    columns["Peak_Sediment_Elapsed_Time"] = np.array([peak_sediment.get(element_id, ("nan", "nan"))[1]
+                                                      for element_id in element_ids], dtype=np.float64)
+
+    return columns
+
+
+def append_k2_results(results_table, columns, row_values):
+    """Append parsed K2 results to the results table in one operation
+    : results_table - results_k2 table of the results geodatabase
+    : columns - dictionary of field name to array from read_k2_output
+    : row_values - values shared by every row: (DelineationName, DiscretizationName, ParameterizationName,
+      SimulationName, OutFileName, CreationDate, AGWAVersionAtCreation, AGWAGDBVersionAtCreation, Status)
+    """
+    row_count = len(columns["Element_ID"])
+    shared_fields = ["DelineationName", "DiscretizationName", "ParameterizationName", "SimulationName",
+                     "OutFileName", "CreationDate", "AGWAVersionAtCreation", "AGWAGDBVersionAtCreation", "Status"]
+    dtype = []
+    for field, value in zip(shared_fields, row_values):
+        if field == "CreationDate":
+            dtype.append((field, "<M8[us]"))
+        else:
+            dtype.append((field, "<U{}".format(max(1, len(str(value))))))
+    for field, values in columns.items():
+        dtype.append((field, values.dtype))
+
+    records = np.empty(row_count, dtype=dtype)
+    for field, value in zip(shared_fields, row_values):
+        records[field] = np.datetime64(value, "us") if field == "CreationDate" else str(value)
+    for field, values in columns.items():
+        records[field] = values
+
+    import_table = "memory\\results_k2_import"
+    if arcpy.Exists(import_table):
+        arcpy.management.Delete(import_table)
+    arcpy.da.NumPyArrayToTable(records, import_table)
+    try:
+        arcpy.management.Append(import_table, results_table, "NO_TEST")
+    finally:
+        arcpy.management.Delete(import_table)
+
+
+def import_k2_time_series(simulation_abspath, max_workers=None):
+    """Parse the plane and channel .sim files of a simulation into its time series store
+    The store is written to {simulation}_timeseries.agts in the simulation directory and read with
+    AGWA_TimeSeriesStore.TimeSeriesStore.
+    : simulation_abspath - K2 simulation directory
+    : max_workers - number of worker processes, defaults to the number of processors
+    """
+    sim_name = os.path.split(simulation_abspath)[1]
+    store_path = os.path.join(simulation_abspath, f"{sim_name}_timeseries.agts")
+    tweet(f"Importing element time series into {os.path.basename(store_path)}")
+    element_count = AGWA_TimeSeriesStore.build_store(simulation_abspath, store_path, max_workers)
+    if element_count == 0:
+        tweet("No element .sim files were found in the planes or channels directories.")
+    else:
+        tweet(f"Time series of {element_count} elements imported successfully!")
+
+    return store_path
 
 
 def update_field_aliases(elements_results_table):
@@ -2,9 +2,13 @@
 import arcpy
 import arcpy.management  # Import statement added to provide intellisense in PyCharm
 import os
+import math
 import datetime
 from enum import Enum
 from collections import deque
+import AGWA_ZonalEngine
+import importlib
+importlib.reload(AGWA_ZonalEngine)
 
 # Check out any necessary licenses
 arcpy.CheckOutExtension("spatial")
@@ -166,21 +170,9 @@ def parameterize(workspace, discretization, parameterization_name, save_intermed
     calculate_element_areas(workspace, delineation_name, discretization, parameterization_name,
                             save_intermediate_outputs)
 
-    tweet("Calculating mean elevation")
-    calculate_mean_elevation(workspace, delineation_name, discretization, parameterization_name,
-                             unfilled_dem_raster, save_intermediate_outputs)
-
-    tweet("Calculating mean slope")
-    calculate_mean_slope(workspace, delineation_name, discretization, parameterization_name, slope_raster,
-                         save_intermediate_outputs)
-
-    tweet("Calculating mean aspect")
-    calculate_mean_aspect(workspace, delineation_name, discretization, parameterization_name, aspect_raster,
-                          save_intermediate_outputs)
-
-    tweet("Calculating mean flow length")
-    calculate_mean_flow_length(workspace, delineation_name, discretization, parameterization_name,
-                               save_intermediate_outputs)
+    tweet("Calculating mean elevation, slope, aspect, and flow length")
+    calculate_zonal_statistics(workspace, delineation_name, discretization, parameterization_name,
+                               unfilled_dem_raster, slope_raster, aspect_raster, save_intermediate_outputs)
 
     tweet("Calculating element centroids")
     calculate_centroids(workspace, delineation_name, discretization, parameterization_name, save_intermediate_outputs)
@@ -241,111 +233,31 @@ def populate_parameter_tables(workspace, delineation_name, discretization_name,
                                              stream_id))
 
 
-def calculate_mean_elevation(workspace, delineation_name, discretization_name, parameterization_name, dem_raster,
-                             save_intermediate_outputs):
-    arcpy.env.workspace = workspace
-
-    parameters_elements_table = os.path.join(workspace, "parameters_elements")
-    discretization_feature_class = os.path.join(workspace, "{}_elements".format(discretization_name))
-    zone_field = "Element_ID"
-    value_raster = dem_raster
-    zonal_table = "intermediate_{}_meanElevation".format(discretization_name)
-    arcpy.sa.ZonalStatisticsAsTable(discretization_feature_class, zone_field, value_raster, zonal_table, "DATA",
-                                    "MEAN")
-
-    table_view = "parameters_elements"
-    delineation_name_field = arcpy.AddFieldDelimiters(workspace, "DelineationName")
-    discretization_name_field = arcpy.AddFieldDelimiters(workspace, "DiscretizationName")
-    parameterization_name_field = arcpy.AddFieldDelimiters(workspace, "ParameterizationName")
-    expression = "{0} = '{1}' And {2} = '{3}' And {4} = '{5}'".format(delineation_name_field, delineation_name,
-                                                                      discretization_name_field,
-                                                                      discretization_name,
-                                                                      parameterization_name_field,
-                                                                      parameterization_name)
-    arcpy.management.MakeTableView(parameters_elements_table, table_view, expression)
-    arcpy.management.AddJoin(table_view, "ElementID", zonal_table, "Element_ID")
-    mean_elevation_field = "{}.MeanElevation".format(table_view)
-    zonal_mean_field = "!{}.MEAN!".format(zonal_table)
-    arcpy.management.CalculateField(table_view, mean_elevation_field, zonal_mean_field)
-    arcpy.management.RemoveJoin(table_view, zonal_table)
-
-    if not save_intermediate_outputs:
-        arcpy.Delete_management(zonal_table)
-
-
-def calculate_mean_slope(workspace, delineation_name, discretization_name, parameterization_name, slope_raster,
-                         save_intermediate_outputs):
+def calculate_zonal_statistics(workspace, delineation_name, discretization_name, parameterization_name, dem_raster,
+                               slope_raster, aspect_raster, save_intermediate_outputs):
+    # Rasterize the elements once and compute the mean elevation, slope, aspect, and flow length of every element
+    # from the same label array instead of running Zonal Statistics as Table and a join for each value raster
     parameters_elements_table = os.path.join(workspace, "parameters_elements")
     discretization_feature_class = os.path.join(workspace, "{}_elements".format(discretization_name))
-    zone_field = "Element_ID"
-    value_raster = slope_raster
-    zonal_table = "intermediate_{}_meanSlope".format(discretization_name)
-    arcpy.sa.ZonalStatisticsAsTable(discretization_feature_class, zone_field, value_raster, zonal_table, "DATA",
-                                    "MEAN")
-
-    table_view = "parameters_elements"
-    delineation_name_field = arcpy.AddFieldDelimiters(workspace, "DelineationName")
-    discretization_name_field = arcpy.AddFieldDelimiters(workspace, "DiscretizationName")
-    parameterization_name_field = arcpy.AddFieldDelimiters(workspace, "ParameterizationName")
-    expression = "{0} = '{1}' And {2} = '{3}' And {4} = '{5}'".format(delineation_name_field, delineation_name,
-                                                                      discretization_name_field,
-                                                                      discretization_name,
-                                                                      parameterization_name_field,
-                                                                      parameterization_name)
-    arcpy.management.MakeTableView(parameters_elements_table, table_view, expression)
-    arcpy.management.AddJoin(table_view, "ElementID", zonal_table, "Element_ID")
-    mean_slope_field = "{}.MeanSlope".format(table_view)
-    zonal_mean_field = "!{}.MEAN!".format(zonal_table)
-    arcpy.management.CalculateField(table_view, mean_slope_field, zonal_mean_field)
-    arcpy.management.RemoveJoin(table_view, zonal_table)
-
-    if not save_intermediate_outputs:
-        arcpy.Delete_management(zonal_table)
-
-
-def calculate_mean_aspect(workspace, delineation_name, discretization_name, parameterization_name, aspect_raster,
-                          save_intermediate_outputs):
-    parameters_elements_table = os.path.join(workspace, "parameters_elements")
-    discretization_feature_class = os.path.join(workspace, "{}_elements".format(discretization_name))
-    zone_field = "Element_ID"
-    value_raster = aspect_raster
-    zonal_table = "intermediate_{}_meanAspect".format(discretization_name)
-    arcpy.sa.ZonalStatisticsAsTable(discretization_feature_class, zone_field, value_raster, zonal_table, "DATA",
-                                    "MEAN")
-
-    table_view = "parameters_elements"
-    delineation_name_field = arcpy.AddFieldDelimiters(workspace, "DelineationName")
-    discretization_name_field = arcpy.AddFieldDelimiters(workspace, "DiscretizationName")
-    parameterization_name_field = arcpy.AddFieldDelimiters(workspace, "ParameterizationName")
-    expression = "{0} = '{1}' And {2} = '{3}' And {4} = '{5}'".format(delineation_name_field, delineation_name,
-                                                                      discretization_name_field,
-                                                                      discretization_name,
-                                                                      parameterization_name_field,
-                                                                      parameterization_name)
-    arcpy.management.MakeTableView(parameters_elements_table, table_view, expression)
-    arcpy.management.AddJoin(table_view, "ElementID", zonal_table, "Element_ID")
-    mean_aspect_field = "{}.MeanAspect".format(table_view)
-    zonal_mean_field = "!{}.MEAN!".format(zonal_table)
-    arcpy.management.CalculateField(table_view, mean_aspect_field, zonal_mean_field)
-    arcpy.management.RemoveJoin(table_view, zonal_table)
-
-    if not save_intermediate_outputs:
-        arcpy.Delete_management(zonal_table)
+    flow_length_down_raster = os.path.join(workspace, "{}_flow_length_downstream".format(discretization_name))
+    elements_raster = os.path.join(workspace, "intermediate_{}_elements_raster".format(discretization_name))
 
+    grid = AGWA_ZonalEngine.rasterize_zones(discretization_feature_class, "Element_ID", dem_raster, elements_raster)
+    zone_ids, zone_index = AGWA_ZonalEngine.index_zones(grid.labels, grid.nodata)
 
-def calculate_mean_flow_length(workspace, delineation_name, discretization_name, parameterization_name,
-                               save_intermediate_outputs):
+    value_rasters = {"MeanElevation": dem_raster,
+                     "MeanSlope": slope_raster,
+                     "MeanAspect": aspect_raster,
+                     "MeanFlowLength": flow_length_down_raster}
+    value_arrays = {}
+    for field, value_raster in value_rasters.items():
+        value_arrays[field] = AGWA_ZonalEngine.read_aligned(value_raster, grid)
+    statistics = AGWA_ZonalEngine.zonal_statistics(zone_index, len(zone_ids), value_arrays, ["MEAN"])
 
-    parameters_elements_table = os.path.join(workspace, "parameters_elements")
-    discretization_feature_class = os.path.join(workspace, "{}_elements".format(discretization_name))
-    flow_length_down_raster = os.path.join(workspace, "{}_flow_length_downstream".format(discretization_name))
-    zone_field = "Element_ID"
-    value_raster = flow_length_down_raster
-    zonal_table = "intermediate_{}_mean_flow_length_downstream".format(discretization_name)
-    arcpy.sa.ZonalStatisticsAsTable(discretization_feature_class, zone_field, value_raster, zonal_table, "DATA",
-                                    "MEAN")
+    element_means = {}
+    for position, element_id in enumerate(zone_ids):
+        element_means[int(element_id)] = [statistics[field]["MEAN"][position] for field in value_rasters]
 
-    table_view = "parameters_elements"
     delineation_name_field = arcpy.AddFieldDelimiters(workspace, "DelineationName")
     discretization_name_field = arcpy.AddFieldDelimiters(workspace, "DiscretizationName")
     parameterization_name_field = arcpy.AddFieldDelimiters(workspace, "ParameterizationName")
@@ -354,15 +266,18 @@ def calculate_mean_flow_length(workspace, delineation_name, discretization_name,
                                                                       discretization_name,
                                                                       parameterization_name_field,
                                                                       parameterization_name)
-    arcpy.management.MakeTableView(parameters_elements_table, table_view, expression)
-    arcpy.management.AddJoin(table_view, "ElementID", zonal_table, "Element_ID")
-    mean_flow_length_field = "{}.MeanFlowLength".format(table_view)
-    zonal_mean_field = "!{}.MEAN!".format(zonal_table)
-    arcpy.management.CalculateField(table_view, mean_flow_length_field, zonal_mean_field)
-    arcpy.management.RemoveJoin(table_view, zonal_table)
+    fields = ["ElementID"] + list(value_rasters)
+    with arcpy.da.UpdateCursor(parameters_elements_table, fields, expression) as cursor:
+        for row in cursor:
+            means = element_means.get(row[0])
+            if means is None:
+                # the element is too small to contain a cell center, so it has no zonal statistics
+                continue
+            row[1:] = [None if math.isnan(mean) else float(mean) for mean in means]
+            cursor.updateRow(row)
 
     if not save_intermediate_outputs:
-        arcpy.Delete_management(zonal_table)
+        arcpy.Delete_management(elements_raster)
 
 
 def calculate_centroids(workspace, delineation_name, discretization_name, parameterization_name,
@@ -526,17 +441,19 @@ def calculate_stream_sequence(workspace, delineation_name, discretization_name,
     # TODO: Replace function comments with docstring style comments
     # Outlet stream has highest sequence
     # Identify outlet using discretization nodes feature class where node_type = 'outlet'
-    # Query for stream outlet and push on to unprocessedStack
+    # Read contributing_channels once into an adjacency index of streamID -> contributing streams
+    # Push stream outlet on to unprocessedStack
     # While unprocessedStack is not empty
     #   peek at unprocessedStack to get streamID
-    #   If channelsList has current streamID
+    #   If visited set has current streamID
     #       push stream ID on to processedStack
-    #   Add streamID to channelsList
-    #   query for streams contributing to streamID
+    #   Add streamID to visited set
+    #   look up streams contributing to streamID in the adjacency index
     #       If no contributing streams
     #           push top of unprocessedStack onto processedStack
     #       while contributing streams
     #           push contributing stream onto unProcessedStack
+    # Write the sequence of every stream with one update cursor
 
     discretization_nodes = "{}_nodes".format(discretization_name)
     nodes_feature_class = os.path.join(workspace, discretization_nodes)
@@ -560,7 +477,6 @@ def calculate_stream_sequence(workspace, delineation_name, discretization_name,
 
     discretization_streams = "{}_streams".format(discretization_name)
     streams_feature_class = os.path.join(workspace, discretization_streams)
-    stream_count = int(arcpy.management.GetCount(streams_feature_class).getOutput(0))
     fields = ["Stream_ID"]
     stream_id = None
     with arcpy.da.SearchCursor(streams_feature_class, fields, expression) as streams_cursor:
@@ -574,168 +490,133 @@ def calculate_stream_sequence(workspace, delineation_name, discretization_name,
     expression = "{0} = '{1}' And {2} = '{3}'".format(delineation_name_field, delineation_name,
                                                       discretization_name_field, discretization_name)
 
-    contrib_table_view = "{}_tableview".format(contributing_channels_table_name)
-    arcpy.management.MakeTableView(contributing_channels_table, contrib_table_view, expression)
-    stream_id_field = arcpy.AddFieldDelimiters(workspace, "StreamID")
-    fields = ["ContributingStream"]
+    contributing_streams = {}
+    fields = ["StreamID", "ContributingStream"]
+    with arcpy.da.SearchCursor(contributing_channels_table, fields, expression) as contrib_cursor:
+        for contrib_row in contrib_cursor:
+            contributing_streams.setdefault(contrib_row[0], []).append(contrib_row[1])
+
     unprocessed_stack = deque()
     unprocessed_stack.append(stream_id)
     processed_stack = deque()
-    streams_list = []
+    visited_streams = set()
     while unprocessed_stack:
         stream_id = unprocessed_stack[-1]
-        if stream_id in streams_list:
+        if stream_id in visited_streams:
             processed_stream = unprocessed_stack.pop()
             processed_stack.append(processed_stream)
             continue
 
-        streams_list.append(stream_id)
+        visited_streams.add(stream_id)
 
-        expression = "{0} = {1}".format(stream_id_field, stream_id)
-        with arcpy.da.SearchCursor(contrib_table_view, fields, expression) as contrib_cursor:
-            contrib_row = None
-            for contrib_row in contrib_cursor:
-                contributing_stream_id = contrib_row[0]
-                unprocessed_stack.append(contributing_stream_id)
-            if contrib_row is None:
-                # No contributing streams so add to the processed stack
-                processed_stream = unprocessed_stack.pop()
-                processed_stack.append(processed_stream)
+        contributing_stream_ids = contributing_streams.get(stream_id)
+        if contributing_stream_ids:
+            unprocessed_stack.extend(contributing_stream_ids)
+        else:
+            # No contributing streams so add to the processed stack
+            processed_stream = unprocessed_stack.pop()
+            processed_stack.append(processed_stream)
 
     # The processed_stack is now in order with the watershed outlet stream at the top of the stack
+    sequences = {stream_id: sequence for sequence, stream_id in enumerate(processed_stack, start=1)}
+
     table_name = "parameters_streams"
     parameters_streams_table = os.path.join(workspace, table_name)
     parameterization_name_field = arcpy.AddFieldDelimiters(workspace, "ParameterizationName")
-    fields = ["Sequence"]
-    for sequence in range(1, stream_count+1):
-        stream_id = processed_stack.popleft()
-        expression = "{0} = '{1}' And {2} = {3}".format(parameterization_name_field, parameterization_name,
-                                                        stream_id_field, stream_id)
-        with arcpy.da.UpdateCursor(parameters_streams_table, fields, expression) as cursor:
-            for row in cursor:
-                row[0] = sequence
+    expression = "{0} = '{1}' And {2} = '{3}' And {4} = '{5}'".format(delineation_name_field, delineation_name,
+                                                                      discretization_name_field,
+                                                                      discretization_name,
+                                                                      parameterization_name_field,
+                                                                      parameterization_name)
+    fields = ["StreamID", "Sequence"]
+    with arcpy.da.UpdateCursor(parameters_streams_table, fields, expression) as cursor:
+        for row in cursor:
+            sequence = sequences.get(row[0])
+            if sequence is not None:
+                row[1] = sequence
                 cursor.updateRow(row)
 
-    arcpy.management.Delete(contrib_table_view)
-
 
 def calculate_contributing_area_k2(workspace, delineation_name, discretization_name, parameterization_name,
                                    save_intermediate_outputs):
     # TODO: Replace function comments with docstring style comments
     # Calculate contributing areas by starting at the top of the watershed
     # and moving towards the outlet
-    # Iterate through parameters_streams by sequence number
-    # This results in the headwater areas being calculated first
+    # The element areas and the stream tree are read once into dictionaries and the streams are visited in
+    # sequence order, which results in the headwater areas being calculated first
     # so moving towards the outlet the upstream contributing areas
     # can be added
+    # All LateralArea and UpstreamArea values are written in a single pass of one update cursor
 
-    parameters_streams_table_name = "parameters_streams"
-    parameters_streams_table = os.path.join(workspace, parameters_streams_table_name)
     delineation_name_field = arcpy.AddFieldDelimiters(workspace, "DelineationName")
     discretization_name_field = arcpy.AddFieldDelimiters(workspace, "DiscretizationName")
     parameterization_name_field = arcpy.AddFieldDelimiters(workspace, "ParameterizationName")
-    expression = "{0} = '{1}' And {2} = '{3}' And {4} = '{5}'". \
+    parameterization_expression = "{0} = '{1}' And {2} = '{3}' And {4} = '{5}'". \
         format(delineation_name_field, delineation_name,
                discretization_name_field, discretization_name,
                parameterization_name_field, parameterization_name)
-    parameters_streams_table_view = "{}_tableview".format(parameters_streams_table)
-    arcpy.management.MakeTableView(parameters_streams_table, parameters_streams_table_view, expression)
-    stream_count = int(arcpy.management.GetCount(parameters_streams_table_view).getOutput(0))
-
-    parameters_elements_table_name = "parameters_elements"
-    parameters_elements_table = os.path.join(workspace, parameters_elements_table_name)
-    expression = "{0} = '{1}' And {2} = '{3}' And {4} = '{5}'". \
-        format(delineation_name_field, delineation_name,
-               discretization_name_field, discretization_name,
-               parameterization_name_field, parameterization_name)
-    parameters_elements_table_view = "{}_tableview".format(parameters_elements_table)
-    arcpy.management.MakeTableView(parameters_elements_table, parameters_elements_table_view, expression)
-
-    contributing_channels_table_name = "contributing_channels"
-    contributing_channels_table = os.path.join(workspace, contributing_channels_table_name)
-    delineation_name_field = arcpy.AddFieldDelimiters(workspace, "DelineationName")
-    discretization_name_field = arcpy.AddFieldDelimiters(workspace, "DiscretizationName")
-    expression = "{0} = '{1}' And {2} = '{3}'".format(delineation_name_field, delineation_name,
-                                                      discretization_name_field, discretization_name)
-    contrib_table_view = "{}_tableview".format(contributing_channels_table_name)
-    arcpy.management.MakeTableView(contributing_channels_table, contrib_table_view, expression)
-
-    stream_id_field = arcpy.AddFieldDelimiters(workspace, "StreamID")
-    sequence_field = arcpy.AddFieldDelimiters(workspace, "Sequence")
-    element_id_field = arcpy.AddFieldDelimiters(workspace, "ElementID")
-    fields_cursor1 = ["StreamID", "LateralArea", "UpstreamArea"]
-    fields_cursor2 = ["Area"]
-    fields_cursor3 = ["ContributingStream"]
-    fields_cursor4 = ["LateralArea", "UpstreamArea"]
-    for sequence in range(1, stream_count + 1):
-        expression = "{0} = {1}".format(sequence_field, sequence)
-        with arcpy.da.UpdateCursor(parameters_streams_table_view, fields_cursor1, expression) as cursor:
-            for row in cursor:
-                stream_id = row[0]
-                left_lateral_id = stream_id - 1
-                right_lateral_id = stream_id - 2
-                headwater_id = stream_id - 3
-
-                lateral_area = 0
-                headwater_area = None
-                upstream_area = None
-
-                # Determine lateral_area
-                expression = "{0} = '{1}' And " \
-                             "{2} = '{3}' And " \
-                             "{4} = '{5}' And " \
-                             "{6} = {7} Or " \
-                             "{8} = {9}".format(delineation_name_field, delineation_name,
-                                                discretization_name_field, discretization_name,
-                                                parameterization_name_field, parameterization_name,
-                                                element_id_field, left_lateral_id,
-                                                element_id_field, right_lateral_id)
-
-                with arcpy.da.SearchCursor(parameters_elements_table_view, fields_cursor2,
-                                           expression) as elements_cursor:
-                    for element_row in elements_cursor:
-                        print("lateral area: ", str(element_row[0]))
-                        lateral_area += element_row[0]
-                # Determine headwater_area
-                expression = "{0} = '{1}' And " \
-                             "{2} = '{3}' And " \
-                             "{4} = '{5}' And " \
-                             "{6} = {7}".format(delineation_name_field, delineation_name,
-                                                discretization_name_field, discretization_name,
-                                                parameterization_name_field, parameterization_name,
-                                                element_id_field, headwater_id)
-                with arcpy.da.SearchCursor(parameters_elements_table_view, fields_cursor2,
-                                           expression) as elements_cursor:
-                    for element_row in elements_cursor:
-                        print("headwater area: ", str(element_row[0]))
-                        headwater_area = element_row[0]
-
-                # Determine upstream_area
-                if headwater_area is None:
-                    expression = "{0} = {1}".format(stream_id_field, stream_id)
-                    expression2 = ""
-                    with arcpy.da.SearchCursor(contrib_table_view, fields_cursor3, expression) as contrib_cursor:
-                        for contrib_row in contrib_cursor:
-                            expression2 += "{0} = {1} Or ".format(stream_id_field, contrib_row[0])
-
-                    expression2 = expression2[:-4]
-                    upstream_area = 0
-                    with arcpy.da.SearchCursor(parameters_streams_table_view, fields_cursor4, expression2) as \
-                            contrib_cursor:
-                        for contrib_row in contrib_cursor:
-                            upstream_area += contrib_row[0] + contrib_row[1]
-
-                row[1] = lateral_area
-                if headwater_area:
-                    row[2] = headwater_area
-                elif upstream_area:
-                    row[2] = upstream_area
+    discretization_expression = "{0} = '{1}' And {2} = '{3}'".format(delineation_name_field, delineation_name,
+                                                                     discretization_name_field, discretization_name)
 
-                cursor.updateRow(row)
+    parameters_elements_table = os.path.join(workspace, "parameters_elements")
+    element_areas = {}
+    with arcpy.da.SearchCursor(parameters_elements_table, ["ElementID", "Area"],
+                               parameterization_expression) as elements_cursor:
+        for element_id, area in elements_cursor:
+            element_areas[element_id] = area
+
+    contributing_channels_table = os.path.join(workspace, "contributing_channels")
+    contributing_streams = {}
+    with arcpy.da.SearchCursor(contributing_channels_table, ["StreamID", "ContributingStream"],
+                               discretization_expression) as contrib_cursor:
+        for stream_id, contributing_stream_id in contrib_cursor:
+            contributing_streams.setdefault(stream_id, []).append(contributing_stream_id)
 
-    arcpy.management.Delete(contrib_table_view)
-    arcpy.management.Delete(parameters_streams_table_view)
-    arcpy.management.Delete(parameters_elements_table_view)
+    parameters_streams_table = os.path.join(workspace, "parameters_streams")
+    with arcpy.da.SearchCursor(parameters_streams_table, ["StreamID", "Sequence"],
+                               parameterization_expression) as streams_cursor:
+        streams = [stream_row for stream_row in streams_cursor]
+    # streams without a sequence cannot be ordered, so they are skipped as they were by the per-sequence queries
+    unsequenced_ids = [stream_id for stream_id, sequence in streams if sequence is None]
+    if unsequenced_ids:
+        tweet("Streams {} have no Sequence, so their contributing areas were not calculated.".format(unsequenced_ids))
+    streams = sorted([stream_row for stream_row in streams if stream_row[1] is not None],
+                     key=lambda stream_row: stream_row[1])
+
+    lateral_areas = {}
+    upstream_areas = {}
+    for stream_id, sequence in streams:
+        left_lateral_id = stream_id - 1
+        right_lateral_id = stream_id - 2
+        headwater_id = stream_id - 3
+
+        # Determine lateral_area
+        lateral_area = element_areas.get(left_lateral_id, 0) + element_areas.get(right_lateral_id, 0)
+
+        # Determine upstream_area from the headwater element or the streams flowing into this stream, whose
+        # areas have already been accumulated because they have lower sequence numbers
+        headwater_area = element_areas.get(headwater_id)
+        if headwater_area is not None:
+            upstream_area = headwater_area
+        else:
+            upstream_area = 0
+            for contributing_stream_id in contributing_streams.get(stream_id, []):
+                # a contributing stream missing from this parameterization contributes no area
+                upstream_area += lateral_areas.get(contributing_stream_id, 0) + \
+                    upstream_areas.get(contributing_stream_id, 0)
+
+        lateral_areas[stream_id] = lateral_area
+        upstream_areas[stream_id] = upstream_area
+
+    fields = ["StreamID", "LateralArea", "UpstreamArea"]
+    with arcpy.da.UpdateCursor(parameters_streams_table, fields, parameterization_expression) as cursor:
+        for row in cursor:
+            stream_id = row[0]
+            if stream_id not in lateral_areas:
+                continue
+            row[1] = lateral_areas[stream_id]
+            row[2] = upstream_areas[stream_id]
+            cursor.updateRow(row)
 
 
 def calculate_stream_slope(workspace, delineation_name, discretization_name, parameterization_name, dem_raster,
@@ -4,6 +4,13 @@ import arcpy.management  # Import statement added to provide intellisense in PyC
 import arcpy.analysis  # Import statement added to provide intellisense in PyCharm
 import os
 import datetime
+from pathlib import Path
+import numpy as np
+import AGWA_SoilCache
+import AGWA_ZonalEngine
+import importlib
+importlib.reload(AGWA_SoilCache)
+importlib.reload(AGWA_ZonalEngine)
 
 # Check out any necessary licenses
 arcpy.CheckOutExtension("spatial")
@@ -232,14 +239,27 @@ def parameterize(workspace, discretization, parameterization_name, save_intermed
     tabulate_land_cover(workspace, delineation_name, discretization, parameterization_name, land_cover,
                         save_intermediate_outputs)
 
-    tweet("Intersecting soils")
-    intersection_feature_class = intersect_soils(workspace, delineation_name, discretization, parameterization_name,
-                                                 soils, soils_database, max_horizons, max_thickness, agwa_directory,
-                                                 save_intermediate_outputs)
+    # a soils raster, e.g. the gSSURGO map unit raster, is cross-tabulated with the elements on its own grid instead
+    # of intersecting the soil polygons with the elements
+    intersection_feature_class = None
+    if is_raster(soils):
+        tweet("Cross-tabulating soils")
+        soil_areas = crosstabulate_soils(workspace, discretization, soils, save_intermediate_outputs)
+    else:
+        tweet("Intersecting soils")
+        intersection_feature_class = intersect_soils(workspace, discretization, soils)
+        soil_areas = read_intersection_soil_areas(intersection_feature_class)
+
+    tweet("Creating soil parameters tables")
+    unique_soils = sorted(set(soil_areas[1]))
+    populate_parameters_soils(workspace, delineation_name, discretization, parameterization_name, unique_soils,
+                              soils_database, max_horizons, max_thickness, agwa_directory)
 
     tweet("Weighting soils")
-    weight_soils(workspace, delineation_name, discretization, parameterization_name, intersection_feature_class,
+    weight_soils(workspace, delineation_name, discretization, parameterization_name, soil_areas,
                  save_intermediate_outputs)
+    if intersection_feature_class is not None and not save_intermediate_outputs:
+        arcpy.management.Delete(intersection_feature_class)
 
     tweet("Setting default parameters for stream soils")
     parameterize_stream_soils(workspace, delineation_name, discretization, parameterization_name,
@@ -301,201 +321,214 @@ def tabulate_land_cover(workspace, delineation_name, discretization_name, parame
     parameters_land_cover_table_view = "{}_tableview".format(parameters_land_cover_table_name)
     arcpy.management.MakeTableView(parameters_land_cover_table, parameters_land_cover_table_view, expression)
 
-    # tabulate area
-    # delineation_raster = "{}_raster".format(delineation_name)
-    discretization_feature_class = os.path.join(workspace, "{}_elements".format(discretization_name))
-    land_cover_name = os.path.split(str(land_cover))[1]
-    tabulate_area_table = "{0}_{1}_tabulate_area".format(discretization_name, land_cover_name)
-    element_id_field = "Element_ID"
-    arcpy.sa.TabulateArea(discretization_feature_class, element_id_field,
-                          land_cover, "Value",
-                          tabulate_area_table,
-                          "",
-                          "CLASSES_AS_FIELDS")
-
-    # Get the land cover values in the tabulate area table to check if any values are missing when the land cover of
-    # any missing elements is added
-    ta_fields = arcpy.ListFields(tabulate_area_table)
-
-    # If the count of records in the tabulate area table is not the same as the number of elements
-    # then the missing elements need to be added manually.
-    tabulate_area_count = int(arcpy.management.GetCount(tabulate_area_table).getOutput(0))
-    elements_count = int(arcpy.management.GetCount(parameters_elements_table_view).getOutput(0))
-    if tabulate_area_count < elements_count:
-        tweet("{0} zones found in the tabulate area table and {1} total plane elements in the discretization.".format(tabulate_area_count, elements_count))
-        # identify the elements missing from the tabulate area table
-        ta_elements = set(row[0] for row in arcpy.da.SearchCursor(tabulate_area_table, "Element_ID"))
-        discretization_elements = set(row[0] for row in arcpy.da.SearchCursor(parameters_elements_table_view, "ElementID"))
-        # tweet("tabulate area elements: {0}\ndiscretization elements: {1}".format(ta_elements, discretization_elements))
-        missing_elements = discretization_elements - ta_elements
-
-        # iterate over the missing elements to add their land cover to the tabulate area table
-        for element in missing_elements:
-            expression = "{0} = {1}".format(element_id_field, element)
-            with arcpy.da.SearchCursor(discretization_feature_class, ["SHAPE@XY", "SHAPE@AREA"], expression) as \
-                    elements_cursor:
-                for element_row in elements_cursor:
-                    element_centroid = element_row[0]
-                    element_area = element_row[1]
-                    # tweet("element centroid: {0}\nelement area: {1}".format(element_centroid, element_area))
-                    location_point = "{0} {1}".format(element_centroid[0], element_centroid[1])
-                    result = arcpy.management.GetCellValue(land_cover, location_point)
-                    # tweet(result.getMessages())
-                    cell_value = None
-                    if result.getOutput(0) != "NoData":
-                        cell_value = int(result.getOutput(0))
-                    missing_field = "VALUE_" + str(cell_value)
-                    tweet("Element ID {} was added to the tabulate area table because it was not identified by the"
-                          " Tabulate Area tool.".format(element))
-                    # Check to see if the tabulate area table has a field for the intersected value and if it does not,
-                    # add a new field for the intersected value
-                    field_exists = False
-
-                    for field in ta_fields:
-                        name = field.name
-                        if name == missing_field:
-                            field_exists = True
-                        # Set the default value for the value fields equal to 0
-                        # This works in ArcGIS Pro 3.1.1, but in ArcGIS Pro 3.0.0 even though
-                        # the fields correctly reflected a default value of 0, the inserted rows
-                        # had null values for the fields that were not explicitly set.
-                        # This may be related to the following bug, though the bug description doesn't completely agree
-                        # with the exhibited behavior.
-                        # https://support.esri.com/en-us/bug/when-using-the-data-access-module-with-the-updatecursor-bug-000091314
-                        # https://gis.stackexchange.com/questions/183932/insert-or-update-cursor-setting-value-to-none-not-honored-when-field-has-a-def
-                        if name.startswith("VALUE_"):
-                            arcpy.management.AssignDefaultToField(tabulate_area_table, name, 0)
-
-                    # value was not found in the tabulate area table, so add it
-                    if not field_exists:
-                        arcpy.management.AddField(
-                            in_table=tabulate_area_table,
-                            field_name=missing_field,
-                            field_type="DOUBLE",
-                            field_precision=None,
-                            field_scale=None,
-                            field_length=None,
-                            field_alias="",
-                            field_is_nullable="NULLABLE",
-                            field_is_required="NON_REQUIRED",
-                            field_domain=""
-                        )
-                        arcpy.management.CalculateField(
-                            in_table=tabulate_area_table,
-                            field=missing_field,
-                            expression="0",
-                            expression_type="PYTHON3",
-                            code_block="",
-                            field_type="TEXT",
-                            enforce_domains="NO_ENFORCE_DOMAINS"
-                        )
-                        # Set the default value to the new field equal to 0 in case other missing elements
-                        # have different missing values, which would result in this field being null in that row
-                        arcpy.management.AssignDefaultToField(tabulate_area_table, missing_field, 0)
-                        # Update the fields so a missing field is only added once
-                        ta_fields = arcpy.ListFields(tabulate_area_table)
-
-                    # Create a new row in the tabulate area table for the missing element
-                    insert_fields = ["Element_ID", missing_field]
-                    with arcpy.da.InsertCursor(tabulate_area_table, insert_fields) as ta_cursor:
-                        tweet("Inserting element ID: {0}".format(element))
-                        ta_cursor.insertRow((element, element_area))
-
-
-    tweet("Adding fields to tabulate area table.")
-    # add TotalArea, Interception, Canopy, Manning, and Imperviousness fields to tabulate area table
-    arcpy.management.AddFields(tabulate_area_table,
-                               "TotalArea LONG # # # #;"
-                               "Interception FLOAT # # # #;"
-                               "Canopy FLOAT # # # #;"
-                               "Manning FLOAT # # # #;"
-                               "Imperviousness FLOAT # # # #",
-                               None)
-
-    # calculate total area
-    value_fields = [f.name for f in arcpy.ListFields(tabulate_area_table, "VALUE*")]
-    expression = "!" + "! + !".join(value_fields) + "!"
-    arcpy.management.CalculateField(tabulate_area_table, "TotalArea",
-                                    expression)
-
-    # loop through parameters_land_cover table to create class-based dictionary of parameter values
-    added_fields = ["LandCoverClass", "Canopy", "Interception", "Manning", "Imperviousness"]
-    d1 = {}
-    with arcpy.da.SearchCursor(parameters_land_cover_table_view, added_fields) as cursor:
+    # the element x class area matrix only depends on the elements and the land cover raster, so it is saved with the
+    # discretization and reused when only the land cover look-up values change
+    element_ids = [row[0] for row in arcpy.da.SearchCursor(parameters_elements_table_view, "ElementID")]
+    matrix_file = land_cover_matrix_path(workspace, delineation_name, discretization_name, land_cover)
+    signature = [land_cover_signature(land_cover), elements_signature(workspace, discretization_name)]
+    crosstab = AGWA_ZonalEngine.SparseCrosstab.load(matrix_file, signature)
+    if crosstab is not None and set(crosstab.zone_ids.tolist()) == set(element_ids):
+        tweet("Using the saved element land cover areas in '{}'".format(matrix_file))
+    else:
+        crosstab = crosstabulate_land_cover(workspace, discretization_name, land_cover, element_ids,
+                                            save_intermediate_outputs)
+        Path(os.path.dirname(matrix_file)).mkdir(parents=True, exist_ok=True)
+        crosstab.save(matrix_file, signature)
+    element_ids = crosstab.zone_ids
+    class_ids = crosstab.class_ids
+
+    # build the class x parameter matrix from the land cover parameters and weight it by the element class areas
+    parameter_fields = ["Canopy", "Interception", "Manning", "Imperviousness"]
+    class_parameters = {}
+    with arcpy.da.SearchCursor(parameters_land_cover_table_view, ["LandCoverClass"] + parameter_fields) as cursor:
         for row in cursor:
-            value = row[0]
-            canopy = row[1]
-            interception = row[2]
-            manning = row[3]
-            imperviousness = row[4]
-            d1[value] = [canopy, interception, manning, imperviousness]
-
-    # loop through tabulate area table to calculate weighted parameter values using the parameter dictionary
-    added_fields = ["Canopy", "Interception", "Manning", "Imperviousness", "TotalArea"]
-    all_fields = added_fields + value_fields
-    with arcpy.da.UpdateCursor(tabulate_area_table, all_fields) as cursor:
+            class_parameters[row[0]] = row[1:]
+    missing_classes = [int(class_id) for class_id in class_ids if int(class_id) not in class_parameters]
+    if missing_classes:
+        msg = "Cannot proceed. \nThe land cover classes {0} were not found in the table '{1}'.".format(
+            missing_classes, parameters_land_cover_table)
+        tweet(msg)
+        raise Exception(msg)
+    lookup = np.array([class_parameters[int(class_id)] for class_id in class_ids],
+                      dtype=np.float64).reshape(len(class_ids), len(parameter_fields))
+    element_parameters = crosstab.weighted_mean(lookup)
+    total_areas = crosstab.total_areas()
+
+    weighted_parameters = {}
+    for element_id, total_area, parameters in zip(element_ids.tolist(), total_areas, element_parameters):
+        if total_area > 0:
+            weighted_parameters[element_id] = [None if np.isnan(value) else float(value) for value in parameters]
+
+    with arcpy.da.UpdateCursor(parameters_elements_table_view, ["ElementID"] + parameter_fields) as cursor:
         for row in cursor:
-            counter = 0
-            canopy = 0
-            interception = 0
-            manning = 0
-            imperviousness = 0
-            for f in value_fields:
-                value = int(f.split("_")[1])
-                index = 5 + counter
-                canopy += row[index] / row[4] * d1[value][0]
-                interception += row[index] / row[4] * d1[value][1]
-                manning += row[index] / row[4] * d1[value][2]
-                imperviousness += row[index] / row[4] * d1[value][3]
-                counter += 1
-            row[0] = canopy
-            row[1] = interception
-            row[2] = manning
-            row[3] = imperviousness
-            cursor.updateRow(row)
+            parameters = weighted_parameters.get(row[0])
+            if parameters is not None:
+                cursor.updateRow([row[0]] + parameters)
+
+    arcpy.management.Delete(parameters_elements_table_view)
+    arcpy.management.Delete(parameters_land_cover_table_view)
+
+
+def crosstabulate_land_cover(workspace, discretization_name, land_cover, element_ids, save_intermediate_outputs):
+    """Build the element x land cover class area matrix on the land cover grid
+    : element_ids - ids of the elements in the parameterization
+    """
+    return crosstabulate_elements(workspace, discretization_name, land_cover, element_ids, "land cover",
+                                  save_intermediate_outputs)
 
-    # join parameters_elements to tabulate area table to transfer weighted parameters
-    arcpy.management.AddJoin(parameters_elements_table_view, "ElementID", tabulate_area_table,
-                             "ELEMENT_ID")
-    elements_canopy_field = "{0}.{1}".format(parameters_elements_table_name, "Canopy")
-    ta_canopy_field = "{0}.{1}".format(tabulate_area_table, "Canopy")
-    elements_interception_field = "{0}.{1}".format(parameters_elements_table_name, "Interception")
-    ta_interception_field = "{0}.{1}".format(tabulate_area_table, "Interception")
-    elements_manning_field = "{0}.{1}".format(parameters_elements_table_name, "Manning")
-    ta_manning_field = "{0}.{1}".format(tabulate_area_table, "Manning")
-    elements_imperviousness_field = "{0}.{1}".format(parameters_elements_table_name, "Imperviousness")
-    ta_imperviousness_field = "{0}.{1}".format(tabulate_area_table, "Imperviousness")
-    calculate_expression = "{0} !{1}!;{2} !{3}!;{4} !{5}!;{6} !{7}!".format(
-        elements_canopy_field, ta_canopy_field,
-        elements_interception_field, ta_interception_field,
-        elements_manning_field, ta_manning_field,
-        elements_imperviousness_field, ta_imperviousness_field)
-    arcpy.management.CalculateFields(parameters_elements_table_view, "PYTHON3", calculate_expression)
-    arcpy.management.RemoveJoin(parameters_elements_table_view, tabulate_area_table)
+
+def crosstabulate_elements(workspace, discretization_name, class_raster, element_ids, class_description,
+                           save_intermediate_outputs):
+    """Build the element x class area matrix of a class raster on the grid of the raster
+    : class_raster - raster of integer classes, e.g. land cover or soil map units
+    : element_ids - ids of the elements in the parameterization
+    : class_description - name of the classes used in messages, e.g. land cover
+    """
+    # cross-tabulate the elements with the class raster on its grid
+    discretization_feature_class = os.path.join(workspace, "{}_elements".format(discretization_name))
+    class_raster_name = os.path.splitext(os.path.split(str(class_raster))[1])[0]
+    elements_raster = "intermediate_{0}_{1}_elements_raster".format(discretization_name, class_raster_name)
+    grid = AGWA_ZonalEngine.rasterize_zones(discretization_feature_class, "Element_ID", class_raster, elements_raster)
+    class_values = AGWA_ZonalEngine.read_aligned(class_raster, grid)
+
+    element_ids, index = AGWA_ZonalEngine.index_zones(grid.labels, grid.nodata, element_ids)
+    crosstab = AGWA_ZonalEngine.crosstabulate(index, element_ids, class_values, grid.cell_size ** 2)
+
+    # elements too small to contain a cell center, or not covered by the raster, take the class at their centroid
+    # for their whole area. The elements are read in the coordinate system of the raster, so the centroids fall on
+    # its cells and the areas are in the same units as the cell areas.
+    missing = np.flatnonzero(crosstab.total_areas() == 0)
+    if len(missing) > 0:
+        tweet("{0} elements have no {1} cells, so the {1} at their centroid is used.".format(
+            len(missing), class_description))
+        fields = ["Element_ID", "SHAPE@XY", "SHAPE@AREA"]
+        with arcpy.da.SearchCursor(discretization_feature_class, fields,
+                                   spatial_reference=grid.spatial_reference) as cursor:
+            element_shapes = {row[0]: (row[1], row[2]) for row in cursor}
+        centroids = np.array([element_shapes.get(element_ids[i], ((np.nan, np.nan), 0))[0] for i in missing],
+                             dtype=np.float64).reshape(-1, 2)
+        areas = np.array([element_shapes.get(element_ids[i], ((np.nan, np.nan), 0))[1] for i in missing],
+                         dtype=np.float64)
+        centroid_classes = AGWA_ZonalEngine.sample_points(grid, class_values, centroids[:, 0], centroids[:, 1])
+        found = ~np.isnan(centroid_classes)
+        crosstab = crosstab.add_entries(missing[found], centroid_classes[found].astype(np.int64), areas[found])
+        for element_id in element_ids[missing[~found]]:
+            tweet("Element ID {0} has no {1} and its {1} parameters were not set.".format(element_id,
+                                                                                      class_description))
 
     if not save_intermediate_outputs:
-        arcpy.Delete_management(tabulate_area_table)
+        arcpy.management.Delete(elements_raster)
 
-    arcpy.management.Delete(parameters_elements_table_view)
-    arcpy.management.Delete(parameters_land_cover_table_view)
+    return crosstab
 
 
-def intersect_soils(workspace, delineation_name, discretization_name, parameterization_name, soils, soils_database,
-                    max_horizons, max_thickness, agwa_directory, save_intermediate_outputs):
-    parameters_elements_table_name = "parameters_elements"
-    parameters_elements_table = os.path.join(workspace, parameters_elements_table_name)
+def land_cover_matrix_path(workspace, delineation_name, discretization_name, land_cover):
+    workspace_directory = os.path.split(workspace)[0]
+    land_cover_name = os.path.splitext(os.path.split(str(land_cover))[1])[0]
+    return os.path.join(workspace_directory, delineation_name, discretization_name, "land_cover",
+                        "{}_element_class_areas.npz".format(land_cover_name))
+
+
+def land_cover_signature(land_cover):
+    # describes the land cover raster so a saved matrix is not reused after the raster is replaced or edited. A raster
+    # file is described by its size and modification time, and any other raster, e.g. in a geodatabase where it can
+    # be overwritten under the same name and extent, by a hash of its cell values
+    description = arcpy.Describe(land_cover)
+    extent = description.extent
+    signature = [description.catalogPath, description.meanCellWidth, description.meanCellHeight,
+                 extent.XMin, extent.YMin, extent.XMax, extent.YMax]
+    if os.path.isfile(description.catalogPath):
+        stat = os.stat(description.catalogPath)
+        signature += [stat.st_size, stat.st_mtime_ns]
+    else:
+        signature.append(AGWA_ZonalEngine.raster_digest(land_cover))
+
+    return signature
 
-    parameters_elements_table_view = "{}_tableview".format(parameters_elements_table_name)
-    delineation_name_field = arcpy.AddFieldDelimiters(workspace, "DelineationName")
-    discretization_name_field = arcpy.AddFieldDelimiters(workspace, "DiscretizationName")
-    parameterization_name_field = arcpy.AddFieldDelimiters(workspace, "ParameterizationName")
-    expression = "{0} = '{1}' And {2} = '{3}' And {4} = '{5}'".format(delineation_name_field, delineation_name,
-                                                                      discretization_name_field,
-                                                                      discretization_name,
-                                                                      parameterization_name_field,
-                                                                      parameterization_name)
-    arcpy.management.MakeTableView(parameters_elements_table, parameters_elements_table_view, expression)
 
+def elements_signature(workspace, discretization_name):
+    # describes the elements so a saved matrix is not reused after the discretization is deleted and recreated under
+    # the same name, which usually gives the elements the same ids
+    creation_date = None
+    meta_discretization_table = os.path.join(workspace, "metaDiscretization")
+    expression = "{0} = '{1}'".format(arcpy.AddFieldDelimiters(workspace, "DiscretizationName"), discretization_name)
+    with arcpy.da.SearchCursor(meta_discretization_table, "CreationDate", expression) as cursor:
+        for row in cursor:
+            creation_date = row[0]
+
+    discretization_feature_class = os.path.join(workspace, "{}_elements".format(discretization_name))
+    element_count = 0
+    total_area = 0.0
+    with arcpy.da.SearchCursor(discretization_feature_class, "SHAPE@AREA") as cursor:
+        for row in cursor:
+            element_count += 1
+            total_area += row[0]
+
+    return [str(creation_date), element_count, round(total_area, 3)]
+
+
+def intersect_soils(workspace, discretization_name, soils):
+    # intersect soils with discretization
+    discretization_feature_class = os.path.join(workspace, "{}_elements".format(discretization_name))
+    soils_name = os.path.split(soils)[1]
+    intersection_feature_class = "{0}_{1}_intersection".format(discretization_name, soils_name)
+    intersection_input = "{0};{1}".format(discretization_feature_class, soils)
+    arcpy.analysis.PairwiseIntersect(intersection_input, intersection_feature_class, "ALL", None, "INPUT")
+
+    return intersection_feature_class
+
+
+def read_intersection_soil_areas(soils_intersection):
+    """Read the element, soil, and area of every polygon of the soils intersection
+    Returns arrays of element ids, soil ids as strings, and areas.
+    : soils_intersection - feature class from intersect_soils
+    """
+    element_ids = []
+    soil_ids = []
+    areas = []
+    with arcpy.da.SearchCursor(soils_intersection, ["Element_ID", "MUKEY", "SHAPE@AREA"]) as cursor:
+        for element_id, soil_id, area in cursor:
+            element_ids.append(element_id)
+            soil_ids.append(str(soil_id))
+            areas.append(area)
+
+    return (np.array(element_ids, dtype=np.int64), np.array(soil_ids, dtype=str),
+            np.array(areas, dtype=np.float64))
+
+
+def crosstabulate_soils(workspace, discretization_name, soils, save_intermediate_outputs):
+    """Build the element x soil map unit areas from a soils raster without a polygon overlay
+    Returns arrays of element ids, soil ids as strings, and areas, like read_intersection_soil_areas.
+    : soils - soils raster whose cell values, or whose MUKEY attribute, identify the soil map units
+    """
+    discretization_feature_class = os.path.join(workspace, "{}_elements".format(discretization_name))
+    element_ids = [row[0] for row in arcpy.da.SearchCursor(discretization_feature_class, "Element_ID")]
+    crosstab = crosstabulate_elements(workspace, discretization_name, soils, element_ids, "soils",
+                                      save_intermediate_outputs)
+
+    # gSSURGO map unit rasters hold the mukey in the MUKEY field of the attribute table, which is not always equal
+    # to the cell value; without that field the cell value is taken as the mukey
+    mukey_field = [field.name for field in arcpy.ListFields(soils) if field.name.upper() == "MUKEY"]
+    if mukey_field:
+        mukey_by_value = {int(row[0]): str(row[1]) for row in arcpy.da.SearchCursor(soils, ["Value", mukey_field[0]])}
+    else:
+        mukey_by_value = {}
+    soil_ids = np.array([mukey_by_value.get(int(class_id), str(int(class_id))) for class_id in crosstab.class_ids],
+                        dtype=str)
+
+    return crosstab.zone_ids[crosstab.rows()], soil_ids[crosstab.indices], crosstab.areas
+
+
+def is_raster(dataset):
+    return arcpy.Describe(dataset).dataType in ("RasterDataset", "RasterLayer", "RasterBand", "MosaicDataset")
+
+
+def populate_parameters_soils(workspace, delineation_name, discretization_name, parameterization_name, unique_soils,
+                              soils_database, max_horizons, max_thickness, agwa_directory):
+    """Write the weighted parameters of the soil map units, components, horizons, and textures to the parameters
+    tables
+    : unique_soils - mukeys of the soils in the discretization
+    """
     parameters_soils_fields = ["DelineationName", "DiscretizationName", "ParameterizationName", "SoilId",
                                "Ksat", "CV", "G", "Porosity", "Rock", "Distribution", "SMax", "Sand", "Silt", "Clay",
                                "Splash", "Cohesion", "Pave", "BPressure", "CreationDate"]
@@ -531,18 +564,10 @@ def intersect_soils(workspace, delineation_name, discretization_name, parameteri
     # parameters_soil_textures_table_view = "{}_tableview".format(parameters_soil_textures_table_name)
     # arcpy.management.MakeTableView(parameters_soil_textures_table, parameters_soil_textures_table_view, expression)
 
-    # intersect soils with discretization
-    discretization_feature_class = os.path.join(workspace, "{}_elements".format(discretization_name))
-    soils_name = os.path.split(soils)[1]
-    intersection_feature_class = "{0}_{1}_intersection".format(discretization_name, soils_name)
-    intersection_input = "{0};{1}".format(discretization_feature_class, soils)
-    arcpy.analysis.PairwiseIntersect(intersection_input, intersection_feature_class, "ALL", None, "INPUT")
-
-    # create table with parameters for each intersected soil type up to the max number of horizons and/or max thickness
-    # TODO: Can this be accomplished using joins or relates to avoid all the nested loops?
-    # TODO: Does converting the tables to numpy arrays offer any performance improvement for discretizations and soils
-    #  with a really large number of features?
-    # first, iterate through intersection feature class to get soil_id (MUKEY, SNUM, etc.)
+    # create table with parameters for each soil type up to the max number of horizons and/or max thickness
+    # the SSURGO tables and kin_lut are each read once and grouped by their key field, so the nested loops below
+    # look up rows in memory instead of opening a cursor per soil, component, horizon, and texture
+    # first, iterate through the soils in the discretization to get soil_id (MUKEY, SNUM, etc.)
     # second, query component table by soil_id to get component_id (cokey)
     # third, query horizon table by component_id to get parameters of each horizon and horizon_id (chkey)
     # fourth, query texture group table by horizon_id to get texture_group_id (chtgkey)
@@ -564,338 +589,396 @@ def intersect_soils(workspace, delineation_name, discretization_name, parameteri
     horizon_table = os.path.join(soils_database, "chorizon")
     texture_group_table = os.path.join(soils_database, "chtexturegrp")
     texture_table = os.path.join(soils_database, "chtexture")
-    intersection_fields = ["mukey"]
     kin_lut_fields = ["KS", "G", "POR", "SMAX", "CV", "SAND", "SILT", "CLAY", "DIST", "KFF", "BPressure"]
     component_fields = ["cokey", "comppct_r"]
     horizon_fields = ["chkey", "hzdept_r", "hzdepb_r", "ksat_r", "sandtotal_r", "silttotal_r", "claytotal_r",
                       "dbthirdbar_r", "partdensity", "sieveno10_r", "kwfact"]
     texture_group_fields = ["chtgkey"]
     texture_fields = ["texcl", "lieutex"]
-    unique_soils = set(row[0] for row in arcpy.da.SearchCursor(intersection_feature_class, intersection_fields))
-    cokey_with_missing_horizons = []
+
+    # the weighted parameters of a soil depend only on the soils database, kin_lut, max_horizons, and max_thickness,
+    # so they are cached next to the AGWA datafiles and only soils that have not been weighted before are computed
+    kin_lut_by_texture = group_rows_by_key(kin_lut_table, "TextureName", kin_lut_fields)
+    cache_path = os.path.join(agwa_directory, "datafiles", "soil_parameter_cache.sqlite")
+    cache_key = AGWA_SoilCache.make_cache_key(soils_database, max_horizons, max_thickness, kin_lut_by_texture)
+    soil_cache = AGWA_SoilCache.open_cache(cache_path)
+    if soil_cache is None:
+        tweet("The soil parameter cache '{}' could not be opened, so all soils will be weighted.".format(cache_path))
+        weighted_soils = {}
+    else:
+        weighted_soils = soil_cache.lookup(cache_key, unique_soils)
+    missing_soils = [soil_id for soil_id in unique_soils if str(soil_id) not in weighted_soils]
+    tweet("{0} of {1} soils found in the soil parameter cache".format(len(unique_soils) - len(missing_soils),
+                                                                      len(unique_soils)))
+
+    if missing_soils:
+        ssurgo_indexes = (group_rows_by_key(component_table, "mukey", component_fields),
+                          group_rows_by_key(horizon_table, "cokey", horizon_fields),
+                          group_rows_by_key(texture_group_table, "chkey", texture_group_fields),
+                          group_rows_by_key(texture_table, "chtgkey", texture_fields))
+        computed_soils = {}
+        for soil_id in missing_soils:
+            computed_soils[str(soil_id)] = weight_soil(soil_id, ssurgo_indexes, kin_lut_by_texture, max_horizons,
+                                                       max_thickness)
+        if soil_cache is not None:
+            soil_cache.store(cache_key, computed_soils)
+        weighted_soils.update(computed_soils)
+    if soil_cache is not None:
+        soil_cache.close()
+
+    soil_rows = []
+    component_rows = []
+    horizon_rows = []
+    texture_rows = []
     creation_date = datetime.datetime.now()
     for soil_id in unique_soils:
-        # query component table
-        component_expression = "mukey = '{}'".format(soil_id)
-        soil_ksat = 0
-        soil_cv = 0
-        soil_g = 0
-        soil_porosity = 0
-        soil_rock = 0
-        soil_distribution = 0
-        soil_smax = 0
-        soil_sand = 0
-        soil_silt = 0
-        soil_clay = 0
-        soil_splash = 0
-        soil_cohesion = 0
-        soil_pave = 0
-        soil_bpressure = 0
-        weighted_component_ksat = 0
-        weighted_component_cv = 0
-        weighted_component_g = 0
-        weighted_component_porosity = 0
-        weighted_component_rock = 0
-        weighted_component_distribution = 0
-        weighted_component_smax = 0
-        weighted_component_sand = 0
-        weighted_component_silt = 0
-        weighted_component_clay = 0
-        weighted_component_splash = 0
-        weighted_component_cohesion = 0
-        weighted_component_pave = 0
-        weighted_component_bpressure = 0
-        total_component_pct = 0
-        with arcpy.da.SearchCursor(component_table, component_fields, component_expression) as component_cursor:
-            for component_row in component_cursor:
-                component_id = component_row[0]
-                component_pct = component_row[1]
-                total_component_pct += component_pct
-
-                # query horizon table
-                horizon_expression = "cokey = '{}'".format(component_id)
-                if max_thickness > 0:
-                    horizon_expression = "cokey = '{0}' and hzdept_r < {1}".format(component_id, max_thickness)
-                horizon_count = 0
-                total_thickness = 0
-                horizon_ksat = 0
-                horizon_g = None
-                horizon_porosity = None
-                horizon_rock = None
-                horizon_sand = None
-                horizon_silt = None
-                horizon_clay = None
-                horizon_splash = None
-                horizon_cohesion = None
-                horizon_pave = None
-                horizon_bpressure = 0
-                weighted_horizon_ksat = 0
-                weighted_horizon_cv = 0
-                weighted_horizon_g = 0
-                weighted_horizon_porosity = 0
-                weighted_horizon_rock = 0
-                weighted_horizon_distribution = 0
-                weighted_horizon_smax = 0
-                weighted_horizon_sand = 0
-                weighted_horizon_silt = 0
-                weighted_horizon_clay = 0
-                weighted_horizon_splash = 0
-                weighted_horizon_cohesion = 0
-                weighted_horizon_pave = 0
-                weighted_horizon_bpressure = 0
-                with arcpy.da.SearchCursor(horizon_table, horizon_fields, horizon_expression) as horizon_cursor:
-                    for horizon_row in horizon_cursor:
-                        horizon_count += 1
-                        # exit for loop because the horizon_count has exceeded the max_horizons threshold
-                        if not (max_horizons == 0 or horizon_count <= max_horizons):
-                            break
-                        horizon_id = horizon_row[0]
-                        horizon_number = horizon_count
-                        horizon_top_depth = horizon_row[1]
-                        horizon_bottom_depth = horizon_row[2]
-                        horizon_thickness = horizon_bottom_depth - horizon_top_depth
-                        total_thickness += horizon_thickness
-                        # SSURGO table has ksat in micrometers per second
-                        # so convert it to millimeters per hour
-                        # 1 mm / 1000 mm * 3600 seconds / 1 hour
-                        horizon_ksat_ums = horizon_row[3]
-                        horizon_ksat = horizon_ksat_ums * 1 / 1000 * 3600 / 1
-                        weighted_horizon_ksat += horizon_thickness / horizon_ksat
-                        # Calculate G based on ksat using relationship derived by Goodrich, 1990 dissertation
-                        # G = 4.83 * (1 / ksat) * 0.326
-                        # Note his calculation are in English units, so conversions from Ks in mm/hr to in/hr
-                        # is used in the equation to derive G in inches, which is then converted back to
-                        # Alternate calculate derived by Haiyan Wei 2016 is G = 362.41 * KS ^ -0.378
-                        horizon_g = 25.4 * (4.83 * (1 / (horizon_ksat / 25.4)) ** 0.326)
-                        weighted_horizon_g += horizon_g * horizon_thickness
-
-                        horizon_sand = horizon_row[4] / 100
-                        horizon_silt = horizon_row[5] / 100
-                        horizon_clay = horizon_row[6] / 100
-                        weighted_horizon_sand += horizon_sand * horizon_thickness
-                        weighted_horizon_silt += horizon_silt * horizon_thickness
-                        weighted_horizon_clay += horizon_clay * horizon_thickness
-                        # An erodibility factor which quantifies the susceptibility of soil particles to detachment and
-                        # movement by water. This factor is adjusted for the effect of rock fragments.
-                        kwfact = horizon_row[10]
-                        # TODO: document the splash and cohesion equations by adding references
-                        if kwfact:
-                            horizon_splash = 422 * float(kwfact) * 0.8
-                            if horizon_clay <= 0.22:
-                                horizon_cohesion = 5.6 * float(kwfact) / (188 - (468 * horizon_clay)
-                                                                          + (907 * (horizon_clay ** 2))) * 0.5
-                            else:
-                                horizon_cohesion = 5.6 * float(kwfact) / 130 * 0.5
-                            weighted_horizon_splash += horizon_splash * horizon_thickness
-                            weighted_horizon_cohesion += horizon_cohesion * horizon_thickness
-
-                        # dbthirdbar_r is moist bulk density
-                        bulk_density = horizon_row[7]
-                        specific_gravity = horizon_row[8]
-                        # sieve_no_10 is soil fraction passing a number 10 sieve (2.00mm square opening) as a weight
-                        # percentage of the less than 3 inch (76.4mm) fraction.
-                        # effectively percent soil
-                        sieve_no_10 = horizon_row[9]
-                        horizon_rock = 1 - (sieve_no_10 / 100)
-                        weighted_horizon_rock += horizon_rock * horizon_thickness
-                        # reference: https://water.usgs.gov/GIS/metadata/usgswrd/XML/ds866_ssurgo_variables.xml
-                        # porosity = 1 - ((bulk density) / (particle density))
-                        # bulk density = dbthirdbar_r from SSURGO chorizon table
-                        # particle density = partdensity from SSURGO chorizon table
-                        if bulk_density is not None and specific_gravity is not None:
-                            horizon_porosity = 1 - (bulk_density / specific_gravity)
-                            weighted_horizon_porosity += horizon_porosity * horizon_thickness
-                        # rock_by_weight = ((1 - horizon_porosity) * (1 - horizon_rock)) /
-                        # (1 - (horizon_porosity * (1 - horizon_rock)))
-
-                        # query texture group table
-                        texture_group_expression = "chkey = '{}'".format(horizon_id)
-                        with arcpy.da.SearchCursor(texture_group_table, texture_group_fields,
-                                                   texture_group_expression) as texture_group_cursor:
-                            for texture_group_row in texture_group_cursor:
-                                texture_group_id = texture_group_row[0]
-
-                                # query texture table
-                                texture_expression = "chtgkey = '{}'".format(texture_group_id)
-                                with arcpy.da.SearchCursor(texture_table, texture_fields, texture_expression) as \
-                                        texture_cursor:
-                                    for texture_row in texture_cursor:
-                                        texture = texture_row[0]
-                                        lieutex = texture_row[1]
-                                        if lieutex is not None:
-                                            texture = lieutex
-                                        with arcpy.da.InsertCursor(parameters_soil_textures_table,
-                                                                   parameters_soil_textures_fields) as \
-                                                insert_texture_cursor:
-                                            insert_texture_cursor.insertRow((delineation_name, discretization_name,
-                                                                             parameterization_name, soil_id,
-                                                                             component_id, horizon_id, texture_group_id,
-                                                                             texture, creation_date))
-
-                        # special cases for textures
-                        if texture == "Bedrock":
-                            horizon_pave = 1
-                        else:
-                            horizon_pave = 0
-
-                        # parameters obtained from kin_lut based on texture
-                        kin_lut_expression = "TextureName = '{}'".format(texture)
-                        with arcpy.da.SearchCursor(kin_lut_table, kin_lut_fields, kin_lut_expression) as kin_lut_cursor:
-                            for kin_lut_row in kin_lut_cursor:
-                                kin_ksat = kin_lut_row[0]
-                                kin_g = kin_lut_row[1]
-                                kin_porosity = kin_lut_row[2]
-                                kin_smax = kin_lut_row[3]
-                                kin_cv = kin_lut_row[4]
-                                kin_sand = kin_lut_row[5]
-                                kin_silt = kin_lut_row[6]
-                                kin_clay = kin_lut_row[7]
-                                kin_distribution = kin_lut_row[8]
-                                kin_kff = kin_lut_row[9]
-                                kin_bpressure = kin_lut_row[10]
-
-                                # the following parameters are not computable from SSURGO,
-                                # so they must come from kin_lut
-                                horizon_cv = kin_cv
-                                weighted_horizon_cv += horizon_cv * horizon_thickness
-                                horizon_distribution = kin_distribution
-                                weighted_horizon_distribution += horizon_distribution * horizon_thickness
-                                horizon_smax = kin_smax
-                                weighted_horizon_smax += horizon_smax * horizon_thickness
-                                horizon_bpressure = kin_bpressure
-                                weighted_horizon_bpressure += horizon_bpressure * horizon_thickness
-
-                                # the following parameters are computable from SSURGO,
-                                # but may be null, in which case they must come from kin_lut
-                                if horizon_ksat is None:
-                                    horizon_ksat = kin_ksat
-                                    weighted_horizon_ksat += horizon_thickness / horizon_ksat
-                                if horizon_g is None:
-                                    horizon_g = kin_g
-                                    weighted_horizon_g += horizon_thickness * horizon_g
-                                if horizon_sand is None:
-                                    horizon_sand = kin_sand / 100
-                                    weighted_horizon_sand += horizon_thickness * horizon_sand
-                                if horizon_silt is None:
-                                    horizon_silt = kin_silt / 100
-                                    weighted_horizon_silt += horizon_thickness * horizon_silt
-                                if horizon_clay is None:
-                                    horizon_clay = kin_clay / 100
-                                    weighted_horizon_clay += horizon_thickness * horizon_clay
-                                if horizon_splash is None:
-                                    kin_splash = 422 * kin_kff * 0.8
-                                    horizon_splash = kin_splash
-                                    weighted_horizon_splash += horizon_thickness * horizon_splash
-                                if horizon_cohesion is None:
-                                    if horizon_clay <= 0.22:
-                                        kin_cohesion = 5.6 * kin_kff / (188 - (468 * horizon_clay)
-                                                                        + (907 * (horizon_clay ** 2))) * 0.5
-                                    else:
-                                        kin_cohesion = 5.6 * kin_kff / 130 * 0.5
-                                    horizon_cohesion = kin_cohesion
-                                    weighted_horizon_cohesion += horizon_thickness * horizon_cohesion
-                                if horizon_porosity is None:
-                                    horizon_porosity = kin_porosity
-                                    weighted_horizon_porosity += horizon_thickness * horizon_porosity
-
-                        with arcpy.da.InsertCursor(parameters_soil_horizons_table, parameters_soil_horizons_fields) \
-                                as insert_horizon_cursor:
-                            insert_horizon_cursor.insertRow((delineation_name, discretization_name,
-                                                             parameterization_name, soil_id, component_id, horizon_id,
-                                                             horizon_number, horizon_top_depth, horizon_bottom_depth,
-                                                             horizon_ksat, horizon_cv, horizon_g, horizon_porosity,
-                                                             horizon_rock, horizon_distribution, horizon_smax,
-                                                             horizon_sand, horizon_silt, horizon_clay, horizon_splash,
-                                                             horizon_cohesion, horizon_pave, horizon_bpressure,
-                                                             creation_date))
-
-                    # compute component average values by weighting the horizon values by their thickness
-                    if total_thickness == 0:
-                        total_component_pct -= component_pct
-                        cokey_with_missing_horizons.append(component_id)
-                    if total_thickness != 0:
-                        component_ksat = total_thickness / weighted_horizon_ksat
-                        weighted_component_ksat += component_ksat * component_pct
-                        component_cv = weighted_horizon_cv / total_thickness
-                        weighted_component_cv += component_cv * component_pct
-                        component_g = weighted_horizon_g / total_thickness
-                        weighted_component_g += component_g * component_pct
-                        component_porosity = weighted_horizon_porosity / total_thickness
-                        weighted_component_porosity += component_porosity * component_pct
-                        component_rock = weighted_horizon_rock / total_thickness
-                        weighted_component_rock += component_rock * component_pct
-                        component_distribution = weighted_horizon_distribution / total_thickness
-                        weighted_component_distribution += component_distribution * component_pct
-                        component_smax = weighted_horizon_smax / total_thickness
-                        weighted_component_smax += component_smax * component_pct
-                        component_sand = weighted_horizon_sand / total_thickness
-                        weighted_component_sand += component_sand * component_pct
-                        component_silt = weighted_horizon_silt / total_thickness
-                        weighted_component_silt += component_silt * component_pct
-                        component_clay = weighted_horizon_clay / total_thickness
-                        weighted_component_clay += component_clay * component_pct
-                        component_splash = weighted_horizon_splash / total_thickness
-                        weighted_component_splash += component_splash * component_pct
-                        component_cohesion = weighted_horizon_cohesion / total_thickness
-                        weighted_component_cohesion += component_cohesion * component_pct
-                        component_pave = weighted_horizon_pave / total_thickness
-                        weighted_component_pave += component_pave * component_pct
-                        component_bpressure = weighted_horizon_bpressure / total_thickness
-                        weighted_component_bpressure += component_bpressure * component_pct
-                        with arcpy.da.InsertCursor(parameters_soil_components_table,
-                                                   parameters_soil_components_fields) as insert_component_cursor:
-                            insert_component_cursor.insertRow((delineation_name, discretization_name,
-                                                               parameterization_name, soil_id, component_id,
-                                                               component_pct, component_ksat, component_cv, component_g,
-                                                               component_porosity, component_rock,
-                                                               component_distribution, component_smax, component_sand,
-                                                               component_silt, component_clay, component_splash,
-                                                               component_cohesion, component_pave, component_bpressure,
-                                                               creation_date))
-
-        # compute MUKEY average values by weighting the component average values by their percentage
-        # composition of the MUKEY.
-        if total_component_pct > 0:
-            soil_ksat = weighted_component_ksat / total_component_pct
-            soil_cv = weighted_component_cv / total_component_pct
-            soil_g = weighted_component_g / total_component_pct
-            soil_porosity = weighted_component_porosity / total_component_pct
-            soil_rock = weighted_component_rock / total_component_pct
-            soil_distribution = weighted_component_distribution / total_component_pct
-            soil_smax = weighted_component_smax / total_component_pct
-            soil_sand = weighted_component_sand / total_component_pct
-            soil_silt = weighted_component_silt / total_component_pct
-            soil_clay = weighted_component_clay / total_component_pct
-            soil_splash = weighted_component_splash / total_component_pct
-            soil_cohesion = weighted_component_cohesion / total_component_pct
-            soil_pave = weighted_component_pave / total_component_pct
-            soil_bpressure = weighted_component_bpressure / total_component_pct
-        else:
-            soil_ksat = None
-            soil_cv = None
-            soil_g = None
-            soil_porosity = None
-            soil_rock = None
-            soil_distribution = None
-            soil_smax = None
-            soil_sand = None
-            soil_silt = None
-            soil_clay = None
-            soil_splash = None
-            soil_cohesion = None
-            soil_pave = None
-            soil_bpressure = None
-        with arcpy.da.InsertCursor(parameters_soils_table, parameters_soils_fields) as insert_soil_cursor:
-            insert_soil_cursor.insertRow((delineation_name, discretization_name, parameterization_name, soil_id,
-                                          soil_ksat, soil_cv, soil_g, soil_porosity, soil_rock,
-                                          soil_distribution, soil_smax, soil_sand, soil_silt, soil_clay,
-                                          soil_splash, soil_cohesion, soil_pave, soil_bpressure, creation_date))
+        soil_values, soil_component_rows, soil_horizon_rows, soil_texture_rows = weighted_soils[str(soil_id)]
+        prefix = (delineation_name, discretization_name, parameterization_name, soil_id)
+        soil_rows.append(prefix + tuple(soil_values) + (creation_date,))
+        component_rows.extend([prefix + tuple(row) + (creation_date,) for row in soil_component_rows])
+        horizon_rows.extend([prefix + tuple(row) + (creation_date,) for row in soil_horizon_rows])
+        texture_rows.extend([prefix + tuple(row) + (creation_date,) for row in soil_texture_rows])
+
+    # write the parameters of all soils, components, horizons, and textures with one cursor per table
+    for table, fields, rows in ((parameters_soil_textures_table, parameters_soil_textures_fields, texture_rows),
+                                (parameters_soil_horizons_table, parameters_soil_horizons_fields, horizon_rows),
+                                (parameters_soil_components_table, parameters_soil_components_fields, component_rows),
+                                (parameters_soils_table, parameters_soils_fields, soil_rows)):
+        with arcpy.da.InsertCursor(table, fields) as insert_cursor:
+            for row in rows:
+                insert_cursor.insertRow(row)
+
+
+def weight_soil(soil_id, ssurgo_indexes, kin_lut_by_texture, max_horizons, max_thickness):
+    """Weight the horizon and component parameters of one soil map unit
+    Returns the soil values and the component, horizon, and texture rows of the soil, without the names, soil id,
+    and creation date of the parameter tables, so the result can be cached independently of the workspace.
+    : soil_id - mukey of the soil
+    : ssurgo_indexes - components by mukey, horizons by cokey, texture groups by chkey, and textures by chtgkey
+    : kin_lut_by_texture - kin_lut rows by texture name
+    : max_horizons - maximum number of horizons weighted, 0 for all
+    : max_thickness - maximum thickness weighted, 0 for all
+    """
+    components_by_soil, horizons_by_component, texture_groups_by_horizon, textures_by_texture_group = ssurgo_indexes
+    component_rows = []
+    horizon_rows = []
+    texture_rows = []
+    cokey_with_missing_horizons = []
+    # kin_lut and texture values are carried from the previous horizon when a horizon has no texture or no kin_lut
+    # match, so they start empty for each soil
+    texture = None
+    horizon_cv = None
+    horizon_distribution = None
+    horizon_smax = None
+
+    # query component table
+    soil_ksat = 0
+    soil_cv = 0
+    soil_g = 0
+    soil_porosity = 0
+    soil_rock = 0
+    soil_distribution = 0
+    soil_smax = 0
+    soil_sand = 0
+    soil_silt = 0
+    soil_clay = 0
+    soil_splash = 0
+    soil_cohesion = 0
+    soil_pave = 0
+    soil_bpressure = 0
+    weighted_component_ksat = 0
+    weighted_component_cv = 0
+    weighted_component_g = 0
+    weighted_component_porosity = 0
+    weighted_component_rock = 0
+    weighted_component_distribution = 0
+    weighted_component_smax = 0
+    weighted_component_sand = 0
+    weighted_component_silt = 0
+    weighted_component_clay = 0
+    weighted_component_splash = 0
+    weighted_component_cohesion = 0
+    weighted_component_pave = 0
+    weighted_component_bpressure = 0
+    total_component_pct = 0
+    for component_row in components_by_soil.get(str(soil_id), []):
+        component_id = component_row[0]
+        component_pct = component_row[1]
+        total_component_pct += component_pct
+
+        # query horizon table
+        horizon_rows_of_component = horizons_by_component.get(str(component_id), [])
+        if max_thickness > 0:
+            horizon_rows_of_component = [horizon_row for horizon_row in horizon_rows_of_component
+                                         if horizon_row[1] is not None and horizon_row[1] < max_thickness]
+        horizon_count = 0
+        total_thickness = 0
+        horizon_ksat = 0
+        horizon_g = None
+        horizon_porosity = None
+        horizon_rock = None
+        horizon_sand = None
+        horizon_silt = None
+        horizon_clay = None
+        horizon_splash = None
+        horizon_cohesion = None
+        horizon_pave = None
+        horizon_bpressure = 0
+        weighted_horizon_ksat = 0
+        weighted_horizon_cv = 0
+        weighted_horizon_g = 0
+        weighted_horizon_porosity = 0
+        weighted_horizon_rock = 0
+        weighted_horizon_distribution = 0
+        weighted_horizon_smax = 0
+        weighted_horizon_sand = 0
+        weighted_horizon_silt = 0
+        weighted_horizon_clay = 0
+        weighted_horizon_splash = 0
+        weighted_horizon_cohesion = 0
+        weighted_horizon_pave = 0
+        weighted_horizon_bpressure = 0
+        for horizon_row in horizon_rows_of_component:
+            horizon_count += 1
+            # exit for loop because the horizon_count has exceeded the max_horizons threshold
+            if not (max_horizons == 0 or horizon_count <= max_horizons):
+                break
+            horizon_id = horizon_row[0]
+            horizon_number = horizon_count
+            horizon_top_depth = horizon_row[1]
+            horizon_bottom_depth = horizon_row[2]
+            horizon_thickness = horizon_bottom_depth - horizon_top_depth
+            total_thickness += horizon_thickness
+            # SSURGO table has ksat in micrometers per second
+            # so convert it to millimeters per hour
+            # 1 mm / 1000 mm * 3600 seconds / 1 hour
+            horizon_ksat_ums = horizon_row[3]
+            horizon_ksat = horizon_ksat_ums * 1 / 1000 * 3600 / 1
+            weighted_horizon_ksat += horizon_thickness / horizon_ksat
+            # Calculate G based on ksat using relationship derived by Goodrich, 1990 dissertation
+            # G = 4.83 * (1 / ksat) * 0.326
+            # Note his calculation are in English units, so conversions from Ks in mm/hr to in/hr
+            # is used in the equation to derive G in inches, which is then converted back to
+            # Alternate calculate derived by Haiyan Wei 2016 is G = 362.41 * KS ^ -0.378
+            horizon_g = 25.4 * (4.83 * (1 / (horizon_ksat / 25.4)) ** 0.326)
+            weighted_horizon_g += horizon_g * horizon_thickness
+
+            horizon_sand = horizon_row[4] / 100
+            horizon_silt = horizon_row[5] / 100
+            horizon_clay = horizon_row[6] / 100
+            weighted_horizon_sand += horizon_sand * horizon_thickness
+            weighted_horizon_silt += horizon_silt * horizon_thickness
+            weighted_horizon_clay += horizon_clay * horizon_thickness
+            # An erodibility factor which quantifies the susceptibility of soil particles to detachment and
+            # movement by water. This factor is adjusted for the effect of rock fragments.
+            kwfact = horizon_row[10]
+            # TODO: document the splash and cohesion equations by adding references
+            if kwfact:
+                horizon_splash = 422 * float(kwfact) * 0.8
+                if horizon_clay <= 0.22:
+                    horizon_cohesion = 5.6 * float(kwfact) / (188 - (468 * horizon_clay)
+                                                              + (907 * (horizon_clay ** 2))) * 0.5
+                else:
+                    horizon_cohesion = 5.6 * float(kwfact) / 130 * 0.5
+                weighted_horizon_splash += horizon_splash * horizon_thickness
+                weighted_horizon_cohesion += horizon_cohesion * horizon_thickness
+
+            # dbthirdbar_r is moist bulk density
+            bulk_density = horizon_row[7]
+            specific_gravity = horizon_row[8]
+            # sieve_no_10 is soil fraction passing a number 10 sieve (2.00mm square opening) as a weight
+            # percentage of the less than 3 inch (76.4mm) fraction.
+            # effectively percent soil
+            sieve_no_10 = horizon_row[9]
+            horizon_rock = 1 - (sieve_no_10 / 100)
+            weighted_horizon_rock += horizon_rock * horizon_thickness
+            # reference: https://water.usgs.gov/GIS/metadata/usgswrd/XML/ds866_ssurgo_variables.xml
+            # porosity = 1 - ((bulk density) / (particle density))
+            # bulk density = dbthirdbar_r from SSURGO chorizon table
+            # particle density = partdensity from SSURGO chorizon table
+            if bulk_density is not None and specific_gravity is not None:
+                horizon_porosity = 1 - (bulk_density / specific_gravity)
+                weighted_horizon_porosity += horizon_porosity * horizon_thickness
+            # rock_by_weight = ((1 - horizon_porosity) * (1 - horizon_rock)) /
+            # (1 - (horizon_porosity * (1 - horizon_rock)))
+
+            # query texture group table
+            for texture_group_row in texture_groups_by_horizon.get(str(horizon_id), []):
+                texture_group_id = texture_group_row[0]
+
+                # query texture table
+                for texture_row in textures_by_texture_group.get(str(texture_group_id), []):
+                    texture = texture_row[0]
+                    lieutex = texture_row[1]
+                    if lieutex is not None:
+                        texture = lieutex
+                    texture_rows.append((component_id, horizon_id, texture_group_id, texture))
+
+            # special cases for textures
+            if texture == "Bedrock":
+                horizon_pave = 1
+            else:
+                horizon_pave = 0
+
+            # parameters obtained from kin_lut based on texture
+            for kin_lut_row in kin_lut_by_texture.get(str(texture), []):
+                kin_ksat = kin_lut_row[0]
+                kin_g = kin_lut_row[1]
+                kin_porosity = kin_lut_row[2]
+                kin_smax = kin_lut_row[3]
+                kin_cv = kin_lut_row[4]
+                kin_sand = kin_lut_row[5]
+                kin_silt = kin_lut_row[6]
+                kin_clay = kin_lut_row[7]
+                kin_distribution = kin_lut_row[8]
+                kin_kff = kin_lut_row[9]
+                kin_bpressure = kin_lut_row[10]
+
+                # the following parameters are not computable from SSURGO,
+                # so they must come from kin_lut
+                horizon_cv = kin_cv
+                weighted_horizon_cv += horizon_cv * horizon_thickness
+                horizon_distribution = kin_distribution
+                weighted_horizon_distribution += horizon_distribution * horizon_thickness
+                horizon_smax = kin_smax
+                weighted_horizon_smax += horizon_smax * horizon_thickness
+                horizon_bpressure = kin_bpressure
+                weighted_horizon_bpressure += horizon_bpressure * horizon_thickness
+
+                # the following parameters are computable from SSURGO,
+                # but may be null, in which case they must come from kin_lut
+                if horizon_ksat is None:
+                    horizon_ksat = kin_ksat
+                    weighted_horizon_ksat += horizon_thickness / horizon_ksat
+                if horizon_g is None:
+                    horizon_g = kin_g
+                    weighted_horizon_g += horizon_thickness * horizon_g
+                if horizon_sand is None:
+                    horizon_sand = kin_sand / 100
+                    weighted_horizon_sand += horizon_thickness * horizon_sand
+                if horizon_silt is None:
+                    horizon_silt = kin_silt / 100
+                    weighted_horizon_silt += horizon_thickness * horizon_silt
+                if horizon_clay is None:
+                    horizon_clay = kin_clay / 100
+                    weighted_horizon_clay += horizon_thickness * horizon_clay
+                if horizon_splash is None:
+                    kin_splash = 422 * kin_kff * 0.8
+                    horizon_splash = kin_splash
+                    weighted_horizon_splash += horizon_thickness * horizon_splash
+                if horizon_cohesion is None:
+                    if horizon_clay <= 0.22:
+                        kin_cohesion = 5.6 * kin_kff / (188 - (468 * horizon_clay)
+                                                        + (907 * (horizon_clay ** 2))) * 0.5
+                    else:
+                        kin_cohesion = 5.6 * kin_kff / 130 * 0.5
+                    horizon_cohesion = kin_cohesion
+                    weighted_horizon_cohesion += horizon_thickness * horizon_cohesion
+                if horizon_porosity is None:
+                    horizon_porosity = kin_porosity
+                    weighted_horizon_porosity += horizon_thickness * horizon_porosity
+
+            horizon_rows.append((component_id, horizon_id, horizon_number, horizon_top_depth,
+                                 horizon_bottom_depth, horizon_ksat, horizon_cv, horizon_g, horizon_porosity,
+                                 horizon_rock, horizon_distribution, horizon_smax, horizon_sand, horizon_silt,
+                                 horizon_clay, horizon_splash, horizon_cohesion, horizon_pave, horizon_bpressure))
+
+        # compute component average values by weighting the horizon values by their thickness
+        if total_thickness == 0:
+            total_component_pct -= component_pct
+            cokey_with_missing_horizons.append(component_id)
+        if total_thickness != 0:
+            component_ksat = total_thickness / weighted_horizon_ksat
+            weighted_component_ksat += component_ksat * component_pct
+            component_cv = weighted_horizon_cv / total_thickness
+            weighted_component_cv += component_cv * component_pct
+            component_g = weighted_horizon_g / total_thickness
+            weighted_component_g += component_g * component_pct
+            component_porosity = weighted_horizon_porosity / total_thickness
+            weighted_component_porosity += component_porosity * component_pct
+            component_rock = weighted_horizon_rock / total_thickness
+            weighted_component_rock += component_rock * component_pct
+            component_distribution = weighted_horizon_distribution / total_thickness
+            weighted_component_distribution += component_distribution * component_pct
+            component_smax = weighted_horizon_smax / total_thickness
+            weighted_component_smax += component_smax * component_pct
+            component_sand = weighted_horizon_sand / total_thickness
+            weighted_component_sand += component_sand * component_pct
+            component_silt = weighted_horizon_silt / total_thickness
+            weighted_component_silt += component_silt * component_pct
+            component_clay = weighted_horizon_clay / total_thickness
+            weighted_component_clay += component_clay * component_pct
+            component_splash = weighted_horizon_splash / total_thickness
+            weighted_component_splash += component_splash * component_pct
+            component_cohesion = weighted_horizon_cohesion / total_thickness
+            weighted_component_cohesion += component_cohesion * component_pct
+            component_pave = weighted_horizon_pave / total_thickness
+            weighted_component_pave += component_pave * component_pct
+            component_bpressure = weighted_horizon_bpressure / total_thickness
+            weighted_component_bpressure += component_bpressure * component_pct
+            component_rows.append((component_id, component_pct, component_ksat, component_cv, component_g,
+                                   component_porosity, component_rock, component_distribution, component_smax,
+                                   component_sand, component_silt, component_clay, component_splash,
+                                   component_cohesion, component_pave, component_bpressure))
+
+    # compute MUKEY average values by weighting the component average values by their percentage
+    # composition of the MUKEY.
+    if total_component_pct > 0:
+        soil_ksat = weighted_component_ksat / total_component_pct
+        soil_cv = weighted_component_cv / total_component_pct
+        soil_g = weighted_component_g / total_component_pct
+        soil_porosity = weighted_component_porosity / total_component_pct
+        soil_rock = weighted_component_rock / total_component_pct
+        soil_distribution = weighted_component_distribution / total_component_pct
+        soil_smax = weighted_component_smax / total_component_pct
+        soil_sand = weighted_component_sand / total_component_pct
+        soil_silt = weighted_component_silt / total_component_pct
+        soil_clay = weighted_component_clay / total_component_pct
+        soil_splash = weighted_component_splash / total_component_pct
+        soil_cohesion = weighted_component_cohesion / total_component_pct
+        soil_pave = weighted_component_pave / total_component_pct
+        soil_bpressure = weighted_component_bpressure / total_component_pct
+    else:
+        soil_ksat = None
+        soil_cv = None
+        soil_g = None
+        soil_porosity = None
+        soil_rock = None
+        soil_distribution = None
+        soil_smax = None
+        soil_sand = None
+        soil_silt = None
+        soil_clay = None
+        soil_splash = None
+        soil_cohesion = None
+        soil_pave = None
+        soil_bpressure = None
+    soil_values = (soil_ksat, soil_cv, soil_g, soil_porosity, soil_rock, soil_distribution, soil_smax, soil_sand,
+                   soil_silt, soil_clay, soil_splash, soil_cohesion, soil_pave, soil_bpressure)
+
+    return soil_values, component_rows, horizon_rows, texture_rows
+
+
+def group_rows_by_key(table, key_field, fields):
+    """Read a table once and group its rows by a key field
+    Rows keep the order of the table and keys are stored as strings to match the text keys of SSURGO.
+    : table - table to read
+    : key_field - field to group by, e.g. mukey
+    : fields - fields of each row in the returned lists
+    """
+    rows_by_key = {}
+    with arcpy.da.SearchCursor(table, [key_field] + fields) as cursor:
+        for row in cursor:
+            rows_by_key.setdefault(str(row[0]), []).append(row[1:])
 
-    return intersection_feature_class
+    return rows_by_key
 
 
-def weight_soils(workspace, delineation_name, discretization_name, parameterization_name, soils_intersection,
+def weight_soils(workspace, delineation_name, discretization_name, parameterization_name, soil_areas,
                  save_intermediate_outputs):
+    """Set the soil parameters of the elements to the area-weighted parameters of their soils
+    : soil_areas - arrays of element ids, soil ids, and areas from read_intersection_soil_areas or crosstabulate_soils
+    """
     parameters_elements_table_name = "parameters_elements"
     parameters_elements_table = os.path.join(workspace, parameters_elements_table_name)
 
@@ -912,127 +995,49 @@ def weight_soils(workspace, delineation_name, discretization_name, parameterizat
 
     parameters_soils_table_name = "parameters_soils"
     parameters_soils_table = os.path.join(workspace, parameters_soils_table_name)
-    parameters_soils_table_view = "{}_tableview".format(parameters_soils_table_name)
-    arcpy.management.MakeTableView(parameters_soils_table, parameters_soils_table_view, expression)
-
-    intersection_join = arcpy.management.AddJoin(soils_intersection, "MUKEY", parameters_soils_table_view, "SoilId",
-                             "KEEP_ALL", "NO_INDEX_JOIN_FIELDS")
-
-    parameters_elements_fields = ["Area", "ElementID", "Ksat", "CV", "G", "Porosity", "Rock", "Distribution", "SMax",
-                                  "Sand", "Silt", "Clay", "Splash", "Cohesion", "Pave", "BPressure", "CreationDate"]
-
-    ksat_field = arcpy.AddFieldDelimiters(workspace, "{}.Ksat".format(parameters_soils_table_name))
-    cv_field = arcpy.AddFieldDelimiters(workspace, "{}.CV".format(parameters_soils_table_name))
-    g_field = arcpy.AddFieldDelimiters(workspace, "{}.G".format(parameters_soils_table_name))
-    porosity_field = arcpy.AddFieldDelimiters(workspace, "{}.Porosity".format(parameters_soils_table_name))
-    rock_field = arcpy.AddFieldDelimiters(workspace, "{}.Rock".format(parameters_soils_table_name))
-    distribution_field = arcpy.AddFieldDelimiters(workspace, "{}.Distribution".format(parameters_soils_table_name))
-    smax_field = arcpy.AddFieldDelimiters(workspace, "{}.SMax".format(parameters_soils_table_name))
-    sand_field = arcpy.AddFieldDelimiters(workspace, "{}.Sand".format(parameters_soils_table_name))
-    silt_field = arcpy.AddFieldDelimiters(workspace, "{}.Silt".format(parameters_soils_table_name))
-    clay_field = arcpy.AddFieldDelimiters(workspace, "{}.Clay".format(parameters_soils_table_name))
-    splash_field = arcpy.AddFieldDelimiters(workspace, "{}.Splash".format(parameters_soils_table_name))
-    cohesion_field = arcpy.AddFieldDelimiters(workspace, "{}.Cohesion".format(parameters_soils_table_name))
-    pave_field = arcpy.AddFieldDelimiters(workspace, "{}.Pave".format(parameters_soils_table_name))
-    bpressure_field = arcpy.AddFieldDelimiters(workspace, "{}.BPressure".format(parameters_soils_table_name))
-    intersection_fields = ["SHAPE@AREA", ksat_field, cv_field, g_field, porosity_field, rock_field, distribution_field,
-                           smax_field, sand_field, silt_field, clay_field, splash_field, cohesion_field, pave_field,
-                           bpressure_field]
 
+    # read the soil parameters once and aggregate the element soil areas with grouped area-weighted sums instead of
+    # querying the joined intersection for every element
+    soil_property_fields = ["Ksat", "CV", "G", "Porosity", "Rock", "Distribution", "SMax", "Sand", "Silt", "Clay",
+                            "Splash", "Cohesion", "Pave", "BPressure"]
+    soil_properties = {}
+    with arcpy.da.SearchCursor(parameters_soils_table, ["SoilId"] + soil_property_fields, expression) as cursor:
+        for row in cursor:
+            soil_properties[str(row[0])] = row[1:]
+
+    area_element_ids, area_soil_ids, areas = soil_areas
+    missing_properties = (None,) * len(soil_property_fields)
+    area_properties = [soil_properties.get(str(soil_id), missing_properties) for soil_id in area_soil_ids]
+
+    element_ids, element_index = np.unique(np.asarray(area_element_ids, dtype=np.int64), return_inverse=True)
+    areas = np.asarray(areas, dtype=np.float64)
+    properties = np.array(area_properties, dtype=np.float64).reshape(len(areas), len(soil_property_fields))
+
+    # only soils with a ksat contribute to the element, and the weights are normalized by the area of those soils
+    ksat = properties[:, 0]
+    valid = ~np.isnan(ksat) & (ksat != 0)
+    weights = np.where(valid, areas, 0.0)
+    total_weights = np.bincount(element_index, weights=weights, minlength=len(element_ids))
+    weighted_properties = np.zeros((len(element_ids), len(soil_property_fields)))
+    for column in range(len(soil_property_fields)):
+        weighted_values = np.where(valid, properties[:, column] * weights, 0.0)
+        weighted_properties[:, column] = np.bincount(element_index, weights=weighted_values,
+                                                     minlength=len(element_ids))
+
+    element_properties = {}
+    for element_id, total_weight, weighted_values in zip(element_ids.tolist(), total_weights, weighted_properties):
+        if total_weight != 0:
+            element_properties[element_id] = [None if np.isnan(value) else float(value)
+                                              for value in weighted_values / total_weight]
+
+    parameters_elements_fields = ["ElementID"] + soil_property_fields
     with arcpy.da.UpdateCursor(parameters_elements_table_view, parameters_elements_fields) as elements_cursor:
         for element_row in elements_cursor:
-            element_area = element_row[0]
-            element_id = element_row[1]
-
-            weighted_soil_ksat = 0
-            weighted_soil_cv = 0
-            weighted_soil_g = 0
-            weighted_soil_porosity = 0
-            weighted_soil_rock = 0
-            weighted_soil_distribution = 0
-            weighted_soil_smax = 0
-            weighted_soil_sand = 0
-            weighted_soil_silt = 0
-            weighted_soil_clay = 0
-            weighted_soil_splash = 0
-            weighted_soil_cohesion = 0
-            weighted_soil_pave = 0
-            weighted_soil_bpressure = 0
-            total_element_fraction = 0
-            expression = "Element_ID = {}".format(element_id)
-            with arcpy.da.SearchCursor(intersection_join, intersection_fields, expression) as intersection_cursor:
-                for intersection_row in intersection_cursor:
-                    intersection_area = intersection_row[0]
-                    soil_ksat = intersection_row[1]
-                    soil_cv = intersection_row[2]
-                    soil_g = intersection_row[3]
-                    soil_porosity = intersection_row[4]
-                    soil_rock = intersection_row[5]
-                    soil_distribution = intersection_row[6]
-                    soil_smax = intersection_row[7]
-                    soil_sand = intersection_row[8]
-                    soil_silt = intersection_row[9]
-                    soil_clay = intersection_row[10]
-                    soil_splash = intersection_row[11]
-                    soil_cohesion = intersection_row[12]
-                    soil_pave = intersection_row[13]
-                    soil_bpressure = intersection_row[14]
-                    if soil_ksat:
-                        element_fraction = intersection_area / element_area
-                        total_element_fraction += element_fraction
-                        weighted_soil_ksat += soil_ksat * element_fraction
-                        weighted_soil_cv += soil_cv * element_fraction
-                        weighted_soil_g += soil_g * element_fraction
-                        weighted_soil_porosity += soil_porosity * element_fraction
-                        weighted_soil_rock += soil_rock * element_fraction
-                        weighted_soil_distribution += soil_distribution * element_fraction
-                        weighted_soil_smax += soil_smax * element_fraction
-                        weighted_soil_sand += soil_sand * element_fraction
-                        weighted_soil_silt += soil_silt * element_fraction
-                        weighted_soil_clay += soil_clay * element_fraction
-                        weighted_soil_splash += soil_splash * element_fraction
-                        weighted_soil_cohesion += soil_cohesion * element_fraction
-                        weighted_soil_pave += soil_pave * element_fraction
-                        weighted_soil_bpressure += soil_bpressure * element_fraction
-
-            if total_element_fraction != 0:
-                element_ksat = weighted_soil_ksat / total_element_fraction
-                element_cv = weighted_soil_cv / total_element_fraction
-                element_g = weighted_soil_g / total_element_fraction
-                element_porosity = weighted_soil_porosity / total_element_fraction
-                element_rock = weighted_soil_rock / total_element_fraction
-                element_distribution = weighted_soil_distribution / total_element_fraction
-                element_smax = weighted_soil_smax / total_element_fraction
-                element_sand = weighted_soil_sand / total_element_fraction
-                element_silt = weighted_soil_silt / total_element_fraction
-                element_clay = weighted_soil_clay / total_element_fraction
-                element_splash = weighted_soil_splash / total_element_fraction
-                element_cohesion = weighted_soil_cohesion / total_element_fraction
-                element_pave = weighted_soil_pave / total_element_fraction
-                element_bpressure = weighted_soil_bpressure / total_element_fraction
-
-                element_row[2] = element_ksat
-                element_row[3] = element_cv
-                element_row[4] = element_g
-                element_row[5] = element_porosity
-                element_row[6] = element_rock
-                element_row[7] = element_distribution
-                element_row[8] = element_smax
-                element_row[9] = element_sand
-                element_row[10] = element_silt
-                element_row[11] = element_clay
-                element_row[12] = element_splash
-                element_row[13] = element_cohesion
-                element_row[14] = element_pave
-                element_row[15] = element_bpressure
-                elements_cursor.updateRow(element_row)
-
-    arcpy.management.RemoveJoin(intersection_join, parameters_soils_table_name)
-    arcpy.management.Delete(parameters_elements_table_view)
-    arcpy.management.Delete(parameters_soils_table_view)
+            values = element_properties.get(element_row[0])
+            if values is not None:
+                elements_cursor.updateRow([element_row[0]] + values)
 
-    if not save_intermediate_outputs:
-        arcpy.management.Delete(soils_intersection)
+    arcpy.management.Delete(parameters_elements_table_view)
 
 
 def parameterize_stream_soils(workspace, delineation_name, discretization_name, parameterization_name,
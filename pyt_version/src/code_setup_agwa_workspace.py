@@ -3,6 +3,21 @@ import arcpy
 import arcpy.management  # Import statement added to provide intellisense in PyCharm
 import os
 import datetime
+import shutil
+import numpy as np
+import AGWA_TerrainEngine
+import AGWA_TiledTerrain
+import AGWA_TerrainCache
+import hashlib
+import json
+import importlib
+importlib.reload(AGWA_TerrainEngine)
+importlib.reload(AGWA_TiledTerrain)
+importlib.reload(AGWA_TerrainCache)
+
+TERRAIN_ENGINES = ["ArcGIS Spatial Analyst", "NumPy", "NumPy (tiled)"]
+TERRAIN_RASTERS = ["filled_DEM.tif", "fd.tif", "fa.tif", "flup.tif", "slope.tif", "aspect.tif"]
+FLOAT_NODATA = -3.4028235e38
 
 
 def tweet(msg):
@@ -16,7 +31,8 @@ def tweet(msg):
 
 
 def prepare_rasters(workspace, filled_dem, unfilled_dem, flow_direction, flow_accumulation, flow_length_upstream,
-                    slope, aspect, agwa_directory):
+                    slope, aspect, agwa_directory, terrain_engine=TERRAIN_ENGINES[0],
+                    tile_size=AGWA_TiledTerrain.DEFAULT_TILE_SIZE):
     try:
         arcpy.env.workspace = workspace
         workspace_folder = arcpy.Describe(arcpy.env.workspace).path
@@ -24,75 +40,346 @@ def prepare_rasters(workspace, filled_dem, unfilled_dem, flow_direction, flow_ac
         if not os.path.exists(rasters_folder):
             os.makedirs(rasters_folder)
 
-        # Process: Fill
-        # Add validation of output dataset name
-        if not filled_dem:
-            tweet("Filling DEM")
-            filled_dem_output = os.path.join(rasters_folder, "filled_DEM.tif")
-            filled_dem_raster = arcpy.sa.Fill(unfilled_dem, "#")
-            filled_dem_raster.save(filled_dem_output)
-        else:
-            filled_dem_raster = filled_dem
-
-        # Process: Flow Direction
-        # Add validation of output dataset name
-        if not flow_direction:
-            tweet("Creating flow direction raster")
-            fd_output = os.path.join(rasters_folder, "fd.tif")
-            fd_raster = filled_dem_raster = arcpy.sa.FlowDirection(filled_dem_raster, "NORMAL", "#")
-            fd_raster.save(fd_output)
+        # the derived rasters depend only on the content of the DEM rasters and the derivation options, so they are
+        # cached under a hash of both and linked into later workspaces set up on the same DEM
+        supplied_rasters = [filled_dem, flow_direction, flow_accumulation, flow_length_upstream, slope, aspect]
+        derived_names = [raster_name for supplied_raster, raster_name in zip(supplied_rasters, TERRAIN_RASTERS)
+                         if not supplied_raster]
+        # the DEM is only hashed when there is something to derive, all supplied rasters are used as they are
+        terrain_cache_key = ""
+        terrain_cache = None
+        if derived_names:
+            tweet("Hashing DEM")
+            terrain_cache_key = make_terrain_cache_key(filled_dem, unfilled_dem, flow_direction, terrain_engine,
+                                                       tile_size)
+            cache_directory = AGWA_TerrainCache.cache_directory_of(agwa_directory)
+            terrain_cache = AGWA_TerrainCache.open_cache(cache_directory)
+            if terrain_cache is None:
+                tweet("The terrain cache '{}' could not be opened, so all rasters will be derived.".format(
+                    cache_directory))
+
+        cached_rasters = None
+        if terrain_cache is not None:
+            cached_rasters = terrain_cache.lookup(terrain_cache_key, derived_names)
+        if cached_rasters:
+            tweet("Linking {0} terrain rasters from the terrain cache '{1}'".format(
+                len(derived_names), terrain_cache.entry_directory(terrain_cache_key)))
+            linked_rasters = terrain_cache.link(terrain_cache_key, derived_names, rasters_folder)
+            rasters = [supplied_raster if supplied_raster else linked_rasters[raster_name]
+                       for supplied_raster, raster_name in zip(supplied_rasters, TERRAIN_RASTERS)]
+        elif terrain_engine == "NumPy":
+            rasters = prepare_rasters_numpy(rasters_folder, filled_dem, unfilled_dem, flow_direction,
+                                            flow_accumulation, flow_length_upstream, slope, aspect)
+        elif terrain_engine == "NumPy (tiled)":
+            rasters = prepare_rasters_tiled(rasters_folder, filled_dem, unfilled_dem, flow_direction,
+                                            flow_accumulation, flow_length_upstream, slope, aspect, tile_size)
         else:
-            fd_raster = flow_direction
-
-        # Process: Flow Accumulation
-        # Add validation of output dataset name
-        if not flow_accumulation:
-            tweet("Creating flow accumulation raster")
-            fa_raster_output = os.path.join(rasters_folder, "fa.tif")
-            fa_raster = arcpy.sa.FlowAccumulation(fd_raster, "#", "FLOAT")
-            fa_raster.save(fa_raster_output)
+            rasters = prepare_rasters_arcpy(rasters_folder, filled_dem, unfilled_dem, flow_direction,
+                                            flow_accumulation, flow_length_upstream, slope, aspect)
+
+        if terrain_cache is not None and not cached_rasters:
+            tweet("Adding terrain rasters to the terrain cache")
+            terrain_cache.store(terrain_cache_key, [os.path.join(rasters_folder, raster_name)
+                                                    for raster_name in derived_names])
+
+        filled_dem_raster, fd_raster, fa_raster, flup_raster, slope_raster, aspect_raster = rasters
+        update_metadata(workspace, filled_dem_raster, unfilled_dem, fd_raster, fa_raster, flup_raster, slope_raster,
+                        aspect_raster, agwa_directory, terrain_cache_key)
+
+    except Exception as e:
+        tweet(e)
+
+
+def prepare_rasters_arcpy(rasters_folder, filled_dem, unfilled_dem, flow_direction, flow_accumulation,
+                          flow_length_upstream, slope, aspect):
+    """Derive the workspace rasters with the ArcGIS Spatial Analyst tools
+    Returns the filled DEM, flow direction, flow accumulation, flow length, slope, and aspect rasters, with the rasters
+    supplied by the user kept.
+    """
+    # Process: Fill
+    # Add validation of output dataset name
+    if not filled_dem:
+        tweet("Filling DEM")
+        filled_dem_output = os.path.join(rasters_folder, "filled_DEM.tif")
+        filled_dem_raster = arcpy.sa.Fill(unfilled_dem, "#")
+        filled_dem_raster.save(filled_dem_output)
+    else:
+        filled_dem_raster = filled_dem
+
+    # Process: Flow Direction
+    # Add validation of output dataset name
+    if not flow_direction:
+        tweet("Creating flow direction raster")
+        fd_output = os.path.join(rasters_folder, "fd.tif")
+        fd_raster = arcpy.sa.FlowDirection(filled_dem_raster, "NORMAL", "#")
+        fd_raster.save(fd_output)
+    else:
+        fd_raster = flow_direction
+
+    # Process: Flow Accumulation
+    # Add validation of output dataset name
+    if not flow_accumulation:
+        tweet("Creating flow accumulation raster")
+        fa_raster_output = os.path.join(rasters_folder, "fa.tif")
+        fa_raster = arcpy.sa.FlowAccumulation(fd_raster, "#", "FLOAT")
+        fa_raster.save(fa_raster_output)
+    else:
+        fa_raster = flow_accumulation
+
+    if not flow_length_upstream:
+        tweet("Creating flow length (upstream) raster")
+        flup_raster_output = os.path.join(rasters_folder, "flup.tif")
+        flup_raster = arcpy.sa.FlowLength(fd_raster, direction_measurement="UPSTREAM")
+        flup_raster.save(flup_raster_output)
+    else:
+        flup_raster = flow_length_upstream
+
+    if not slope:
+        tweet("Creating slope raster")
+        slope_raster_output = os.path.join(rasters_folder, "slope.tif")
+        if unfilled_dem:
+            slope_raster = arcpy.sa.Slope(unfilled_dem, "PERCENT_RISE")
         else:
-            fa_raster = flow_accumulation
+            slope_raster = arcpy.sa.Slope(filled_dem_raster, "PERCENT_RISE")
+        slope_raster.save(slope_raster_output)
+    else:
+        slope_raster = slope
 
-        if not flow_length_upstream:
-            tweet("Creating flow length (upstream) raster")
-            flup_raster_output = os.path.join(rasters_folder, "flup.tif")
-            flup_raster = arcpy.sa.FlowLength(fd_raster, direction_measurement="UPSTREAM")
-            flup_raster.save(flup_raster_output)
+    if not aspect:
+        tweet("Creating aspect raster")
+        aspect_raster_output = os.path.join(rasters_folder, "aspect.tif")
+        if unfilled_dem:
+            aspect_raster = arcpy.sa.Aspect(unfilled_dem)
         else:
-            flup_raster = flow_length_upstream
-
-        if not slope:
-            tweet("Creating slope raster")
-            slope_raster_output = os.path.join(rasters_folder, "slope.tif")
-            if unfilled_dem:
-                slope_raster = arcpy.sa.Slope(unfilled_dem, "PERCENT_RISE")
-            else:
-                slope_raster = arcpy.sa.Slope(filled_dem_raster, "PERCENT_RISE")
-            slope_raster.save(slope_raster_output)
+            aspect_raster = arcpy.sa.Aspect(filled_dem_raster)
+        aspect_raster.save(aspect_raster_output)
+    else:
+        aspect_raster = aspect
+
+    return filled_dem_raster, fd_raster, fa_raster, flup_raster, slope_raster, aspect_raster
+
+
+def prepare_rasters_numpy(rasters_folder, filled_dem, unfilled_dem, flow_direction, flow_accumulation,
+                          flow_length_upstream, slope, aspect):
+    """Derive the workspace rasters with the NumPy terrain engine from one load of the DEM
+    Rasters supplied by the user are kept, and a supplied filled DEM or flow direction raster is routed instead of
+    being derived again.
+    """
+    dem = filled_dem if filled_dem else unfilled_dem
+    template = arcpy.Raster(dem)
+    tweet("Loading DEM")
+    dem_values = read_raster_array(dem, template)
+    unfilled_values = read_raster_array(unfilled_dem, template) if unfilled_dem else None
+    filled_values = dem_values if filled_dem else None
+    direction_values = None
+    if flow_direction:
+        direction_values = np.nan_to_num(read_raster_array(flow_direction, template), nan=0).astype(np.uint8)
+
+    tweet("Deriving terrain rasters with the NumPy terrain engine")
+    terrain = AGWA_TerrainEngine.derive_terrain(dem_values, template.meanCellWidth, filled_values, direction_values,
+                                                unfilled_values)
+
+    rasters = []
+    for supplied_raster, output_name, terrain_key in ((filled_dem, "filled_DEM.tif", "filled"),
+                                                      (flow_direction, "fd.tif", "direction"),
+                                                      (flow_accumulation, "fa.tif", "accumulation"),
+                                                      (flow_length_upstream, "flup.tif", "flow_length_upstream"),
+                                                      (slope, "slope.tif", "slope"),
+                                                      (aspect, "aspect.tif", "aspect")):
+        if supplied_raster:
+            rasters.append(supplied_raster)
         else:
-            slope_raster = slope
-
-        if not aspect:
-            tweet("Creating aspect raster")
-            aspect_raster_output = os.path.join(rasters_folder, "aspect.tif")
-            if unfilled_dem:
-                aspect_raster = arcpy.sa.Aspect(unfilled_dem)
-            else:
-                aspect_raster = arcpy.sa.Aspect(filled_dem_raster)
-            aspect_raster.save(aspect_raster_output)
+            tweet("Saving {}".format(output_name))
+            output_raster = os.path.join(rasters_folder, output_name)
+            save_raster_array(terrain[terrain_key], template, output_raster)
+            rasters.append(output_raster)
+
+    return rasters
+
+
+def prepare_rasters_tiled(rasters_folder, filled_dem, unfilled_dem, flow_direction, flow_accumulation,
+                          flow_length_upstream, slope, aspect, tile_size):
+    """Derive the workspace rasters tile by tile, with the DEM and the outputs in memory-mapped files, so DEMs larger
+    than memory can be processed
+    Rasters supplied by the user are kept, and a supplied filled DEM or flow direction raster is routed instead of
+    being derived again.
+    """
+    dem = filled_dem if filled_dem else unfilled_dem
+    template = arcpy.Raster(dem)
+    tiles_folder = os.path.join(rasters_folder, "terrain_tiles")
+    if not os.path.exists(tiles_folder):
+        os.makedirs(tiles_folder)
+
+    tweet("Copying DEM to memory-mapped tiles")
+    dem_values = export_raster_tiles(dem, template, os.path.join(tiles_folder, "dem.npy"), tile_size)
+    if not filled_dem:
+        unfilled_values = dem_values
+    elif unfilled_dem:
+        unfilled_values = export_raster_tiles(unfilled_dem, template, os.path.join(tiles_folder, "unfilled.npy"),
+                                              tile_size)
+    else:
+        unfilled_values = None
+    filled_values = dem_values if filled_dem else None
+    direction_values = None
+    if flow_direction:
+        direction_values = export_raster_tiles(flow_direction, template, os.path.join(tiles_folder, "fd.npy"),
+                                               tile_size, np.uint8)
+
+    tweet("Deriving terrain rasters with the tiled NumPy terrain engine")
+    terrain = AGWA_TiledTerrain.derive_terrain_tiled(dem_values, template.meanCellWidth, tiles_folder, tile_size,
+                                                     filled_values, direction_values, unfilled_values)
+
+    rasters = []
+    for supplied_raster, output_name, terrain_key in ((filled_dem, "filled_DEM.tif", "filled"),
+                                                      (flow_direction, "fd.tif", "direction"),
+                                                      (flow_accumulation, "fa.tif", "accumulation"),
+                                                      (flow_length_upstream, "flup.tif", "flow_length_upstream"),
+                                                      (slope, "slope.tif", "slope"),
+                                                      (aspect, "aspect.tif", "aspect")):
+        if supplied_raster:
+            rasters.append(supplied_raster)
         else:
-            aspect_raster = aspect
+            tweet("Saving {}".format(output_name))
+            values = np.load(terrain[terrain_key], mmap_mode="r")
+            rasters.append(save_raster_tiles(values, template, rasters_folder, output_name, tiles_folder, tile_size))
+            del values
 
-        update_metadata(workspace, filled_dem_raster, unfilled_dem, fd_raster, fa_raster, flup_raster, slope_raster,
-                        aspect_raster, agwa_directory)
+    del dem_values, unfilled_values, direction_values
+    shutil.rmtree(tiles_folder, ignore_errors=True)
 
-    except Exception as e:
-        tweet(e)
+    return rasters
+
+
+def make_terrain_cache_key(filled_dem, unfilled_dem, flow_direction, terrain_engine, tile_size):
+    """Build the terrain cache key from the content of the rasters the derived rasters depend on and the options of
+    the terrain engine
+    : filled_dem, unfilled_dem, flow_direction - rasters supplied by the user, or None
+    : terrain_engine - one of TERRAIN_ENGINES
+    : tile_size - tile size of the tiled NumPy terrain engine
+    """
+    input_signatures = {"filled_dem": raster_signature(filled_dem) if filled_dem else None,
+                        "unfilled_dem": raster_signature(unfilled_dem) if unfilled_dem else None,
+                        "flow_direction": raster_signature(flow_direction) if flow_direction else None}
+    parameters = {"terrain_engine": terrain_engine,
+                  "tile_size": tile_size if terrain_engine == "NumPy (tiled)" else None,
+                  "flow_direction": "NORMAL", "flow_accumulation": "FLOAT", "slope": "PERCENT_RISE"}
+
+    return AGWA_TerrainCache.make_cache_key(input_signatures, parameters)
+
+
+def raster_signature(raster, block_rows=1024):
+    """Hash the cell values and the georeferencing of a raster
+    File based rasters are hashed from their bytes, other rasters, e.g. in a geodatabase, a block of rows at a time.
+    : raster - raster to hash
+    : block_rows - number of rows read at a time from rasters that are not files
+    """
+    value_raster = arcpy.Raster(raster)
+    extent = value_raster.extent
+    georeference = [value_raster.spatialReference.exportToString(), extent.XMin, extent.YMin, extent.XMax,
+                    extent.YMax, value_raster.meanCellWidth, value_raster.meanCellHeight, value_raster.noDataValue]
+    digest = hashlib.sha256(json.dumps(georeference, default=str).encode("utf-8"))
+
+    catalog_path = value_raster.catalogPath
+    if os.path.isfile(catalog_path):
+        AGWA_TerrainCache.hash_file(catalog_path, digest)
+    else:
+        for r0 in range(0, value_raster.height, block_rows):
+            r1 = min(r0 + block_rows, value_raster.height)
+            lower_left = arcpy.Point(extent.XMin, extent.YMax - r1 * value_raster.meanCellHeight)
+            block = arcpy.RasterToNumPyArray(value_raster, lower_left, value_raster.width, r1 - r0)
+            digest.update(block.tobytes())
+
+    return digest.hexdigest()
+
+
+def export_raster_tiles(raster, template, npy_file, tile_size, dtype=np.float64):
+    """Copy a raster over the extent of a template raster to a memory-mapped .npy file one tile at a time
+    NoData is stored as NaN, or as 0 for integer types such as flow direction codes.
+    : raster - raster to copy
+    : template - arcpy.Raster whose extent and number of cells are copied
+    : npy_file - output .npy file
+    : tile_size - number of rows and columns read at a time
+    : dtype - type of the stored values
+    """
+    value_raster = arcpy.Raster(raster)
+    values = AGWA_TiledTerrain.create_array(npy_file, (template.height, template.width), dtype)
+    cell_width = template.meanCellWidth
+    cell_height = template.meanCellHeight
+    for r0, r1, c0, c1 in AGWA_TiledTerrain.tiles(values.shape, tile_size):
+        lower_left = arcpy.Point(template.extent.XMin + c0 * cell_width, template.extent.YMax - r1 * cell_height)
+        block = arcpy.RasterToNumPyArray(value_raster, lower_left, c1 - c0, r1 - r0).astype(np.float64)
+        if value_raster.noDataValue is not None:
+            block[block == value_raster.noDataValue] = np.nan
+        if np.issubdtype(dtype, np.integer):
+            block = np.nan_to_num(block, nan=0)
+        values[r0:r1, c0:c1] = block
+    values.flush()
+
+    return values
+
+
+def save_raster_tiles(values, template, output_folder, output_name, tiles_folder, tile_size):
+    """Save an array aligned to a template raster one tile at a time and mosaic the tiles into one raster
+    Returns the path of the output raster.
+    : values - 2D array or memmap from the tiled terrain engine
+    : template - arcpy.Raster the array is aligned to
+    : output_folder, output_name - folder and name of the output raster
+    : tiles_folder - folder of the temporary tile rasters
+    : tile_size - number of rows and columns saved at a time
+    """
+    cell_width = template.meanCellWidth
+    cell_height = template.meanCellHeight
+    tile_rasters = []
+    for r0, r1, c0, c1 in AGWA_TiledTerrain.tiles(values.shape, tile_size):
+        lower_left = arcpy.Point(template.extent.XMin + c0 * cell_width, template.extent.YMax - r1 * cell_height)
+        tile_raster = os.path.join(tiles_folder, "tile_{0}_{1}.tif".format(r0, c0))
+        save_raster_array(np.asarray(values[r0:r1, c0:c1]), template, tile_raster, lower_left)
+        tile_rasters.append(tile_raster)
+
+    pixel_type = "8_BIT_UNSIGNED" if values.dtype == np.uint8 else "32_BIT_FLOAT"
+    arcpy.management.MosaicToNewRaster(tile_rasters, output_folder, output_name, template.spatialReference,
+                                       pixel_type, cell_width, 1)
+    for tile_raster in tile_rasters:
+        arcpy.management.Delete(tile_raster)
+
+    return os.path.join(output_folder, output_name)
+
+
+def read_raster_array(raster, template):
+    """Read a raster over the extent of a template raster as a float array with NaN for NoData
+    : raster - raster to read
+    : template - arcpy.Raster whose extent and number of cells are read
+    """
+    value_raster = arcpy.Raster(raster)
+    lower_left = arcpy.Point(template.extent.XMin, template.extent.YMin)
+    values = arcpy.RasterToNumPyArray(value_raster, lower_left, template.width, template.height).astype(np.float64)
+    if value_raster.noDataValue is not None:
+        values[values == value_raster.noDataValue] = np.nan
+
+    return values
+
+
+def save_raster_array(values, template, output_raster, lower_left=None):
+    """Save an array aligned to a template raster, with NaN or 0 flow direction codes as NoData
+    : values - 2D array from the terrain engine
+    : template - arcpy.Raster the array is aligned to
+    : output_raster - output raster path
+    : lower_left - optional arcpy.Point of the lower left corner of the array, defaults to that of the template
+    """
+    if lower_left is None:
+        lower_left = arcpy.Point(template.extent.XMin, template.extent.YMin)
+    if values.dtype == np.uint8:
+        nodata = 0
+    else:
+        values = np.where(np.isnan(values), FLOAT_NODATA, values).astype(np.float32)
+        nodata = FLOAT_NODATA
+    raster = arcpy.NumPyArrayToRaster(values, lower_left, template.meanCellWidth, template.meanCellHeight, nodata)
+    raster.save(output_raster)
+    arcpy.management.DefineProjection(output_raster, template.spatialReference)
 
 
 def update_metadata(workspace, filled_dem, unfilled_dem, flow_direction, flow_accumulation, flow_length_upstream,
-                    slope, aspect, agwa_directory):
+                    slope, aspect, agwa_directory, terrain_cache_key=""):
     out_path = workspace
     out_name = "metaWorkspace"
     # Note: relative paths are relevant to the toolbox location, not the script location
@@ -129,10 +416,11 @@ def update_metadata(workspace, filled_dem, unfilled_dem, flow_direction, flow_ac
 
     fields = ["DelineationWorkspace", "UnfilledDEMName", "UnfilledDEMPath", "FilledDEMName", "FilledDEMPath", "FDName",
               "FDPath", "FAName", "FAPath", "FlUpName", "FlUpPath", "SlopeName", "SlopePath", "AspectName",
-              "AspectPath", "CreationDate", "AGWADirectory", "AGWAVersionAtCreation", "AGWAGDBVersionAtCreation"]
+              "AspectPath", "CreationDate", "AGWADirectory", "AGWAVersionAtCreation", "AGWAGDBVersionAtCreation",
+              "TerrainCacheKey"]
 
     with arcpy.da.InsertCursor(metadata_table, fields) as cursor:
         cursor.insertRow((workspace, unfilled_dem_name, unfilled_dem_path, filled_dem_name, filled_dem_path,
                           fd_name, fd_path, fa_name, fa_path, flup_name, flup_path, slope_name, slope_path, aspect_name,
                           aspect_path, creation_date, agwa_directory, agwa_version_at_creation,
-                          agwa_gdb_version_at_creation))
+                          agwa_gdb_version_at_creation, terrain_cache_key))
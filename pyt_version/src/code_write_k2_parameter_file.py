@@ -66,23 +66,22 @@ def execute(workspace, delineation, discretization, parameterization, parameteri
                                  (df_parameterization_file.ParameterizationName == parameterization)]
     agwa_version_at_creation = df_parameterization_file_filtered.AGWAVersionAtCreation.values[0]
 
-    def write_plane(plane_id, par_name, df_p):
-
-        # read plane table
-        # TODO: Add query/filter for delineation name and discretization name
-        p_par = df_p[(df_p.ElementID == plane_id) & (df_p.ParameterizationName == par_name)]
-        width, length = p_par.Width.values[0], p_par.Length.values[0]
-        slope = p_par.MeanSlope.values[0]
-        man, x, y = p_par.Manning.values[0], p_par.CentroidX.values[0], p_par.CentroidY.values[0]
-        cv, ks, g = p_par.CV.values[0], p_par.Ksat.values[0], p_par.G.values[0]
-        dist, por = p_par.Distribution.values[0], p_par.Porosity.values[0]
-        rock = p_par.Rock.values[0]
-        sand = p_par.Sand.values[0]
-        silt, clay = p_par.Silt.values[0], p_par.Clay.values[0]
-        splash, coh = p_par.Splash.values[0], p_par.Cohesion.values[0]
-        smax = p_par.SMax.values[0]
-        inter, canopy = p_par.Interception.values[0], p_par.Canopy.values[0]
-        pave = p_par.Pave.values[0]
+    def write_plane(p_par):
+
+        # p_par is the plane's row of the indexed parameters_elements table
+        plane_id = p_par.ElementID
+        width, length = p_par.Width, p_par.Length
+        slope = p_par.MeanSlope
+        man, x, y = p_par.Manning, p_par.CentroidX, p_par.CentroidY
+        cv, ks, g = p_par.CV, p_par.Ksat, p_par.G
+        dist, por = p_par.Distribution, p_par.Porosity
+        rock = p_par.Rock
+        sand = p_par.Sand
+        silt, clay = p_par.Silt, p_par.Clay
+        splash, coh = p_par.Splash, p_par.Cohesion
+        smax = p_par.SMax
+        inter, canopy = p_par.Interception, p_par.Canopy
+        pave = p_par.Pave
 
         # write plane
         plane_info = ('BEGIN PLANE\n'
@@ -100,25 +99,24 @@ def execute(workspace, delineation, discretization, parameterization, parameteri
 
         return plane_info
 
-    def write_channel(stream_id, up_id, lat_id, par_name, df_s):
-
-        # read channel table
-        # TODO: Add query/filter for delineation name and discretization name
-        s_par = df_s[(df_s.StreamID == stream_id) & (df_s.ParameterizationName == par_name)]
-        length = s_par.StreamLength.values[0]
-        slope = s_par.MeanSlope.values[0]
-        man, x, y = s_par.Manning.values[0], s_par.CentroidX.values[0], s_par.CentroidY.values[0]
-        ss1, ss2 = s_par.SideSlope1.values[0], s_par.SideSlope2.values[0]
-
-        cv, ks, g = s_par.CV.values[0], s_par.Ksat.values[0], s_par.G.values[0]
-        dist, por, rock = s_par.Distribution.values[0], s_par.Porosity.values[0], s_par.Rock.values[0]
-        sand, silt, clay = s_par.Sand.values[0], s_par.Silt.values[0], s_par.Clay.values[0],
-        coh = s_par.Cohesion.values[0]
-        sp = s_par.Splash.values[0]
-        pave = s_par.Pave.values[0]
+    def write_channel(s_par, up_id, lat_id):
+
+        # s_par is the channel's row of the indexed parameters_streams table
+        stream_id = s_par.StreamID
+        length = s_par.StreamLength
+        slope = s_par.MeanSlope
+        man, x, y = s_par.Manning, s_par.CentroidX, s_par.CentroidY
+        ss1, ss2 = s_par.SideSlope1, s_par.SideSlope2
+
+        cv, ks, g = s_par.CV, s_par.Ksat, s_par.G
+        dist, por, rock = s_par.Distribution, s_par.Porosity, s_par.Rock
+        sand, silt, clay = s_par.Sand, s_par.Silt, s_par.Clay
+        coh = s_par.Cohesion
+        sp = s_par.Splash
+        pave = s_par.Pave
         sat = 0.2
-        down_width, up_width = s_par.DownstreamBottomWidth.values[0], s_par.UpstreamBottomWidth.values[0]
-        down_depth, up_depth = s_par.DownstreamBankfullDepth.values[0], s_par.UpstreamBankfullDepth.values[0]
+        down_width, up_width = s_par.DownstreamBottomWidth, s_par.UpstreamBottomWidth
+        down_depth, up_depth = s_par.DownstreamBankfullDepth, s_par.UpstreamBankfullDepth
 
         channel_info = (f'BEGIN CHANNEL\n'
                         fr'  ID = {stream_id}, PRINT = 1, FILE = channels\chan_{stream_id}.sim\n'
@@ -145,9 +143,23 @@ def execute(workspace, delineation, discretization, parameterization, parameteri
     df_contrib = pd.DataFrame(
         arcpy.da.TableToNumPyArray(f'{workspace}\\contributing_channels', '*'))
 
-    # get filtered df based on parameterization name
-    df_p_filtered = df_p[df_p.ParameterizationName == parameterization]
-    df_s_filtered = df_s[df_s.ParameterizationName == parameterization]
+    # get filtered df based on delineation, discretization, and parameterization name
+    df_p_filtered = df_p[(df_p.DelineationName == delineation) & (df_p.DiscretizationName == discretization) &
+                         (df_p.ParameterizationName == parameterization)]
+    df_s_filtered = df_s[(df_s.DelineationName == delineation) & (df_s.DiscretizationName == discretization) &
+                         (df_s.ParameterizationName == parameterization)]
+    df_contrib_filtered = df_contrib[(df_contrib.DelineationName == delineation) &
+                                     (df_contrib.DiscretizationName == discretization)]
+
+    # index the tables once so every plane, channel, and contributing stream lookup is a dictionary access instead
+    # of a scan of the full table
+    planes = {p_par.ElementID: p_par for p_par in df_p_filtered.itertuples(index=False)}
+    streams = {s_par.StreamID: s_par for s_par in df_s_filtered.itertuples(index=False)}
+    streams_by_sequence = dict(zip(df_s_filtered.Sequence, df_s_filtered.StreamID))
+    contributing_streams = {}
+    for stream_id, contributing_stream_id in zip(df_contrib_filtered.StreamID, df_contrib_filtered.ContributingStream):
+        contributing_streams.setdefault(stream_id, []).append(contributing_stream_id)
+
     watershed_area = sum(df_p_filtered.Area)
     count_planes = len(df_p_filtered)
     count_streams = len(df_s_filtered)
@@ -178,33 +190,29 @@ def execute(workspace, delineation, discretization, parameterization, parameteri
     if not os.path.exists(output_path):
         os.makedirs(output_path)
     output_file = os.path.join(output_path, parameterization_file_name)
-    f = open(output_file, 'w')
-
-    f.write(file_info)
-
-    f.write(global_info)
 
+    blocks = [file_info, global_info]
     for squc in range(1, count_streams + 1):
 
         # get stream_ID by squence
-        stream_id = df_s_filtered.loc[df_s_filtered.Sequence == squc, 'StreamID'].values[0]
+        stream_id = streams_by_sequence[squc]
 
         # get lateral ID
         lat_id = f'{stream_id - 2} {stream_id - 1}'
 
         # get upland ID
-        if stream_id - 3 in df_p_filtered.ElementID.values:
+        if stream_id - 3 in planes:
             up_plane = [stream_id - 3, stream_id - 2, stream_id - 1]
             up_id = f'{stream_id - 3}'
         else:
             up_plane = [stream_id - 2, stream_id - 1]
-            up_stream = df_contrib.loc[
-                df_contrib.StreamID == stream_id, 'ContributingStream'].values
+            up_stream = contributing_streams.get(stream_id, [])
             up_id = ' '.join(list(map(str, up_stream)))
 
         # write parameters
         for element_id in up_plane:
-            f.write(write_plane(element_id, parameterization, df_p_filtered))
-        f.write(write_channel(stream_id, up_id, lat_id, parameterization, df_s_filtered))
+            blocks.append(write_plane(planes[element_id]))
+        blocks.append(write_channel(streams[stream_id], up_id, lat_id))
 
-    f.close()
+    with open(output_file, 'w') as f:
+        f.write(''.join(blocks))
@@ -1,7 +1,9 @@
 import arcpy
 import arcpy.management
 import math
+import numpy as np
 import os
+import re
 from pathlib import Path
 import datetime
 
@@ -24,6 +26,14 @@ def initialize_workspace(workspace, discretization, depth, duration, time_step,
     arcpy.env.workspace = workspace
 
     tweet("Reading delineation name from metadata")
+    delineation_name = get_delineation_name(workspace, discretization)
+
+    tweet("Writing precipitation parameters to metadata")
+    insert_precipitation_metadata(workspace, delineation_name, discretization,
+                                  [(precipitation_name, depth, duration, time_step, hyetograph_shape, soil_moisture)])
+
+
+def get_delineation_name(workspace, discretization):
     meta_discretization_table = os.path.join(workspace, "metaDiscretization")
     fields = ["DelineationName"]
     row = None
@@ -37,7 +47,13 @@ def initialize_workspace(workspace, discretization, depth, duration, time_step,
             tweet(msg)
             raise Exception(msg)
 
-    tweet("Writing precipitation parameters to metadata")
+    return delineation_name
+
+
+def insert_precipitation_metadata(workspace, delineation_name, discretization, storms):
+    """Record precipitation parameters in metaPrecipitationK2, creating the table if needed
+    : storms - list of (precipitation name, depth, duration, time step, hyetograph shape, initial soil moisture)
+    """
     out_path = workspace
     out_name = "metaPrecipitationK2"
     template = r"\schema\metaPrecipitationK2.csv"
@@ -56,9 +72,10 @@ def initialize_workspace(workspace, discretization, depth, duration, time_step,
               "AGWAGDBVersionAtCreation"]
 
     with arcpy.da.InsertCursor(meta_precipitation_table, fields) as cursor:
-        cursor.insertRow((delineation_name, discretization, precipitation_name, depth, duration, time_step,
-                          hyetograph_shape, soil_moisture, creation_date, agwa_version_at_creation,
-                          agwa_gdb_version_at_creation))
+        for precipitation_name, depth, duration, time_step, hyetograph_shape, soil_moisture in storms:
+            cursor.insertRow((delineation_name, discretization, precipitation_name, depth, duration, time_step,
+                              hyetograph_shape, soil_moisture, creation_date, agwa_version_at_creation,
+                              agwa_gdb_version_at_creation))
 
 
 def write_precipitation(workspace, discretization, precipitation_name):
@@ -106,6 +123,97 @@ def write_precipitation(workspace, discretization, precipitation_name):
     output_file.close()
 
 
+def read_storm_matrix(storm_matrix_table, name_prefix):
+    """Read the storms of a storm matrix table
+    The table needs Depth, Duration, TimeStep, HyetographShape, and InitialSoilMoisture fields. Storms are named from
+    an optional PrecipitationName field, or from the prefix and their parameters when it is missing or empty.
+    : storm_matrix_table - table or csv with one row per storm
+    : name_prefix - prefix of generated precipitation names
+    """
+    fields = ["Depth", "Duration", "TimeStep", "HyetographShape", "InitialSoilMoisture"]
+    table_fields = [field.name.lower() for field in arcpy.ListFields(storm_matrix_table)]
+    missing_fields = [field for field in fields if field.lower() not in table_fields]
+    if missing_fields:
+        raise Exception("Cannot proceed. \nThe storm matrix '{0}' is missing the field(s) {1}.".format(
+            storm_matrix_table, ", ".join(missing_fields)))
+    has_names = "precipitationname" in table_fields
+    if has_names:
+        fields.append("PrecipitationName")
+
+    storms = []
+    with arcpy.da.SearchCursor(storm_matrix_table, fields) as cursor:
+        for row in cursor:
+            depth = float(row[0])
+            duration = float(row[1])
+            time_step = int(round(float(row[2])))
+            hyetograph_shape = row[3]
+            soil_moisture = float(row[4])
+            precipitation_name = row[5] if has_names else None
+            if not precipitation_name:
+                precipitation_name = "{0}_{1:g}mm_{2:g}h_{3}_{4:g}".format(name_prefix, depth, duration,
+                                                                         hyetograph_shape, soil_moisture)
+                precipitation_name = re.sub(r"[^0-9A-Za-z_]", "_", precipitation_name.replace(".", "p"))
+            storms.append((precipitation_name, depth, duration, time_step, hyetograph_shape, soil_moisture))
+
+    names = [storm[0] for storm in storms]
+    duplicate_names = sorted(set([name for name in names if names.count(name) > 1]))
+    if duplicate_names:
+        raise Exception("Cannot proceed. \nThe storm matrix has duplicate precipitation names: {}.".format(
+            ", ".join(duplicate_names)))
+
+    return storms
+
+
+def write_precipitation_matrix(workspace, discretization, storms):
+    """Write a .pre file for every storm of a storm matrix and record them all in metaPrecipitationK2
+    The distribution look-up table is read once, and the hyetographs of all storms that share a shape, duration,
+    and time step are computed together since they differ only by depth.
+    : storms - list of (precipitation name, depth, duration, time step, hyetograph shape, initial soil moisture)
+    """
+    arcpy.env.workspace = workspace
+
+    tweet("Reading delineation name from metadata")
+    delineation_name = get_delineation_name(workspace, discretization)
+
+    tweet("Reading precipitation distributions")
+    agwa_directory = get_agwa_directory(workspace)
+    precip_distribution_file = os.path.join(agwa_directory, "datafiles/precip", "precipitation_distributions_LUT.dbf")
+    shapes = sorted(set([storm[4] for storm in storms]))
+    lut = arcpy.da.TableToNumPyArray(precip_distribution_file, ["Time"] + shapes)
+    order = np.argsort(lut["Time"], kind="stable")
+    times = lut["Time"][order].astype(np.float64)
+
+    tweet("Computing {} design storms".format(len(storms)))
+    groups = {}
+    for storm_index, storm in enumerate(storms):
+        groups.setdefault((storm[4], storm[2], storm[3]), []).append(storm_index)
+
+    bodies = [None] * len(storms)
+    for (hyetograph_shape, duration, time_step), storm_indices in groups.items():
+        ratios = lut[hyetograph_shape][order].astype(np.float64)
+        kin_times, fractions = compute_storm_fractions(duration, time_step, times, ratios)
+        depths = np.array([storms[storm_index][1] for storm_index in storm_indices])
+        cum_depths = np.outer(depths, fractions)
+        for storm_cum_depths, storm_index in zip(cum_depths, storm_indices):
+            depth = storms[storm_index][1]
+            soil_moisture = storms[storm_index][5]
+            bodies[storm_index] = format_design_storm(kin_times, storm_cum_depths, depth, duration, soil_moisture)
+
+    tweet("Writing precipitation files")
+    workspace_directory = os.path.split(workspace)[0]
+    output_directory = os.path.join(workspace_directory, delineation_name, discretization, "precip")
+    Path(output_directory).mkdir(parents=True, exist_ok=True)
+    for storm, body in zip(storms, bodies):
+        precipitation_name, depth, duration, time_step, hyetograph_shape, soil_moisture = storm
+        header = write_header(discretization, depth, duration, hyetograph_shape)
+        output_filename = os.path.join(output_directory, precipitation_name + ".pre")
+        with open(output_filename, "w") as output_file:
+            output_file.write(header + body)
+
+    tweet("Writing precipitation parameters to metadata")
+    insert_precipitation_metadata(workspace, delineation_name, discretization, storms)
+
+
 def write_header(discretization_base_name, depth, duration, storm_shape):
     header = ""
     header += f"! User-defined storm depth {depth}mm.\n"
@@ -116,110 +224,123 @@ def write_header(discretization_base_name, depth, duration, storm_shape):
     return header
 
 
+def read_distribution(precip_distribution_file, hyetograph_shape):
+    """Read the cumulative precipitation ratios of one hyetograph shape into arrays sorted by time
+    : precip_distribution_file - precipitation_distributions_LUT.dbf in the AGWA datafiles
+    : hyetograph_shape - name of the distribution field, e.g. SCS Type II
+    """
+    fields = ["Time", hyetograph_shape]
+    distribution = arcpy.da.TableToNumPyArray(precip_distribution_file, fields)
+    times = distribution["Time"].astype(np.float64)
+    ratios = distribution[hyetograph_shape].astype(np.float64)
+    order = np.argsort(times, kind="stable")
+
+    return times[order], ratios[order]
+
+
+def compute_storm_fractions(duration, time_step_duration, times, ratios):
+    """Compute the fraction of the storm depth accumulated at each time step of a design storm
+    The storm is centered on the window of the distribution with length equal to the duration that has the largest
+    increase in cumulative ratio, and the fractions at each time step are interpolated from the distribution.
+    Returns the time steps in minutes and the cumulative fractions, so storms that differ only by depth share them.
+    : duration - storm duration in hours
+    : time_step_duration - time step in minutes
+    : times - sorted distribution times in hours
+    : ratios - cumulative precipitation ratios at each of the times
+    """
+    time_steps = math.floor((duration * 60 / time_step_duration) + 1)
+
+    # find the distribution time at the end of each window and compare it to the start of the window
+    end_times = times + duration
+    end_index = np.minimum(np.searchsorted(times, end_times - 1e-6), len(times) - 1)
+    has_end = np.isclose(times[end_index], end_times)
+    differences = np.where(has_end, ratios[end_index] - ratios, 0.0)
+    start_index = int(np.argmax(differences))
+    if differences[start_index] <= 0:
+        raise Exception("The precipitation distribution has no window with a duration of {} hours.".format(duration))
+
+    t_start = times[start_index]
+    p_start = ratios[start_index]
+    p_end = ratios[end_index[start_index]]
+
+    kin_times = np.arange(time_steps) * time_step_duration
+    p_ratios = np.interp(t_start + kin_times / 60, times, ratios)
+    fractions = (p_ratios - p_start) / (p_end - p_start)
+
+    return kin_times, fractions
+
+
+def compute_design_storm(depth, duration, time_step_duration, times, ratios):
+    """Compute the cumulative depths of a design storm from a cumulative distribution
+    Returns the time steps in minutes and the cumulative depths in mm.
+    : depth - storm depth in mm
+    : duration - storm duration in hours
+    : time_step_duration - time step in minutes
+    : times - sorted distribution times in hours
+    : ratios - cumulative precipitation ratios at each of the times
+    """
+    kin_times, fractions = compute_storm_fractions(duration, time_step_duration, times, ratios)
+
+    return kin_times, depth * fractions
+
+
+def format_design_storm(kin_times, cum_depths, depth, duration, soil_moisture, element_id="notSet"):
+    rg_line = "BEGIN RG1" + "\n"
+    if not element_id == "notSet":
+        rg_line = "BEGIN RG" + element_id + "\n"
+
+    coordinate_line = "  X = " + \
+                      str(Prop_xcoord) + ", Y = " + str(Prop_ycoord) + "\n"
+    if (Prop_xcoord == "xcoord") or (Prop_ycoord == "ycoord"):
+        coordinate_line = "  X = 0, Y = 0\n"
+
+    soil_moisture_line = "  SAT = " + str(soil_moisture) + "\n"
+    time_steps_line = "  N = " + str(len(kin_times)) + "\n"
+    header_line = "  TIME        DEPTH\n" + \
+                  "! (min)        (mm)\n"
+    design_storm = rg_line + coordinate_line + soil_moisture_line + time_steps_line + header_line
+
+    design_storm += "".join(["{0:6.2f}{1:13.2f}\n".format(kin_time, cum_depth)
+                             for kin_time, cum_depth in zip(kin_times, cum_depths)])
+
+    # If the time step duration does not divide into the storm duration
+    # evenly, this accounts for the remainder
+    if kin_times[-1] < (duration * 60):
+        design_storm += "{0:6.2f}{1:13.2f}\n".format(duration * 60, depth)
+
+    if (Prop_xcoord == "xcoord") and (Prop_ycoord == "ycoord"):
+        design_storm += "END\n"
+    else:
+        design_storm += "END\n\n" + \
+                        "BEGIN RG2\n" + \
+                        "  X = " + str(Prop_xcoord) + ", Y = " + str(Prop_ycoord) + "\n" + \
+                        "  SAT = " + str(soil_moisture) + "\n" + \
+                        "  N = 1\n" + \
+                        "  TIME        DEPTH\n" + \
+                        "! (min)        (mm)\n" + \
+                        "  0.00         0.00\n" + \
+                        "END\n"
+
+    return design_storm
+
+
 def write_from_distributions_lut(depth,
                                  duration,
                                  time_step_duration,
                                  hyetograph_shape,
                                  soil_moisture,
                                  precip_distribution_file,
-                                 element_id="notSet"):
+                                 element_id="notSet",
+                                 distribution=None):
+    # distribution - optional (times, ratios) tuple from read_distribution, so a look-up table that is already loaded
+    # can be reused for many storms
     try:
-        time_steps = math.floor((duration * 60 / time_step_duration) + 1)
-
-        rg_line = "BEGIN RG1" + "\n"
-        if not element_id == "notSet":
-            rg_line = "BEGIN RG" + element_id + "\n"
-
-        coordinate_line = "  X = " + \
-                          str(Prop_xcoord) + ", Y = " + str(Prop_ycoord) + "\n"
-        if (Prop_xcoord == "xcoord") or (Prop_ycoord == "ycoord"):
-            coordinate_line = "  X = 0, Y = 0\n"
-
-        soil_moisture_line = "  SAT = " + str(soil_moisture) + "\n"
-        time_steps_line = "  N = " + str(time_steps) + "\n"
-        header_line = "  TIME        DEPTH\n" + \
-                      "! (min)        (mm)\n"
-        design_storm = rg_line + coordinate_line + soil_moisture_line + time_steps_line + header_line
-
-        fields = ["Time", hyetograph_shape]
-
-        time = 0.0
-        value = 0.0
-        max_dif = 0.0
-        t_start = 0.0
-        t_end = 0.0
-        p_start = 0.0
-        p_end = 0.0
-
-        dist_curs = arcpy.da.SearchCursor(precip_distribution_file, fields)
-        for dist_row in dist_curs:
-            time = dist_row[0]
-            value = dist_row[1]
-            new_time = time + duration
-            if new_time <= 24:
-                where_clause = "Time = " + str(new_time)
-
-                upper_bound_curs = arcpy.da.SearchCursor(
-                    precip_distribution_file, fields, where_clause)
-                upper_bound_row = next(upper_bound_curs)
-                upper_time = upper_bound_row[0]
-                upper_value = upper_bound_row[1]
-                difference = upper_value - value
-
-                if difference > max_dif:
-                    t_start = time
-                    t_end = upper_time
-                    p_start = value
-                    p_end = upper_value
-                    max_dif = difference
-
-        the_kin_time = 0
-        cum_depth = 0
-        p_ratio = 0
-        current_time = ""
-        current_depth = ""
-
-        for i in range(time_steps):
-            the_time = t_start + i * time_step_duration / 60
-            the_kin_time = i * time_step_duration
-            p_ratio_query = "Time = " + str(round(the_time, 1))
-            p_ratio_cursor = arcpy.da.SearchCursor(
-                precip_distribution_file, fields, p_ratio_query)
-            p_ratio_row = next(p_ratio_cursor)
-            p_ratio = p_ratio_row[1]
-
-            cum_depth = depth * (p_ratio - p_start) / (p_end - p_start)
-
-            # Add the current line to the string
-            current_time = "%.2f" % round(the_kin_time, 2)
-            current_time = current_time.rjust(6, ' ')
-            current_depth = "%.2f" % round(cum_depth, 2)
-            current_depth = current_depth.rjust(13, ' ')
-            design_storm += current_time + current_depth + "\n"
-
-        # If the time step duration does not divide into the storm duration
-        # evenly, this accounts for the remainder
-        if int(float(current_time.strip())) < (duration * 60):
-            current_time = "%.2f" % round(duration, 2)
-            current_time = current_time.rjust(6, ' ')
-            current_depth = "%.2f" % round(depth, 2)
-            current_depth = current_depth.rjust(13, ' ')
-            design_storm += current_time + current_depth + "\n"
-
-        if (Prop_xcoord == "xcoord") and (Prop_ycoord == "ycoord"):
-            design_storm += "END\n"
-        else:
-            design_storm += "END\n\n" + \
-                            "BEGIN RG2\n" + \
-                            "  X = " + str(Prop_xcoord) + ", Y = " + str(Prop_ycoord) + "\n" + \
-                            "  SAT = " + str(soil_moisture) + "\n" + \
-                            "  N = 1\n" + \
-                            "  TIME        DEPTH\n" + \
-                            "! (min)        (mm)\n" + \
-                            "  0.00         0.00\n" + \
-                            "END\n"
-
-        return design_storm
+        if distribution is None:
+            distribution = read_distribution(precip_distribution_file, hyetograph_shape)
+        times, ratios = distribution
+        kin_times, cum_depths = compute_design_storm(depth, duration, time_step_duration, times, ratios)
+
+        return format_design_storm(kin_times, cum_depths, depth, duration, soil_moisture, element_id)
     except BaseException:
         msg = "WriteFromDistributionsLUT() Error"
         arcpy.AddMessage(msg)
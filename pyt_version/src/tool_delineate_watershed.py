@@ -71,7 +71,14 @@ class DelineateWatershed(object):
                                  direction="Input")
         param7.value = False
 
-        params = [param0, param1, param2, param3, param4, param5, param6, param7]
+        param8 = arcpy.Parameter(displayName="Batch Delineation (one delineation per outlet)",
+                                 name="Batch_Delineation",
+                                 datatype="GPBoolean",
+                                 parameterType="Optional",
+                                 direction="Input")
+        param8.value = False
+
+        params = [param0, param1, param2, param3, param4, param5, param6, param7, param8]
         return params
 
     # noinspection PyPep8Naming
@@ -108,6 +115,15 @@ class DelineateWatershed(object):
                     msg = f"The selected geodatabase already has an AGWA delineation named {delineation_name_par}. " \
                           f"Please enter a unique name for the delineation to be created."
                     parameters[3].setErrorMessage(msg)
+                # batch delineations are named <Delineation Name>_<ObjectID of the outlet>
+                if parameters[8].value:
+                    df_filtered = df_delineation[df_delineation.DelineationName.str.startswith(
+                        f"{delineation_name_par}_")]
+                    if len(df_filtered) != 0:
+                        msg = f"The selected geodatabase already has AGWA delineations named " \
+                              f"{delineation_name_par}_<ObjectID>. Please enter a unique name for the batch of " \
+                              f"delineations to be created."
+                        parameters[3].setErrorMessage(msg)
 
         return
 
@@ -123,9 +139,15 @@ class DelineateWatershed(object):
         delineation_name_par = parameters[3].valueAsText
         environment_par = arcpy.GetParameterAsText(5)
         save_intermediate_outputs_par = arcpy.GetParameterAsText(7).lower() == 'true'
-
-        agwa.initialize_workspace(workspace_par, delineation_name_par, outlet_feature_set_par, snap_radius_par)
-        agwa.delineate(workspace_par, delineation_name_par, save_intermediate_outputs_par)
+        batch_delineation_par = arcpy.GetParameterAsText(8).lower() == 'true'
+
+        if batch_delineation_par:
+            delineation_names = agwa.initialize_batch(workspace_par, delineation_name_par, outlet_feature_set_par,
+                                                      snap_radius_par)
+            agwa.delineate_batch(workspace_par, delineation_name_par, delineation_names, save_intermediate_outputs_par)
+        else:
+            agwa.initialize_workspace(workspace_par, delineation_name_par, outlet_feature_set_par, snap_radius_par)
+            agwa.delineate(workspace_par, delineation_name_par, save_intermediate_outputs_par)
         messages.addGPMessages()
 
         return
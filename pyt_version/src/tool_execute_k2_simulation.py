@@ -4,9 +4,10 @@ import os
 import sys
 import pandas as pd
 import glob
-import subprocess
-# from subprocess import Popen, PIPE
 sys.path.append(os.path.dirname(__file__))
+import code_execute_k2_simulation as agwa
+import importlib
+importlib.reload(agwa)
 
 
 class ExecuteK2Simulation(object):
@@ -56,11 +57,12 @@ class ExecuteK2Simulation(object):
 
         param0.filter.list = discretization_list
 
-        param1 = arcpy.Parameter(displayName="Simulation",
-                                 name="Simulation",
+        param1 = arcpy.Parameter(displayName="Simulations",
+                                 name="Simulations",
                                  datatype="GPString",
                                  parameterType="Required",
-                                 direction="Input")
+                                 direction="Input",
+                                 multiValue=True)
 
         param2 = arcpy.Parameter(displayName="Workspace",
                                  name="Workspace",
@@ -87,7 +89,16 @@ class ExecuteK2Simulation(object):
                                  direction="Input")
         param5.value = False
 
-        params = [param0, param1, param2, param3, param4, param5]
+        param6 = arcpy.Parameter(displayName="Maximum Concurrent Simulations",
+                                 name="Maximum_Concurrent_Simulations",
+                                 datatype="GPLong",
+                                 parameterType="Optional",
+                                 direction="Input")
+        param6.filter.type = "Range"
+        param6.filter.list = [1, 1024]
+        param6.value = os.cpu_count()
+
+        params = [param0, param1, param2, param3, param4, param5, param6]
         return params
 
     # noinspection PyPep8Naming
@@ -157,22 +168,12 @@ class ExecuteK2Simulation(object):
         # arcpy.AddMessage("Toolbox source: " + os.path.dirname(__file__))
         arcpy.AddMessage("Script source: " + __file__)
         discretization_par = parameters[0].valueAsText
-        simulation_par = parameters[1].valueAsText
+        simulations_par = parameters[1].values
         workspace_par = parameters[2].valueAsText
         delineation_par = parameters[3].valueAsText
+        max_workers_par = parameters[6].value
 
-        workspace_directory = os.path.split(workspace_par)[0]
-        k2_path = os.path.join(simulation_par, "k2.exe -b")
-
-        # This executes the model, but the command window closes automatically without the opportunity to see the output
-        # subprocess.Popen(k2_path, cwd=simulation_par)
-
-        # This executes the model and keeps the command window open
-        subprocess.Popen(["start", "cmd", "/k", k2_path], shell=True, cwd=simulation_par)
-
-        # A failed attempt at executing the model and keeping the command window open until a key is pressed
-        # process = subprocess.Popen(k2_path, cwd=simulation_par, stdin=subprocess.PIPE, text=True)
-        # process.communicate("\n")
+        agwa.execute_simulations(workspace_par, [str(simulation) for simulation in simulations_par], max_workers_par)
 
         return
 
@@ -102,7 +102,14 @@ class ImportResults(object):
                                  direction="Input")
         param5.value = False
 
-        params = [param0, param1, param2, param3, param4, param5]
+        param6 = arcpy.Parameter(displayName="Import Element Time Series",
+                                 name="Import_Element_Time_Series",
+                                 datatype="GPBoolean",
+                                 parameterType="Optional",
+                                 direction="Input")
+        param6.value = False
+
+        params = [param0, param1, param2, param3, param4, param5, param6]
         return params
 
     # noinspection PyPep8Naming
@@ -233,6 +240,7 @@ class ImportResults(object):
         delineation_par = parameters[3].valueAsText
         debug_par = parameters[4].valueAsText
         save_intermediate_outputs_par = parameters[5].valueAsText
+        import_time_series_par = parameters[6].value
 
         meta_simulation_table = os.path.join(workspace_par, "metaSimulation")
         parameterization_name = None
@@ -258,6 +266,8 @@ class ImportResults(object):
                 arcpy.AddMessage(f"Importing simulation '{simulation_name}' ")
                 agwa.import_k2_results(workspace_par, delineation_par, discretization_par, parameterization_name,
                                        simulation_name, sim_abspath)
+                if import_time_series_par:
+                    agwa.import_k2_time_series(sim_abspath)
                 arcpy.AddMessage("------------------------------------------------------------")
             else:
                 arcpy.AddMessage(f"Skipping simulation '{simulation_name}' ")
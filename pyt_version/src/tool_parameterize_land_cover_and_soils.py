@@ -73,7 +73,7 @@ class ParameterizeLandCoverAndSoils(object):
                                  datatype=["GPFeatureLayer", "GPRasterLayer"],
                                  parameterType="Required",
                                  direction="Input")
-        # TODO: Add GPRasterLayer to datatype list for Soils Layer parameter
+        # a soils raster, e.g. the gSSURGO map unit raster, is cross-tabulated with the elements instead of intersected
 
         param4 = arcpy.Parameter(displayName="Soils Database",
                                  name="Soils Database",
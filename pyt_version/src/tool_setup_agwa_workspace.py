@@ -97,7 +97,24 @@ class SetupAgwaWorkspace(object):
                                   parameterType="Optional",
                                   direction="Input")
 
-        params = [param0, param1, param2, param3, param4, param5, param6, param7, param8, param9, param10, param11]
+        param12 = arcpy.Parameter(displayName="Terrain Engine",
+                                  name="Terrain_Engine",
+                                  datatype="GPString",
+                                  parameterType="Required",
+                                  direction="Input")
+        param12.filter.list = agwa.TERRAIN_ENGINES
+        param12.value = param12.filter.list[0]
+
+        param13 = arcpy.Parameter(displayName="Tile Size (cells)",
+                                  name="Tile_Size",
+                                  datatype="GPLong",
+                                  parameterType="Optional",
+                                  direction="Input")
+        param13.value = agwa.AGWA_TiledTerrain.DEFAULT_TILE_SIZE
+        param13.enabled = False
+
+        params = [param0, param1, param2, param3, param4, param5, param6, param7, param8, param9, param10, param11,
+                  param12, param13]
         return params
 
     # noinspection PyPep8Naming
@@ -127,6 +144,9 @@ class SetupAgwaWorkspace(object):
             parameters[6].value = ""
             parameters[7].value = ""
 
+        # the tile size only applies to the tiled terrain engine
+        parameters[13].enabled = parameters[12].valueAsText == "NumPy (tiled)"
+
         return
 
     # noinspection PyPep8Naming
@@ -193,9 +213,13 @@ class SetupAgwaWorkspace(object):
         slope_par = parameters[8].valueAsText
         aspect_par = parameters[9].valueAsText
         environment_par = arcpy.GetParameterAsText(10)
+        terrain_engine_par = parameters[12].valueAsText
+        tile_size_par = parameters[13].value
+        if not tile_size_par:
+            tile_size_par = agwa.AGWA_TiledTerrain.DEFAULT_TILE_SIZE
 
         agwa.prepare_rasters(workspace_par, filled_dem_par, unfilled_dem_par, fd_par, fa_par, flup_par, slope_par,
-                             aspect_par, agwa_directory_par)
+                             aspect_par, agwa_directory_par, terrain_engine_par, int(tile_size_par))
 
         return
 
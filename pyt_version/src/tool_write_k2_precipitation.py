@@ -64,7 +64,7 @@ class WriteK2Precipitation(object):
         param1 = arcpy.Parameter(displayName="Depth (mm)",
                                  name="Depth",
                                  datatype="GPDouble",
-                                 parameterType="Required",
+                                 parameterType="Optional",
                                  direction="Input")
         param1.filter.type = "Range"
         param1.filter.list = [0, sys.float_info.max]
@@ -72,7 +72,7 @@ class WriteK2Precipitation(object):
         param2 = arcpy.Parameter(displayName="Duration (hours)",
                                  name="Duration",
                                  datatype="GPDouble",
-                                 parameterType="Required",
+                                 parameterType="Optional",
                                  direction="Input")
         param2.filter.type = "Range"
         param2.filter.list = [0.05, sys.float_info.max]
@@ -80,7 +80,7 @@ class WriteK2Precipitation(object):
         param3 = arcpy.Parameter(displayName="Time Step Duration (minutes)",
                                  name="Time_step_duration",
                                  datatype="GPDouble",
-                                 parameterType="Required",
+                                 parameterType="Optional",
                                  direction="Input")
         param3.filter.type = "Range"
         param3.filter.list = [1, sys.float_info.max]
@@ -88,13 +88,13 @@ class WriteK2Precipitation(object):
         param4 = arcpy.Parameter(displayName="Hyetograph Shape",
                                  name="Hyetograph_Shape",
                                  datatype="GPString",
-                                 parameterType="Required",
+                                 parameterType="Optional",
                                  direction="Input")
 
         param5 = arcpy.Parameter(displayName="Initial Soil Moisture",
                                  name="Initial Soil Moisture",
                                  datatype="GPDouble",
-                                 parameterType="Required",
+                                 parameterType="Optional",
                                  direction="Input")
         param5.filter.type = "Range"
         param5.filter.list = [0, 1]
@@ -129,7 +129,16 @@ class WriteK2Precipitation(object):
         else:
             param9.value = ""
 
-        params = [param0, param1, param2, param3, param4, param5, param6, param7, param8, param9]
+        param10 = arcpy.Parameter(displayName="Storm Matrix",
+                                  name="Storm_Matrix",
+                                  datatype="GPTableView",
+                                  parameterType="Optional",
+                                  direction="Input")
+        # table with Depth, Duration, TimeStep, HyetographShape, InitialSoilMoisture, and optionally
+        # PrecipitationName fields. When provided, a precipitation file is written for every row and the
+        # Filename is used as the prefix of storms without a name
+
+        params = [param0, param1, param2, param3, param4, param5, param6, param7, param8, param9, param10]
         return params
 
     # noinspection PyPep8Naming
@@ -202,6 +211,11 @@ class WriteK2Precipitation(object):
     def updateMessages(self, parameters):
         """Modify the messages created by internal validation for each tool
         parameter.  This method is called after internal validation."""
+        # a single storm needs every storm parameter unless a storm matrix is provided
+        if not parameters[10].value:
+            for parameter in parameters[1:6]:
+                if parameter.value is None:
+                    parameter.setErrorMessage("A value is required when no Storm Matrix is provided.")
         return
 
     def execute(self, parameters, messages):
@@ -218,10 +232,15 @@ class WriteK2Precipitation(object):
         filename_par = parameters[6].valueAsText
         environment_par = parameters[7].valueAsText
         workspace_par = parameters[8].valueAsText
+        storm_matrix_par = parameters[10].valueAsText
 
-        agwa.initialize_workspace(workspace_par, discretization_par, depth_par, duration_par, time_step_par,
-                                  hyetograph_par, soil_moisture_par, filename_par)
-        agwa.write_precipitation(workspace_par, discretization_par, filename_par)
+        if storm_matrix_par:
+            storms = agwa.read_storm_matrix(storm_matrix_par, filename_par)
+            agwa.write_precipitation_matrix(workspace_par, discretization_par, storms)
+        else:
+            agwa.initialize_workspace(workspace_par, discretization_par, depth_par, duration_par, time_step_par,
+                                      hyetograph_par, soil_moisture_par, filename_par)
+            agwa.write_precipitation(workspace_par, discretization_par, filename_par)
 
         return
 